@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Benchmarks spdl end to end against a local `FakeCDN`, without any access to the real South Park hosts. Each run
+times the phases of a download like the command line interface performs it:
+
+ * catalog: fetching the season feeds (`select_episodes()`)
+ * videos: fetching the mrss feeds and mediagen documents (`Episode.get_videos()`)
+ * streams: fetching the variant playlists (`Video.get_streams()`)
+ * download: downloading (and merging, if an ffmpeg binary is given) all episodes
+
+The results are printed as a table and can be saved as JSON to compare them with a later run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spdl
+from fake_cdn import FakeCDN
+
+PHASES = ('catalog', 'videos', 'streams', 'download')
+
+
+def run_once(cdn: FakeCDN, args: argparse.Namespace, workdir: str,
+             cache: Optional[spdl.MetadataCache] = None) -> Dict[str, Any]:
+    """
+    Perform one benchmark run with fresh episode objects, a fresh HTTP client and fresh throughput measurements.
+    :param cdn: The running fake CDN
+    :param args: The benchmark options
+    :param workdir: The directory to download to
+    :param cache: The metadata cache to use, or None to disable caching
+    :return: The duration of each phase in seconds alongside the statistics of the run
+    """
+    spdl.http_client.close()
+    spdl.http_client = spdl.HTTPClient(timeout=args.timeout, retries=args.retries, backoff=args.backoff)
+    spdl.http_client.host_overrides['*'] = cdn.url
+    spdl.throughput_monitor = spdl.ThroughputMonitor()
+    spdl.metadata_cache = cache
+    stats = spdl.instrumentation.add_sink(spdl.RunStats())
+    cdn.reset_counters()
+
+    timings = {}
+    try:
+        started = time.perf_counter()
+        episodes = spdl.select_episodes(spdl.SouthPark(args.language), args.what, args.resolve_threads)
+        timings['catalog'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        spdl.resolve_episodes(episodes, args.resolve_threads, streams=False)
+        timings['videos'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        spdl.resolve_episodes(episodes, args.resolve_threads, streams=True)
+        timings['streams'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        failed = download(episodes, args, workdir)
+        timings['download'] = time.perf_counter() - started
+    finally:
+        spdl.instrumentation.remove_sink(stats)
+
+    summary = stats.summary()
+    return {
+        'phases': timings,
+        'total': sum(timings.values()),
+        'episodes': len(episodes),
+        'failed': failed,
+        'bytes': summary['bytes'],
+        'rate': summary['bytes'] / timings['download'] if timings['download'] else 0.,
+        'latency_p50': summary['latency_p50'],
+        'latency_p95': summary['latency_p95'],
+        'elapsed_p50': summary['elapsed_p50'],
+        'elapsed_p95': summary['elapsed_p95'],
+        'retries': summary['retries'],
+        'busy': summary['phases'],
+        'requests': cdn.requests,
+        'injected_errors': cdn.errors,
+    }
+
+
+def download(episodes: List[spdl.Episode], args: argparse.Namespace, workdir: str) -> int:
+    """
+    Download the episodes. Without an ffmpeg binary, only the parts are downloaded (the synthetic segments can not
+    be merged anyway); otherwise a `DownloadScheduler` downloads and merges them like the command line interface.
+    :return: The number of failed episodes
+    """
+    if args.ffmpeg_binary:
+        scheduler = spdl.DownloadScheduler(quality=args.quality, max_episodes=args.episodes_parallel,
+                                           max_threads=args.threads, max_threads_per_part=args.part_threads,
+                                           ffmpeg_executable=args.ffmpeg_binary, resume=False,
+                                           streaming=args.stream_mux)
+        jobs = scheduler.run((e, os.path.join(workdir, f"{e.id}.mp4")) for e in episodes)
+        scheduler.shutdown()
+        return sum(1 for j in jobs if j.state != 'done')
+
+    network_pool = spdl.PriorityThreadPool(args.threads)
+
+    def download_parts(priority: int, episode: spdl.Episode) -> bool:
+        try:
+            parts = episode.download_parts(args.quality, network_pool.with_priority(priority), args.part_threads,
+                                           resume=False)
+        except spdl.SpdlError as e:
+            print(f"Download of {episode} failed: {e}", file=sys.stderr)
+            return False
+        spdl.remove_files(parts)
+        return True
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.episodes_parallel) as episode_pool:
+            results = list(episode_pool.map(download_parts, range(len(episodes)), episodes))
+    finally:
+        network_pool.shutdown()
+    return results.count(False)
+
+
+def aggregate(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine multiple runs into the median of each measurement.
+    :param runs: The runs, as returned by `run_once()`
+    :return: The medians
+    """
+    return {
+        'phases': {p: statistics.median(r['phases'][p] for r in runs) for p in PHASES},
+        'total': statistics.median(r['total'] for r in runs),
+        'rate': statistics.median(r['rate'] for r in runs),
+        'latency_p50': statistics.median(r['latency_p50'] for r in runs),
+        'latency_p95': statistics.median(r['latency_p95'] for r in runs),
+        'elapsed_p50': statistics.median(r['elapsed_p50'] for r in runs),
+        'elapsed_p95': statistics.median(r['elapsed_p95'] for r in runs),
+        'requests': statistics.median(r['requests'] for r in runs),
+        'retries': statistics.median(r['retries'] for r in runs),
+    }
+
+
+def report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    """
+    Print the medians of a benchmark, optionally next to the medians of an earlier one.
+    :param result: The benchmark result
+    :param baseline: An earlier benchmark result to compare with
+    """
+    rows = [(f"{p} (s)", result['median']['phases'][p], baseline and baseline['median']['phases'][p], True)
+            for p in PHASES]
+    rows += [
+        ("total (s)", result['median']['total'], baseline and baseline['median']['total'], True),
+        ("rate (MB/s)", result['median']['rate'] / 2 ** 20, baseline and baseline['median']['rate'] / 2 ** 20, False),
+        ("latency p50 (s)", result['median']['latency_p50'], baseline and baseline['median']['latency_p50'], True),
+        ("latency p95 (s)", result['median']['latency_p95'], baseline and baseline['median']['latency_p95'], True),
+        ("segment p50 (s)", result['median']['elapsed_p50'], baseline and baseline['median']['elapsed_p50'], True),
+        ("segment p95 (s)", result['median']['elapsed_p95'], baseline and baseline['median']['elapsed_p95'], True),
+        ("requests", result['median']['requests'], baseline and baseline['median']['requests'], True),
+        ("retries", result['median']['retries'], baseline and baseline['median']['retries'], True),
+    ]
+    print(f"{'':<18}{'median':>12}" + (f"{'baseline':>12}{'change':>10}" if baseline else ""))
+    for name, value, old, lower_is_better in rows:
+        line = f"{name:<18}{value:>12.3f}"
+        if baseline:
+            change = (value - old) / old * 100 if old else 0.
+            better = change < 0 if lower_is_better else change > 0
+            line += f"{old:>12.3f}{change:>+9.1f}%" + (" *" if abs(change) >= 5 and better else "")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(os.path.basename(__file__), description="Benchmark spdl against a local fake CDN")
+    parser.add_argument('what', nargs='?', default='all',
+                        help="The episodes to download, in the same format as for spdl.py. Default: all")
+    parser.add_argument('--seasons', default=2, type=int, help="The number of seasons the fake CDN serves. Default: 2")
+    parser.add_argument('--episodes', default=4, type=int, help="The number of episodes per season. Default: 4")
+    parser.add_argument('--parts', default=4, type=int, help="The number of video parts per episode. Default: 4")
+    parser.add_argument('--segments', default=20, type=int, help="The number of segments per video part. Default: 20")
+    parser.add_argument('--segment-size', default='200k',
+                        help="The size of each segment of the highest rendition, e.g. '200k' or '1M'. Default: 200k")
+    parser.add_argument('--latency', default=0., type=float,
+                        help="The delay before each response, in seconds. Default: 0")
+    parser.add_argument('--bandwidth', default=None,
+                        help="The maximum rate of each response, e.g. '2M' bytes per second. Default: no limit")
+    parser.add_argument('--error-rate', default=0., type=float,
+                        help="The probability that a request fails with a 503 response. Default: 0")
+    parser.add_argument('--fixtures', default=None,
+                        help="A directory with recorded responses that are served instead of the synthetic ones, stored as '<host>/<quoted path and query>'")
+    parser.add_argument('--seed', default=1, type=int, help="The seed for the error injection. Default: 1")
+    parser.add_argument('--url-lifetime', default=None, type=float,
+                        help="Sign the stream urls with an expiry this many seconds after they were resolved. Default: no expiry")
+    parser.add_argument('-l', '--language', default='en', help="The language to request. Default: en")
+    parser.add_argument('-q', '--quality', default='max', help="The video quality to download. Default: max")
+    parser.add_argument('-t', '--threads', default=8, type=int,
+                        help="The maximum number of segments to download concurrently. Default: 8")
+    parser.add_argument('--part-threads', default=4, type=int,
+                        help="The maximum number of segments to download concurrently per video part. Default: 4")
+    parser.add_argument('-e', '--episodes-parallel', default=2, type=int,
+                        help="The maximum number of episodes to download concurrently. Default: 2")
+    parser.add_argument('--resolve-threads', default=16, type=int,
+                        help="The maximum number of concurrent metadata requests. Default: 16")
+    parser.add_argument('--timeout', default=30., type=float, help="The network timeout in seconds. Default: 30")
+    parser.add_argument('--retries', default=3, type=int, help="How often failed requests are retried. Default: 3")
+    parser.add_argument('--backoff', default=0.05, type=float,
+                        help="The base delay between retries in seconds. Default: 0.05")
+    parser.add_argument('--cache', action='store_true',
+                        help="Use a metadata cache that is shared by all runs, so that only the first run is cold")
+    parser.add_argument('--stream-mux', action='store_true', help="Pipe the segments directly into ffmpeg")
+    parser.add_argument('-b', '--ffmpeg-binary', default=None,
+                        help="Merge the downloaded parts with this ffmpeg binary. Only useful with recorded segments. Default: do not merge")
+    parser.add_argument('-r', '--repeat', default=3, type=int, help="The number of runs. Default: 3")
+    parser.add_argument('-o', '--output', default=None, help="Save the results as JSON to this file")
+    parser.add_argument('-c', '--compare', default=None, help="Compare the results with a JSON file saved earlier")
+    args = parser.parse_args()
+
+    cdn = FakeCDN(seasons=args.seasons, episodes=args.episodes, parts=args.parts, segments=args.segments,
+                  segment_size=spdl.parse_size(args.segment_size), latency=args.latency,
+                  bandwidth=spdl.parse_size(args.bandwidth or '') or None, error_rate=args.error_rate,
+                  fixtures=args.fixtures, seed=args.seed, url_lifetime=args.url_lifetime)
+    cdn.start()
+    workdir = tempfile.mkdtemp(prefix='spdl-bench-')
+    spdl.set_tempdir(workdir)
+    cache = spdl.MetadataCache(os.path.join(workdir, 'metadata.sqlite')) if args.cache else None
+
+    runs = []
+    try:
+        for i in range(args.repeat):
+            result = run_once(cdn, args, workdir, cache)
+            runs.append(result)
+            print(f"Run {i + 1}/{args.repeat}: " + ", ".join(f"{p} {result['phases'][p]:.3f}s" for p in PHASES)
+                  + f", {result['rate'] / 2 ** 20:.2f} MB/s, {result['requests']} requests, {result['failed']} failed")
+    finally:
+        if cache is not None:
+            cache.close()
+        cdn.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'runs': runs,
+        'median': aggregate(runs),
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['config'] != result['config']:
+            print("Warning: the baseline was measured with different options", file=sys.stderr)
+    print()
+    report(result, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+A local HTTP server that imitates the South Park hosts and their CDN for benchmarks. It serves synthetic (or
+recorded) season feeds, mrss feeds, mediagen documents, HLS playlists, captions and MPEG-TS segments, and can
+inject latency, bandwidth caps, errors and expiring stream urls.
+
+Point spdl at it with `HTTPClient.host_overrides`; the server tells the original hosts apart by the Host header.
+"""
+
+import http.server
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from typing import Optional, Tuple, Dict
+
+MEDIAGEN_HOST = "media.spdl.test"
+CDN_HOST = "cdn.spdl.test"
+
+TS_NULL_PACKET = bytes([0x47, 0x1f, 0xff, 0x10]) + b'\xff' * 184
+
+
+class FakeCDN:
+    def __init__(self, seasons: int = 2, episodes: int = 4, parts: int = 4, segments: int = 20,
+                 segment_duration: float = 4., segment_size: int = 200 * 1024,
+                 renditions: Tuple[str, ...] = ('1920x1080', '1280x720', '960x540'), latency: float = 0.,
+                 bandwidth: Optional[float] = None, error_rate: float = 0., fixtures: Optional[str] = None,
+                 seed: Optional[int] = None, url_lifetime: Optional[float] = None):
+        """
+        :param seasons: The number of seasons
+        :param episodes: The number of episodes per season
+        :param parts: The number of video parts per episode
+        :param segments: The number of segments per video part
+        :param segment_duration: The duration of each segment in seconds
+        :param segment_size: The size of each segment of the highest rendition in bytes; lower renditions are smaller
+        :param renditions: The resolutions of the streams, from highest to lowest
+        :param latency: The delay before each response is sent, in seconds
+        :param bandwidth: The maximum rate each response is sent with, in bytes per second, or None for no limit
+        :param error_rate: The probability that a request fails with a 503 response
+        :param fixtures: A directory with recorded responses, stored as '<host>/<quoted path and query>'. They are served instead of the synthetic ones.
+        :param seed: The seed of the random generator for the error injection
+        :param url_lifetime: If given, the stream urls of the mediagen documents are signed with an expiry this many seconds in the future, and expired urls are rejected with a 403 response
+        """
+        self.seasons = seasons
+        self.episodes = episodes
+        self.parts = parts
+        self.segments = segments
+        self.segment_duration = segment_duration
+        self.segment_size = segment_size
+        self.renditions = renditions
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.fixtures = fixtures
+        self.url_lifetime = url_lifetime
+        self.requests: int = 0
+        """The number of requests received"""
+        self.errors: int = 0
+        """The number of injected errors"""
+        self.rejected: int = 0
+        """The number of requests rejected because their url expired"""
+        self.bytes_sent: int = 0
+        """The number of body bytes sent"""
+        self.__random = random.Random(seed)
+        self.__segment_data: Dict[int, bytes] = {}
+        self.__lock = threading.Lock()
+        self.__server: Optional[socketserver.ThreadingTCPServer] = None
+
+    @property
+    def url(self) -> str:
+        """The base url of the running server"""
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        Start serving in a background thread.
+        :param host: The address to listen on
+        :param port: The port to listen on; 0 picks a free port
+        :return: The base url of the server
+        """
+        self.__server = _Server((host, port), _Handler)
+        self.__server.cdn = self
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def reset_counters(self):
+        """
+        Reset the request, error and byte counters.
+        """
+        with self.__lock:
+            self.requests = self.errors = self.rejected = self.bytes_sent = 0
+
+    def respond(self, host: str, path: str) -> Tuple[int, str, bytes]:
+        """
+        Create the response to a request.
+        :param host: The requested host, without port
+        :param path: The requested path, including the query
+        :return: The status, the content type and the body
+        """
+        with self.__lock:
+            self.requests += 1
+            failed = self.error_rate > 0 and self.__random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if failed:
+            return 503, 'text/plain', b'Injected error'
+
+        if self.fixtures is not None:
+            fixture = os.path.join(self.fixtures, host, urllib.parse.quote(path.lstrip('/'), safe='/'))
+            if os.path.isfile(fixture):
+                with open(fixture, 'rb') as f:
+                    return 200, 'application/octet-stream', f.read()
+
+        parts = urllib.parse.urlsplit(path)
+        path = parts.path
+        token = f"?{parts.query}" if host == CDN_HOST and parts.query else ''
+        expires = urllib.parse.parse_qs(parts.query).get('exp', [None])[0]
+        if host == CDN_HOST and expires is not None and float(expires) < time.time():
+            with self.__lock:
+                self.rejected += 1
+            return 403, 'text/plain', b'Expired'
+        if path.endswith(('/all-episodes', '/alle-episoden')) or (path == '/' and host.endswith('southparkstudios.nu')):
+            return 200, 'text/html', ''.join(f'<a data-value="season-{n}">Season {n}</a>'
+                                             for n in range(1, self.seasons + 1)).encode()
+        m = re.search(r'/feeds/carousel/video/[^/]+/(\d+)/(\d+)/json/!airdate/season-(\d+)', path)
+        if m:
+            return 200, 'application/json', self.__season(int(m.group(3)), int(m.group(1)), int(m.group(2)))
+        m = re.search(r'/feeds/video-player/mrss/mgid:arc:episode:[^:]+:([\w-]+)', path)
+        if m:
+            items = ''.join(f'<item><media:content url="{urllib.parse.quote(self.__mediagen_url(m.group(1), p), safe="")}"/></item>'
+                            for p in range(self.parts))
+            return 200, 'text/xml', f'<rss xmlns:media="http://search.yahoo.com/mrss/"><channel>{items}</channel></rss>'.encode()
+        if path == '/pmt/e1/access/index.html':
+            episode = urllib.parse.parse_qs(parts.query).get('uri', [''])[0].split(':')[-1]
+            items = [{'group': {'content': self.__mediagen_url(episode, p)}} for p in range(self.parts)]
+            return 200, 'application/json', json.dumps({'feed': {'items': items}}).encode()
+        m = re.match(r'/mediagen/([\w-]+)/(\d+)$', path)
+        if m:
+            base = f"http://{CDN_HOST}/{m.group(1)}/{m.group(2)}"
+            duration = int(self.segments * self.segment_duration)
+            signature = f"?exp={int(time.time() + self.url_lifetime)}" if self.url_lifetime is not None else ''
+            return 200, 'text/xml', (f'<package><video><item><rendition duration="{duration}"><src>{base}/master.m3u8{signature}</src>'
+                                     f'</rendition><typographic format="vtt" src="{base}/captions.vtt"/></item></video></package>').encode()
+        if path.endswith('/master.m3u8'):
+            lines = ['#EXTM3U']
+            for i, resolution in enumerate(self.renditions):
+                lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={self.__rendition_size(i) * 8 // max(int(self.segment_duration), 1)},RESOLUTION={resolution}')
+                lines.append(f'{i}/media.m3u8{token}')
+            return 200, 'application/vnd.apple.mpegurl', ('\n'.join(lines) + '\n').encode()
+        m = re.search(r'/(\d+)/media\.m3u8$', path)
+        if m:
+            lines = ['#EXTM3U', f'#EXT-X-TARGETDURATION:{round(self.segment_duration)}', '#EXT-X-MEDIA-SEQUENCE:0']
+            for i in range(self.segments):
+                lines += [f'#EXTINF:{self.segment_duration:.3f},', f'seg{i}.ts{token}']
+            lines.append('#EXT-X-ENDLIST')
+            return 200, 'application/vnd.apple.mpegurl', ('\n'.join(lines) + '\n').encode()
+        m = re.search(r'/(\d+)/seg\d+\.ts$', path)
+        if m:
+            return 200, 'video/mp2t', self.__segment(self.__rendition_size(int(m.group(1))))
+        if path.endswith('.vtt'):
+            return 200, 'text/vtt', b'WEBVTT\n\n00:00:01.000 --> 00:00:03.000\nBenchmark\n'
+        return 404, 'text/plain', b'Not found'
+
+    def count_sent(self, size: int):
+        with self.__lock:
+            self.bytes_sent += size
+
+    def __season(self, season: int, page_size: int, page: int) -> bytes:
+        results = [{
+            'itemId': f'bench-{season:02d}{e:02d}',
+            'title': f'Benchmark Episode {season}x{e}',
+            'description': 'A synthetic episode',
+            'shortDescription': 'A synthetic episode',
+            'images': f'http://{CDN_HOST}/thumbnails/{season:02d}{e:02d}.jpg',
+            'originalAirDate': str(1000000000 + season * 100000 + e),
+            'episodeNumber': f'{season:02d}{e:02d}',
+        } for e in range(1, self.episodes + 1)]
+        start = (max(page, 1) - 1) * page_size
+        return json.dumps({'results': results[start:start + page_size]}).encode()
+
+    def __mediagen_url(self, episode: str, part: int) -> str:
+        return f"http://{MEDIAGEN_HOST}/mediagen/{episode}/{part}?device={{device}}"
+
+    def __rendition_size(self, index: int) -> int:
+        return self.segment_size // 2 ** index
+
+    def __segment(self, size: int) -> bytes:
+        packets = max(size // len(TS_NULL_PACKET), 1)
+        with self.__lock:
+            if packets not in self.__segment_data:
+                self.__segment_data[packets] = TS_NULL_PACKET * packets
+            return self.__segment_data[packets]
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} requests={self.requests} errors={self.errors} rejected={self.rejected} bytes_sent={self.bytes_sent}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    cdn: FakeCDN = None
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    CHUNK_SIZE = 16 * 1024
+
+    def do_GET(self):
+        cdn = self.server.cdn
+        host = (self.headers.get('Host') or '').split(':')[0]
+        status, content_type, body = cdn.respond(host, self.path)
+        if cdn.latency:
+            time.sleep(cdn.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if cdn.bandwidth:
+            for i in range(0, len(body), self.CHUNK_SIZE):
+                chunk = body[i:i + self.CHUNK_SIZE]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / cdn.bandwidth)
+        else:
+            self.wfile.write(body)
+        cdn.count_sent(len(body))
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to start spdl, each in a fresh interpreter:
+
+ * interpreter: starting python without importing anything (`python -c pass`), for reference
+ * import: importing the library (`python -c "import spdl"`)
+ * cli: printing the help of the command line interface (`python spdl.py --help`)
+ * cli_module: the same, run as a module (`python -m spdl --help`), which reuses the compiled bytecode of spdl.py
+   instead of compiling the script on every start
+
+Additionally, the time `python -X importtime` attributes to each module imported by `import spdl` is collected, so that
+an import that slows down the startup can be found. The results can be saved as JSON to compare them with a later run.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ('interpreter', 'import', 'cli', 'cli_module')
+
+
+def environment() -> Dict[str, str]:
+    """
+    The environment to run the interpreters in. Bytecode is written, so that only the first (discarded) run compiles spdl.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def timed(args: List[str]) -> float:
+    """
+    Run a python interpreter until it exits.
+    :param args: The arguments for the interpreter
+    :return: The wall time in seconds
+    """
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + args, cwd=ROOT, env=environment(), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def import_times() -> Dict[str, float]:
+    """
+    Import spdl with `-X importtime`.
+    :return: The cumulative import time of each module in seconds, including 'spdl' itself
+    """
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import spdl'], cwd=ROOT, env=environment(),
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def run_once() -> Dict[str, Any]:
+    """
+    Perform one measurement of each phase.
+    :return: The wall time of each phase in seconds and the import time of each module
+    """
+    modules = import_times()
+    return {
+        'phases': {
+            'interpreter': timed(['-c', 'pass']),
+            'import': timed(['-c', 'import spdl']),
+            'cli': timed([os.path.join(ROOT, 'spdl.py'), '--help']),
+            'cli_module': timed(['-m', 'spdl', '--help']),
+        },
+        'import_time': modules['spdl'],
+        'modules': modules,
+    }
+
+
+def aggregate(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine multiple runs into the median of each measurement.
+    :param runs: The runs, as returned by `run_once()`
+    :return: The medians
+    """
+    modules = set.intersection(*(set(r['modules']) for r in runs))
+    return {
+        'phases': {p: statistics.median(r['phases'][p] for r in runs) for p in PHASES},
+        'import_time': statistics.median(r['import_time'] for r in runs),
+        'modules': {m: statistics.median(r['modules'][m] for r in runs) for m in modules},
+    }
+
+
+def slowest(modules: Dict[str, float], count: int) -> List[Tuple[str, float]]:
+    """
+    Find the imports that take the longest, ignoring spdl itself.
+    :param modules: The import time of each module, as returned by `import_times()`
+    :param count: The number of modules to return
+    :return: The names of the modules and their cumulative import times, slowest first
+    """
+    return sorted(((m, t) for m, t in modules.items() if m != 'spdl'), key=lambda x: -x[1])[:count]
+
+
+def report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None, top: int = 10):
+    """
+    Print the medians of a benchmark, optionally next to the medians of an earlier one.
+    :param result: The benchmark result
+    :param baseline: An earlier benchmark result to compare with
+    :param top: The number of slowest imports to list
+    """
+    rows = [(f"{p} (ms)", result['median']['phases'][p], baseline and baseline['median']['phases'][p]) for p in PHASES]
+    rows.append(("importtime (ms)", result['median']['import_time'], baseline and baseline['median']['import_time']))
+    print(f"{'':<18}{'median':>12}" + (f"{'baseline':>12}{'change':>10}" if baseline else ""))
+    for name, value, old in rows:
+        line = f"{name:<18}{value * 1000:>12.1f}"
+        if baseline:
+            change = (value - old) / old * 100 if old else 0.
+            line += f"{old * 1000:>12.1f}{change:>+9.1f}%" + (" *" if change <= -5 else "")
+        print(line)
+
+    print("\nSlowest imports (cumulative ms):")
+    old_modules = baseline['median']['modules'] if baseline else {}
+    for name, value in slowest(result['median']['modules'], top):
+        line = f"  {name:<30}{value * 1000:>8.1f}"
+        if name in old_modules:
+            line += f"{old_modules[name] * 1000:>12.1f}"
+        elif baseline:
+            line += f"{'new':>12}"
+        print(line)
+    if baseline:
+        dropped = [m for m, _ in slowest(old_modules, top) if m not in result['median']['modules']]
+        if dropped:
+            print(f"  No longer imported: {', '.join(dropped)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(os.path.basename(__file__), description="Benchmark the startup time of spdl")
+    parser.add_argument('-r', '--repeat', default=10, type=int, help="The number of runs. Default: 10")
+    parser.add_argument('--top', default=10, type=int, help="The number of slowest imports to list. Default: 10")
+    parser.add_argument('--budget', default=None, type=float,
+                        help="Exit with status 1 if the median import time, as reported by -X importtime, exceeds this many milliseconds")
+    parser.add_argument('-o', '--output', default=None, help="Save the results as JSON to this file")
+    parser.add_argument('-c', '--compare', default=None, help="Compare the results with a JSON file saved earlier")
+    args = parser.parse_args()
+
+    run_once()  # warm up the bytecode and file system caches
+    runs = []
+    for i in range(args.repeat):
+        result = run_once()
+        runs.append(result)
+        print(f"Run {i + 1}/{args.repeat}: " + ", ".join(f"{p} {result['phases'][p] * 1000:.1f}ms" for p in PHASES)
+              + f", importtime {result['import_time'] * 1000:.1f}ms")
+
+    result = {
+        'config': {'repeat': args.repeat},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'runs': runs,
+        'median': aggregate(runs),
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['environment']['python'] != result['environment']['python']:
+            print("Warning: the baseline was measured with a different python version", file=sys.stderr)
+    print()
+    report(result, baseline, args.top)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1, sort_keys=True)
+    if args.budget is not None and result['median']['import_time'] * 1000 > args.budget:
+        print(f"\nThe import time of {result['median']['import_time'] * 1000:.1f}ms exceeds the budget of {args.budget:.1f}ms",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
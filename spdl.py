@@ -1,51 +1,126 @@
 #!/usr/bin/env python3
 
 import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import itertools
 import json
 import logging
+import math
 import os
+import queue
+import random
 import re
 import shutil
-import subprocess
+import signal
 import sys
-import tempfile
+import threading
 import time
 import urllib.parse
-import urllib.request
+import zlib
+from concurrent.futures import Executor, Future
 from concurrent.futures.thread import ThreadPoolExecutor
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, Iterable, Callable, AsyncIterator, NamedTuple
 
-try:
-    from lxml import etree
-except ImportError:
-    try:
-        import xml.etree.ElementTree as etree
-    except ImportError:
-        try:
-            import cElementTree as etree
-        except ImportError:
-            try:
-                import elementtree.ElementTree as etree
-            except ImportError:
-                raise ImportError("Couldn't import ElementTree from any known place - please install lxml for python 3")
+# Modules that only some features need (asyncio, http.client and ssl, sqlite3, subprocess, the XML parser, ...) are
+# imported where they are used, so that importing spdl stays fast for quick queries. Check the import time with
+# benchmarks/startup.py.
 
 log = logging.getLogger('spdl')
 
 
+class SpdlError(Exception):
+    """The base class of all errors raised by this module."""
+
+
+class NetworkError(SpdlError, IOError):
+    """Raised when a network request fails."""
+
+    def __init__(self, message: str, url: str):
+        super().__init__(message)
+        self.url: str = url
+        """The url of the failed request"""
+
+
+class HTTPError(NetworkError):
+    """Raised when a server responds with an error status."""
+
+    def __init__(self, message: str, url: str, status: int):
+        super().__init__(message, url)
+        self.status: int = status
+        """The HTTP status code of the response"""
+
+
+class DownloadCancelled(SpdlError):
+    """Raised when a running download is cancelled."""
+
+
 def set_tempdir(dir: Optional[str] = None) -> str:
     """
     Set the directory to put temporary files. The files are deleted automatically when the script exits.
     :param dir: The temporary directory root
+    :return: The temporary directory of this process, which is created in the root
     """
-    global tempdir
-    tempdir = os.path.join(dir or tempfile.gettempdir(), f'.spdl-{time.time()}')
-    if not os.path.isdir(tempdir):
-        os.mkdir(tempdir)
-    atexit.register(lambda: shutil.rmtree(tempdir))
+    global tempdir, tempdir_root
+    with _tempdir_lock:
+        tempdir_root = os.path.abspath(dir or _default_tempdir_root())
+        tempdir = make_tempdir(tempdir_root)
     return tempdir
 
 
-tempdir = set_tempdir()
+def get_tempdir() -> str:
+    """
+    Get the directory to put temporary files. It is created on first use, see `set_tempdir()`.
+    """
+    global tempdir
+    with _tempdir_lock:
+        if tempdir is None:
+            tempdir = make_tempdir(get_tempdir_root())
+        return tempdir
+
+
+def get_tempdir_root() -> str:
+    """
+    Get the directory the temporary directory of this process is (or will be) created in, without creating it.
+    """
+    return tempdir_root or _default_tempdir_root()
+
+
+def get_hostname() -> str:
+    """
+    Get the name of this machine, escaped for use in file names.
+    """
+    import socket
+    return escape_filename(socket.gethostname())
+
+
+def _default_tempdir_root() -> str:
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def make_tempdir(root: str) -> str:
+    """
+    Create a directory for the temporary files of this process. It is deleted automatically when the script exits, and
+    by `ScratchSpace.sweep()` if the process crashed. Its name holds the process id and the host name, since the root
+    may be shared with other machines.
+    :param root: The directory to create it in
+    """
+    path = os.path.join(root, f'.spdl-{os.getpid()}@{get_hostname()}-{time.time()}')
+    os.makedirs(path, exist_ok=True)
+    atexit.register(shutil.rmtree, path, ignore_errors=True)
+    return path
+
+
+tempdir: Optional[str] = None
+"""The temporary directory of this process, or None until it is needed; use `get_tempdir()` to get it"""
+
+tempdir_root: Optional[str] = None
+"""The directory to create the temporary directory in, see `set_tempdir()`. Defaults to the system's temporary directory."""
+
+_tempdir_lock = threading.Lock()
 
 
 DOMAIN_REF = {
@@ -64,6 +139,22 @@ DOMAIN_URL = {
     'se': "southparkstudios.nu"  ## se
 }
 
+CAPTION_LANGUAGES = {
+    'en': "eng",
+    'uk': "eng",
+    'es': "spa",
+    'de': "ger",
+    'se': "swe"
+}
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+CONTAINERS = {  # the output options and the subtitle codec of each supported container
+    'mp4': (['-f', 'mp4', '-movflags', '+faststart'], 'mov_text'),
+    'mkv': (['-f', 'matroska'], 'srt'),
+}
+
 ALL_SEASONS_URL = {  # TODO: only the german address is currently valid; correct the others
     'en': "https://southpark.cc.com/all-episodes",  ## en
     'uk': "https://southpark.cc.com/all-episodes",  ## en uk
@@ -73,12 +164,45 @@ ALL_SEASONS_URL = {  # TODO: only the german address is currently valid; correct
 }
 
 
+class Segment(object):
+    def __init__(self, url: str, duration: float, sequence: int):
+        self.url: str = url
+        """The url of the segment (a single MPEG-TS chunk of the stream)"""
+        self.duration: float = duration
+        """The duration of the segment in seconds, as announced by the playlist"""
+        self.sequence: int = sequence
+        """The media sequence number of the segment"""
+        self.rendition: Optional[str] = None
+        """The resolution of the stream the segment belongs to, if known"""
+        self.context: Dict[str, Any] = {}
+        """Fields added to the instrumentation events of the segment, like the episode and part it belongs to"""
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} sequence={self.sequence} duration={self.duration} url=\"{self.url}\">"
+
+    def __repr__(self):
+        return str(self)
+
+
 class Stream(object):
-    def __init__(self, resolution: str, url: str):
+    def __init__(self, resolution: str, url: str, bandwidth: Optional[int] = None):
         self.url: str = url
         """The url of the stream."""
         self.resolution: str = resolution
         """The resolution of the stream as a string in the format \"1920x1080\""""
+        self.bandwidth: Optional[int] = bandwidth
+        """The peak bit rate of the stream in bits per second, as announced by the variant playlist"""
+
+    def get_segments(self) -> List[Segment]:
+        """
+        Fetch the media playlist of this stream and return the segments it consists of, in playback order.
+        :raise ValueError: If the playlist is encrypted or not a valid media playlist; such streams can only be
+                           downloaded by ffmpeg.
+        """
+        segments = parse_media_playlist(http_get(self.url, kind='playlist'), self.url)
+        for segment in segments:
+            segment.rendition = self.resolution
+        return segments
 
     def __str__(self):
         return f"<{type(self).__name__} at {id(self)} resolution={self.resolution} url=\"{self.url}\">"
@@ -90,18 +214,160 @@ class Stream(object):
         return int(self.resolution.split("x")[0]) < int(other.resolution.split("x")[0])
 
 
+class TransferStats(object):
+    def __init__(self):
+        self.throughput: float = 0.
+        """The moving average of the throughput of single requests, in bytes per second"""
+        self.latency: float = 0.
+        """The moving average of the time until the response headers arrived, in seconds"""
+        self.requests: int = 0
+        """The number of measured requests"""
+        self.bytes: int = 0
+        """The total number of bytes received"""
+
+    def add(self, size: int, elapsed: float, latency: float, alpha: float):
+        rate = size / max(elapsed, 1e-6)
+        if self.requests == 0:
+            self.throughput, self.latency = rate, latency
+        else:
+            self.throughput += alpha * (rate - self.throughput)
+            self.latency += alpha * (latency - self.latency)
+        self.requests += 1
+        self.bytes += size
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} throughput={self.throughput:.0f}B/s latency={self.latency:.3f}s requests={self.requests}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class ThroughputMonitor:
+    """
+    Measures the throughput and latency of segment downloads per host and per rendition, as exponentially weighted
+    moving averages. The measurements are used to pick the fastest mirror of a stream and by `AdaptiveQuality`.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        """
+        :param alpha: The weight of a new measurement in the moving averages
+        """
+        self.alpha: float = alpha
+        """The weight of a new measurement in the moving averages"""
+        self.__hosts: Dict[str, TransferStats] = {}
+        self.__renditions: Dict[str, TransferStats] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, host: str, rendition: Optional[str], size: int, elapsed: float, latency: float):
+        """
+        Record a finished request.
+        :param host: The host the data was received from
+        :param rendition: The resolution of the stream the data belongs to, if known
+        :param size: The number of bytes received
+        :param elapsed: The duration of the request, in seconds
+        :param latency: The time until the response headers arrived, in seconds
+        """
+        with self.__lock:
+            self.__hosts.setdefault(host, TransferStats()).add(size, elapsed, latency, self.alpha)
+            if rendition is not None:
+                self.__renditions.setdefault(rendition, TransferStats()).add(size, elapsed, latency, self.alpha)
+
+    def host_stats(self, host: str) -> Optional[TransferStats]:
+        """
+        Get the measurements of a host.
+        :param host: The host name
+        :return: The measurements, or None if nothing was downloaded from the host yet
+        """
+        with self.__lock:
+            return self.__hosts.get(host)
+
+    def rendition_stats(self, rendition: str) -> Optional[TransferStats]:
+        """
+        Get the measurements of a rendition.
+        :param rendition: The resolution of the rendition, like '1920x1080'
+        :return: The measurements, or None if nothing was downloaded in this rendition yet
+        """
+        with self.__lock:
+            return self.__renditions.get(rendition)
+
+    def rate(self, host: str, min_requests: int = 1) -> float:
+        """
+        Get the measured throughput of a host.
+        :param host: The host name
+        :param min_requests: The number of requests needed for a meaningful measurement
+        :return: The throughput in bytes per second, or infinity if the host has not been measured enough yet
+        """
+        stats = self.host_stats(host)
+        return stats.throughput if stats is not None and stats.requests >= min_requests else math.inf
+
+
+class AdaptiveQuality:
+    """
+    Picks the rendition to download an episode in, based on the throughput measured by a `ThroughputMonitor`. If
+    the fastest host of the requested rendition is slower than the target rate, a lower rendition is picked - one
+    step for every halving of the throughput. The rendition is picked once per episode, as the parts of an episode
+    must have the same resolution to be merged.
+    """
+
+    def __init__(self, min_rate: float, monitor: Optional[ThroughputMonitor] = None, min_requests: int = 5):
+        """
+        :param min_rate: The target throughput of a single request, in bytes per second
+        :param monitor: The monitor to read the measurements from; defaults to `throughput_monitor`
+        :param min_requests: The number of requests to a host needed before it is considered too slow
+        """
+        self.min_rate: float = min_rate
+        """The target throughput of a single request, in bytes per second"""
+        self.monitor: Optional[ThroughputMonitor] = monitor
+        self.min_requests: int = min_requests
+
+    def choose(self, episode: 'Episode', quality: str) -> Tuple[str, bool]:
+        """
+        Pick the rendition to download an episode in.
+        :param episode: The episode; its videos and streams are fetched if they are not resolved yet
+        :param quality: The requested quality, see `Episode.download()`
+        :return: The quality to download the episode in (a resolution like '960x540' when it was lowered) and whether it was lowered
+        """
+        videos = episode.get_videos()
+        if not videos:
+            return quality, False
+        monitor = self.monitor or throughput_monitor
+        streams = videos[0].get_streams()
+        preferred = videos[0].get_stream(quality)
+        rate = max(monitor.rate(urllib.parse.urlsplit(s.url).hostname, self.min_requests)
+                   for s in streams if s.resolution == preferred.resolution)
+        if rate >= self.min_rate:
+            return quality, False
+
+        resolutions = []
+        for s in streams:
+            if s.resolution not in resolutions:
+                resolutions.append(s.resolution)
+        steps = 1 + int(math.log2(self.min_rate / max(rate, 1.)))
+        index = min(resolutions.index(preferred.resolution) + steps, len(resolutions) - 1)
+        if resolutions[index] == preferred.resolution:
+            return quality, False
+        log.info("Measured %.0f B/s for %s, lowering the quality from %s to %s", rate, episode,
+                 preferred.resolution, resolutions[index])
+        return resolutions[index], True
+
+
 class Video:
     RTMP_STREAMS = [
         "rtmpe://viacommtvstrmfs.fplive.net:1935/viacommtvstrm",
         "rtmpe://cp75298.edgefcs.net/ondemand"
     ]
 
-    def __init__(self, streams: List[str], duration: List[int], captions: str):
+    def __init__(self, streams: List[str], duration: List[int], captions: str, source: Optional[str] = None):
         self.__streams = streams
         self.duration: List[int] = duration
         """The duration of the video"""
         self.captions: str = captions
         """Sub-titles for the video"""
+        self.source: Optional[str] = source
+        """The url of the mediagen document the video was read from"""
+        self.resolved: float = time.time()
+        """When the video was read from the mediagen document, as unix timestamp"""
+        self.__resolved_streams: Optional[List[Stream]] = None
 
     def __rtmp_streams(self, index: int = 0) -> str:
         return self.RTMP_STREAMS[index]
@@ -110,39 +376,70 @@ class Video:
         """
         Get a list of streams in different qualities for this Video. The list is sorted by the
         stream quality in descending order, so that you can easily retrieve the highest quality stream
-        using the first element.
+        using the first element. The streams are fetched only once per Video.
         """
-        p = http_get(self.get_play_data()[1])
+        if self.__resolved_streams is None:
+            self.__resolved_streams = self.__fetch_streams()
+        return list(self.__resolved_streams)
+
+    def __fetch_streams(self) -> List[Stream]:
+        url = self.get_play_data()[1]
+        p = http_get(url, kind='playlist')
         streams = []
         curr_res = None
+        curr_bandwidth = None
         for line in p.splitlines():
             if line.startswith(b"#EXT-X-STREAM-INF:"):
                 curr_res = re.search(rb'RESOLUTION=(\d+x\d+)', line).group(1)
+                bandwidth = re.search(rb'[:,]BANDWIDTH=(\d+)', line)
+                curr_bandwidth = int(bandwidth.group(1)) if bandwidth else None
             elif not line.startswith(b"#") and line.strip():
-                streams.append(Stream(curr_res.decode("utf-8"), line.decode("utf-8")))
+                streams.append(Stream(curr_res.decode("utf-8"), urllib.parse.urljoin(url, line.strip().decode("utf-8")),
+                                      curr_bandwidth))
         return sorted(streams, reverse=True)
 
     def get_stream(self, quality: str = 'max') -> Stream:
         """
-        Returns a single stream for this video.
+        Returns a single stream for this video. If several streams with the selected resolution are available (e.g.
+        on different CDN hosts), the one on the host with the best throughput measured by `throughput_monitor` is
+        returned; hosts without measurements are tried first.
         :param quality: The desired quality. Either 'max', 'medium', 'min', or a resolution like '1920x1080' (the closes matching resolution is taken in this case)
         :return: The Stream object
         """
         streams = self.get_streams()
         if quality == 'max':
-            return streams[0]
+            stream = streams[0]
         elif quality == 'min':
-            return streams[-1]
+            stream = streams[-1]
         elif quality == 'medium':
-            return streams[len(streams) // 2]
+            stream = streams[len(streams) // 2]
         elif re.match(r"\d+x\d+$", quality):
             q = int(quality.split("x")[0]) * int(quality.split("x")[0])
             streams = sorted(streams,
                              key=lambda s: abs(q - int(s.resolution.split("x")[0]) * int(s.resolution.split("x")[0])))
-            return streams[0]
+            stream = streams[0]
         else:
             raise ValueError(
                 f"Invalid quality string: \"{quality}\". Use one of 'max', 'medium', 'min' or a resolution like '1920x1080'")
+        mirrors = [s for s in streams if s.resolution == stream.resolution]
+        if len(mirrors) > 1:
+            stream = max(mirrors, key=lambda s: throughput_monitor.rate(urllib.parse.urlsplit(s.url).hostname))
+        return stream
+
+    def get_urls(self) -> List[str]:
+        """
+        Get the urls this video was resolved from: the mediagen document, the variant playlist and the urls of the
+        streams that were fetched so far.
+        """
+        urls = [self.source] if self.source else []
+        if self.__streams:
+            urls.append(self.get_play_data()[1])
+        return urls + [s.url for s in self.__resolved_streams or []]
+
+    @property
+    def expires(self) -> Optional[float]:
+        """The time the first of the video's urls expires as unix timestamp, or None if the urls carry no expiry, see `url_expiry()`"""
+        return min(filter(None, map(url_expiry, self.get_urls())), default=None)
 
     def get_play_data(self) -> Tuple[str, str]:
         ## High quality is the last stream  (-1)
@@ -159,7 +456,273 @@ class Video:
         return playpath, rtmp
 
 
+class DownloadJournal:
+    """
+    A durable record of the progress of an episode download. The parts of the episode are downloaded into the
+    journal's directory and every finished segment is recorded with its size and checksum, so that an interrupted
+    download can be continued later - even by another process - without fetching finished segments again.
+    """
+
+    def __init__(self, directory: str):
+        """
+        :param directory: The directory to keep the journal and the part files in. It is created if it does not exist.
+        """
+        self.directory: str = directory
+        """The directory of the journal and the part files"""
+        self.__path = os.path.join(directory, 'journal.jsonl')
+        self.__lock = threading.Lock()
+        self.__parts: Dict[int, Dict[str, Any]] = {}
+        os.makedirs(directory, exist_ok=True)
+        self.__load()
+        self.__file = open(self.__path, 'a', encoding='utf-8')
+
+    def part_file(self, part: int) -> str:
+        """
+        Get the file a part is downloaded to.
+        :param part: The index of the part
+        """
+        return os.path.join(self.directory, f'part-{part}.ts')
+
+    def is_part_done(self, part: int, signature: str) -> bool:
+        """
+        Check whether a part has been downloaded completely.
+        :param part: The index of the part
+        :param signature: Identifies the stream of the part, see `start_part()`
+        """
+        with self.__lock:
+            state = self.__parts.get(part)
+            return state is not None and state['signature'] == signature and state['done'] \
+                and os.path.isfile(self.part_file(part))
+
+    def start_part(self, part: int, signature: str) -> int:
+        """
+        Prepare the download of a part. If the journal contains progress for the same stream, the part file is
+        checked against the recorded sizes and checksums and truncated after the last intact segment; otherwise
+        the part is started from scratch.
+        :param part: The index of the part
+        :param signature: Identifies the stream of the part (e.g. its resolution and number of segments); progress recorded for a different signature is discarded
+        :return: The number of segments that are already downloaded
+        """
+        fn = self.part_file(part)
+        with self.__lock:
+            state = self.__parts.get(part)
+            if state is None or state['signature'] != signature or not os.path.isfile(fn):
+                state = self.__parts[part] = {'signature': signature, 'segments': [], 'done': False}
+                self.__write({'type': 'part', 'part': part, 'signature': signature})
+                open(fn, 'wb').close()
+                return 0
+
+            intact = 0
+            with open(fn, 'rb') as f:
+                for size, checksum in state['segments']:
+                    data = f.read(size)
+                    if len(data) != size or zlib.crc32(data) != checksum:
+                        break
+                    intact += 1
+            if intact < len(state['segments']):
+                log.info("Part %s of %s is damaged after segment %s", part, self.directory, intact)
+                del state['segments'][intact:]
+                state['done'] = False
+                self.__write({'type': 'truncate', 'part': part, 'segments': intact})
+            with open(fn, 'r+b') as f:
+                f.truncate(sum(size for size, _ in state['segments']))
+            return intact
+
+    def add_segment(self, part: int, data: bytes):
+        """
+        Record that the next segment of a part has been written to the part file.
+        :param part: The index of the part
+        :param data: The data of the segment
+        """
+        checksum = zlib.crc32(data)
+        with self.__lock:
+            self.__parts[part]['segments'].append((len(data), checksum))
+            self.__write({'type': 'segment', 'part': part, 'size': len(data), 'crc32': checksum})
+
+    def segment_count(self, part: int) -> int:
+        """
+        Get the number of segments of a part that were written to the part file.
+        :param part: The index of the part
+        """
+        with self.__lock:
+            state = self.__parts.get(part)
+            return len(state['segments']) if state is not None else 0
+
+    def written_segments(self, part: int) -> int:
+        """
+        Count the recorded segments of a part that the part file actually holds, judging by its size on disk. Unlike
+        `segment_count()`, this notices a part file that lost data after the segments were recorded.
+        :param part: The index of the part
+        """
+        with self.__lock:
+            state = self.__parts.get(part)
+            sizes = [size for size, _ in state['segments']] if state is not None else []
+        try:
+            left = os.path.getsize(self.part_file(part))
+        except OSError:
+            return 0
+        count = 0
+        for size in sizes:
+            if size > left:
+                break
+            left -= size
+            count += 1
+        return count
+
+    def verify_part(self, part: int) -> List[int]:
+        """
+        Check the segments in a part file against the recorded sizes and checksums and check that each one is a valid
+        MPEG transport stream, see `check_ts()`.
+        :param part: The index of the part
+        :return: The indices of the damaged segments
+        """
+        with self.__lock:
+            segments = list(self.__parts[part]['segments'])
+        damaged = []
+        with open(self.part_file(part), 'rb') as f:
+            for i, (size, checksum) in enumerate(segments):
+                data = f.read(size)
+                if len(data) != size or zlib.crc32(data) != checksum or check_ts(data) is not None:
+                    damaged.append(i)
+        return damaged
+
+    def replace_segments(self, part: int, segments: Dict[int, bytes]):
+        """
+        Replace segments of a part file, e.g. with ones that were fetched again because they were damaged. The part
+        file is rewritten, the other segments are kept.
+        :param part: The index of the part
+        :param segments: The new data of the segments, by index
+        """
+        if not segments:
+            return
+        fn = self.part_file(part)
+        with self.__lock:
+            state = self.__parts[part]
+            with open(fn, 'rb') as src, open(f'{fn}.tmp', 'wb') as dst:
+                for i, (size, _) in enumerate(state['segments']):
+                    data = src.read(size)
+                    dst.write(segments.get(i, data))
+            os.replace(f'{fn}.tmp', fn)
+            for i, data in sorted(segments.items()):
+                state['segments'][i] = (len(data), zlib.crc32(data))
+                self.__write({'type': 'replace', 'part': part, 'segment': i, 'size': len(data), 'crc32': zlib.crc32(data)})
+
+    def finish_part(self, part: int):
+        """
+        Record that a part has been downloaded completely.
+        :param part: The index of the part
+        """
+        with self.__lock:
+            self.__parts[part]['done'] = True
+            self.__write({'type': 'done', 'part': part})
+
+    def close(self):
+        """
+        Close the journal file. The recorded progress is kept.
+        """
+        with self.__lock:
+            self.__file.close()
+
+    def remove(self):
+        """
+        Close the journal and delete it alongside all part files.
+        """
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __write(self, record: Dict[str, Any]):
+        self.__file.write(json.dumps(record) + '\n')
+        self.__file.flush()
+
+    def __load(self):
+        if not os.path.isfile(self.__path):
+            return
+        with open(self.__path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # A torn write at the end of the journal
+                part = record.get('part')
+                if record['type'] == 'part':
+                    self.__parts[part] = {'signature': record['signature'], 'segments': [], 'done': False}
+                elif part not in self.__parts:
+                    continue
+                elif record['type'] == 'segment':
+                    self.__parts[part]['segments'].append((record['size'], record['crc32']))
+                elif record['type'] == 'replace':
+                    self.__parts[part]['segments'][record['segment']] = (record['size'], record['crc32'])
+                elif record['type'] == 'truncate':
+                    del self.__parts[part]['segments'][record['segments']:]
+                    self.__parts[part]['done'] = False
+                elif record['type'] == 'done':
+                    self.__parts[part]['done'] = True
+
+
+class VerificationReport:
+    """
+    The result of verifying the downloaded parts of an episode: the number and duration of the segments of each part
+    compared to its playlist and to the duration announced by the mediagen feed, and the damaged segments that were
+    fetched again.
+    """
+
+    def __init__(self):
+        self.parts: List[Dict[str, Any]] = []
+        """One record per part with the keys 'part', 'segments', 'expected_segments', 'duration', 'expected_duration', 'repaired' and 'problems'"""
+
+    def add_part(self, part: int, segments: Optional[int] = None, expected_segments: Optional[int] = None,
+                 duration: Optional[float] = None, expected_duration: Optional[float] = None, repaired: int = 0,
+                 problems: Optional[List[str]] = None):
+        """
+        Add the result of verifying a part.
+        :param part: The index of the part
+        :param segments: The number of segments that were downloaded, or None if unknown
+        :param expected_segments: The number of segments in the playlist, or None if unknown
+        :param duration: The duration of the downloaded segments in seconds, or None if unknown
+        :param expected_duration: The duration announced by the mediagen feed, or None if unknown
+        :param repaired: The number of damaged segments that were fetched again successfully
+        :param problems: Descriptions of the problems that could not be repaired
+        """
+        self.parts.append({
+            'part': part,
+            'segments': segments,
+            'expected_segments': expected_segments,
+            'duration': duration,
+            'expected_duration': expected_duration,
+            'repaired': repaired,
+            'problems': problems or [],
+        })
+        self.parts.sort(key=lambda p: p['part'])
+
+    @property
+    def problems(self) -> List[str]:
+        """The problems of all parts that could not be repaired"""
+        return [f"part {p['part']}: {problem}" for p in self.parts for problem in p['problems']]
+
+    @property
+    def repaired(self) -> int:
+        """The number of damaged segments that were fetched again"""
+        return sum(p['repaired'] for p in self.parts)
+
+    @property
+    def ok(self) -> bool:
+        """Whether no problems were found or all of them were repaired"""
+        return not self.problems
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} parts={len(self.parts)} repaired={self.repaired} problems={len(self.problems)}>"
+
+    def __repr__(self):
+        return str(self)
+
+
 class Episode:
+    DURATION_TOLERANCE = 2.
+    """The maximum difference in seconds between the duration of a part's playlist and the duration announced by the mediagen feed"""
+
+    EXPIRED_STATUSES = (401, 403, 410)
+    """The HTTP status codes with which the CDN rejects stream urls whose signature expired"""
+
     def __init__(self, id: str, title: str, description: str, short_description: str, thumbnail: str, date: float,
                  episode_number: str, season: Optional[str] = None,
                  episode_number_in_season: Optional[str] = None, _lang: str = 'en'):
@@ -183,46 +746,429 @@ class Episode:
         """The episode number relative to it's season, e.g. "06\""""
         self.lang: str = _lang
         """The language of the episode, inherited from the SouthPark constructor"""
+        self.verification: Optional[VerificationReport] = None
+        """The result of verifying the last download of the episode, see `download_parts()` and `stream()`"""
+        self.__videos: Optional[List[Video]] = None
+        self.__metadata_args: Optional[List[str]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get the metadata of the episode as a JSON-serializable dict, e.g. to hand it to another process.
+        :return: The metadata, see `from_dict()`
+        """
+        return {
+            'id': self.id,
+            'title': self.title,
+            'description': self.description,
+            'short_description': self.short_description,
+            'thumbnail': self.thumbnail,
+            'date': self.date,
+            'episode_number': self.episode_number,
+            'season': self.season,
+            'episode_number_in_season': self.episode_number_in_season,
+            'lang': self.lang,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'Episode':
+        """
+        Create an episode from the metadata returned by `to_dict()`. Its videos are resolved again when needed.
+        :param data: The metadata
+        """
+        data = dict(data)
+        return Episode(_lang=data.pop('lang'), **data)
 
     def get_videos(self) -> List[Video]:
         """
-        Each south park episode consists of about 3-4 separate videos. This method returns a list of them.
+        Each south park episode consists of about 3-4 separate videos. This method returns a list of them. The
+        videos are fetched only once per Episode.
+        """
+        if self.__videos is None:
+            self.__videos = [self.__get_video(m) for m in self.__get_mediagen()]
+        return list(self.__videos)
+
+    def resolve_videos(self, streams: bool = True) -> List[Video]:
+        """
+        Fetch the videos of this episode, and the streams of each video, one after another. See `resolve()` to fetch them concurrently.
+        :param streams: Whether to fetch the streams of each video, too
+        :return: The videos
+        """
+        videos = self.get_videos()
+        for video in videos if streams else []:
+            video.get_streams()
+        return videos
+
+    def refresh(self, streams: bool = True) -> List[Video]:
+        """
+        Resolve the videos of this episode again, e.g. because their stream urls expired. The cached mediagen documents
+        and playlists of the episode are dropped first, so that new urls are fetched through the whole mediagen chain.
+        :param streams: Whether to fetch the streams of each video, too
+        :return: The new videos
+        """
+        videos, self.__videos = self.__videos, None
+        if metadata_cache is not None:
+            for url in [url for v in videos or [] for url in v.get_urls()]:
+                metadata_cache.invalidate(url, self.lang)
+                metadata_cache.invalidate(url)
+        return self.resolve_videos(streams)
+
+    @property
+    def resolved(self) -> Optional[float]:
+        """When the videos of the episode were resolved, as unix timestamp, or None if they are not resolved yet"""
+        return min((v.resolved for v in self.__videos), default=None) if self.__videos is not None else None
+
+    @property
+    def expires(self) -> Optional[float]:
+        """The time the first of the resolved stream urls expires, as unix timestamp, or None if it is not known, see `Video.expires`"""
+        return min(filter(None, (v.expires for v in self.__videos or [])), default=None)
+
+    def is_expired(self, error: BaseException) -> bool:
+        """
+        Check whether a download failed because the stream urls of this episode expired, so that it succeeds after `refresh()`.
+        :param error: The error the download failed with
+        """
+        if isinstance(error, HTTPError):
+            return error.status in self.EXPIRED_STATUSES
+        expires = self.expires
+        return isinstance(error, SpdlError) and not isinstance(error, DownloadCancelled) \
+            and expires is not None and expires <= time.time()
+
+    def resolve(self, executor: Executor, streams: bool = True) -> Future:
+        """
+        Fetch the videos of this episode - and the streams of each video - concurrently on an executor. Afterwards,
+        `get_videos()` and `Video.get_streams()` return without network requests.
+        :param executor: The executor to perform the requests on. No worker blocks waiting for another one, so the executor may be shared by many episodes.
+        :param streams: Whether to fetch the streams of each video, too
+        :return: A future that completes with the list of videos
         """
-        return [self.__get_video(m) for m in self.__get_mediagen()]
+        result = Future()
+
+        def store_videos(videos: Future):
+            try:
+                self.__videos = videos.result()
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                result.set_result(list(self.__videos))
 
-    def download(self, filename: Optional[str] = None, quality: str = 'max', ffmpeg_executable: Optional[str] = None, max_threads: int = 4):
+        def resolve_videos(mediagen: Future):
+            try:
+                futures = [executor.submit(self.__resolve_video, m, streams) for m in mediagen.result()]
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                gather_futures(futures).add_done_callback(store_videos)
+
+        if self.__videos is None:
+            executor.submit(self.__get_mediagen).add_done_callback(resolve_videos)
+        else:
+            gather_futures([executor.submit(self.__resolve_streams, v, streams) for v in self.__videos]) \
+                .add_done_callback(store_videos)
+        return result
+
+    def download(self, filename: Optional[str] = None, quality: str = 'max', ffmpeg_executable: Optional[str] = None,
+                 max_threads: int = 8, max_threads_per_part: int = 4, resume: bool = True, streaming: bool = False,
+                 container: Optional[str] = None, captions: bool = False):
         """
-        Downloads the episode to a file using a single thread. ffmpeg is required for this to work.
+        Downloads the episode to a file. The video parts are fetched segment by segment in parallel, ffmpeg is only
+        used to merge them into the final file (and to download encrypted streams, which are rare), so it is
+        required for this to work.
         :param filename: The file to save the download to. If it points to an existing directory, a new file is created in that directory following a simple name scheme and with .mp4 extension.
         :param quality: The desired quality. Either 'max', 'medium', 'min', or a resolution like '1920x1080' (the closes matching resolution is taken in this case)
         :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
-        :param max_threads: The maximum number of downloads to perform concurrently.
+        :param max_threads: The maximum number of segments to download concurrently for the whole episode.
+        :param max_threads_per_part: The maximum number of segments to download concurrently for a single video part.
+        :param resume: Whether to continue an earlier, interrupted download of the episode and to keep the progress if this one is interrupted, see `DownloadJournal`
+        :param streaming: Whether to pipe the segments directly into ffmpeg instead of writing the parts to temporary files first, see `stream()`. Streamed downloads can not be resumed.
+        :param container: The container of the file, one of the keys of `CONTAINERS` ('mp4' is written with faststart). Defaults to the extension of the file name.
+        :param captions: Whether to embed the captions of the episode as a subtitle track; only supported by the containers in `CONTAINERS`
         """
+        filename = self.get_filename(filename)
 
-        if filename is None:
+        log.info("Downloading Episode \"%s\" (S%sE%s) to %s...", self.title, self.season, self.episode_number_in_season,
+                 filename)
 
-            filename = f'S{self.season}E{self.episode_number_in_season} - {escape_filename(self.title)}.mp4'
-        elif os.path.isdir(filename):
-            filename = os.path.join(filename, f'S{self.season}E{self.episode_number_in_season} - {escape_filename(self.title)}.mp4')
+        with ThreadPoolExecutor(max_workers=max_threads) as segment_pool:
+            if streaming:
+                try:
+                    self.stream(filename, quality, segment_pool, max_threads, ffmpeg_executable, container=container,
+                                captions=captions)
+                except ValueError as e:
+                    log.info("Can not stream the episode, downloading its parts instead: %s", e)
+                    streaming = False
+            if not streaming:
+                fns = self.download_parts(quality, segment_pool, max_threads_per_part, ffmpeg_executable, resume=resume)
+                captions_file = self.download_captions(os.path.join(os.path.dirname(fns[0]), 'captions.vtt')) \
+                    if captions and fns else None
+                self.merge_parts(fns, filename, ffmpeg_executable, container=container, captions=captions_file)
 
-        if ffmpeg_executable is None:
-            ffmpeg_executable = 'ffmpeg.exe' if os.name == 'nt' else 'ffmpeg'
+        log.info("Download of Episode \"%s\" (S%sE%s) done.", self.title, self.season, self.episode_number_in_season)
 
-        log.info("Downloading Episode \"%s\" (S%sE%s) to %s...", self.title, self.season, self.episode_number_in_season,
-                 filename)
+    def get_filename(self, filename: Optional[str] = None) -> str:
+        """
+        Get the file name a download of this episode is saved to.
+        :param filename: The requested file name. If it is None or points to an existing directory, a file name following a simple name scheme with .mp4 extension is returned.
+        """
+        if filename is None:
+            return f'S{self.season}E{self.episode_number_in_season} - {escape_filename(self.title)}.mp4'
+        elif os.path.isdir(filename):
+            return os.path.join(filename, f'S{self.season}E{self.episode_number_in_season} - {escape_filename(self.title)}.mp4')
+        return filename
 
-        videos = self.get_videos()
+    def download_parts(self, quality: str, executor: Executor, max_threads_per_part: int = 4,
+                       ffmpeg_executable: Optional[str] = None, cancelled: Optional[threading.Event] = None,
+                       resume: bool = True, directory: Optional[str] = None) -> List[str]:
+        """
+        Downloads the video parts of the episode to separate files, without merging them. This is the network-bound
+        half of `download()`; use `merge_parts()` to create the final file. Afterwards, the parts are verified and
+        damaged segments are fetched again; the result is stored in `verification`.
+        :param quality: The desired quality, see `download()`
+        :param executor: The executor to download the segments on. Share one executor between multiple episodes to bound the total number of concurrent requests.
+        :param max_threads_per_part: The maximum number of segments to download concurrently for a single video part.
+        :param ffmpeg_executable: The path to the ffmpeg executable, only used for streams that can not be downloaded natively
+        :param cancelled: An event that aborts the download with a `DownloadCancelled` exception when set
+        :param resume: Whether to download into a `DownloadJournal`, which continues earlier progress and keeps this one if the download is interrupted. Otherwise, the parts are downloaded to the temporary directory.
+        :param directory: The directory to download the parts to, e.g. from `ScratchSpace.admit()`. Defaults to a directory for the episode in the resume directory or the temporary directory.
+        :return: The downloaded part files, in playback order
+        """
+        ffmpeg_executable = get_ffmpeg_executable(ffmpeg_executable)
+
+        if directory is not None:
+            journal = DownloadJournal(directory)
+        elif resume:
+            journal = DownloadJournal(os.path.join(get_resume_dir(), escape_filename(f"{self.lang}-{self.id}-{quality}")))
+        else:
+            journal = DownloadJournal(os.path.join(get_tempdir(), escape_filename(f"{self.lang}-{self.id}-{quality}-{time.time()}")))
+        try:
+            try:
+                videos = self.get_videos()
+                report = self.__download_videos(videos, quality, journal, executor, max_threads_per_part,
+                                                ffmpeg_executable, cancelled)
+            except SpdlError as e:
+                if not self.is_expired(e):
+                    raise
+                # The parts that were finished before are kept in the journal; signed urls of the same
+                # stream lead to the same segments
+                log.info("The stream urls of %s expired, resolving them again: %s", self, e)
+                videos = self.refresh()
+                report = self.__download_videos(videos, quality, journal, executor, max_threads_per_part,
+                                                ffmpeg_executable, cancelled)
+        except BaseException:
+            if resume:
+                journal.close()
+            else:
+                journal.remove()
+            raise
+        journal.close()
+        self.verification = report
+        if report.repaired:
+            log.info("Repaired %s damaged segment(s) of %s", report.repaired, self)
+        if not report.ok:
+            log.warning("Verification of %s failed: %s", self, "; ".join(report.problems))
+        return [journal.part_file(i) for i in range(len(videos))]
 
-        fns = []
-        with ThreadPoolExecutor(max_workers=max_threads) as e:
+    def __download_videos(self, videos: List[Video], quality: str, journal: DownloadJournal, executor: Executor,
+                          max_threads_per_part: int, ffmpeg_executable: str,
+                          cancelled: Optional[threading.Event]) -> VerificationReport:
+        with instrumentation.phase('transfer', episode=self.id), \
+                ThreadPoolExecutor(max_workers=max(len(videos), 1)) as part_pool:
+            futures = []
             for i, vid in enumerate(videos):
-                stream = vid.get_stream(quality=quality)
-                fn = os.path.join(tempdir, f"{self.id}--{i}.ts")
-                fns.append(fn)
                 log.info("Initiated download of stream #%s of %s...", i, len(videos))
-                e.submit(lambda: subprocess.Popen([ffmpeg_executable, '-loglevel', 'warning', '-y', '-i', stream.url, '-codec', 'copy', fn], stdin=subprocess.PIPE).wait())
+                futures.append(part_pool.submit(self.__download_part, vid, quality, journal, i,
+                                                executor, max_threads_per_part, ffmpeg_executable, cancelled))
+            report = VerificationReport()
+            for future in futures:
+                report.add_part(**future.result())
+        return report
 
+    def merge_parts(self, part_files: List[str], filename: str, ffmpeg_executable: Optional[str] = None,
+                    cancelled: Optional[threading.Event] = None, container: Optional[str] = None,
+                    captions: Optional[str] = None):
+        """
+        Merges previously downloaded video parts into the final file using ffmpeg and tags it with the episode's
+        metadata. The part files (and their `DownloadJournal`) are deleted afterwards if the merge succeeded.
+        :param part_files: The part files, e.g. as returned by `download_parts()`
+        :param filename: The file to save the merged episode to
+        :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+        :param cancelled: An event that stops ffmpeg and raises a `DownloadCancelled` exception when set
+        :param container: The container of the file, see `download()`
+        :param captions: A WebVTT file to embed as subtitle track, e.g. from `download_captions()`
+        :raise SpdlError: If ffmpeg failed
+        """
         log.info("Merging downloaded streams...")
+        Episode.merge_batch([(self, part_files, filename, captions)], ffmpeg_executable, container, cancelled)
+
+    @staticmethod
+    def merge_batch(merges: List[Tuple['Episode', List[str], str, Optional[str]]], ffmpeg_executable: Optional[str] = None,
+                    container: Optional[str] = None, cancelled: Optional[threading.Event] = None):
+        """
+        Merge the downloaded parts of multiple episodes with a single ffmpeg process that writes one file per episode,
+        which saves starting and probing a process per episode. The part files are deleted if the merge succeeded.
+        :param merges: The episode, its part files, the file to save it to and the captions to embed (or None) of each merge
+        :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+        :param container: The container of the files, see `download()`
+        :param cancelled: An event that stops ffmpeg and raises a `DownloadCancelled` exception when set
+        :raise SpdlError: If ffmpeg failed; the files of all episodes are removed in this case
+        """
+        inputs, outputs = [], []
+        index = 0
+        for episode, part_files, filename, captions in merges:
+            inputs += ['-f', 'mpegts', '-i', f'concat:{"|".join(part_files)}']
+            captions_index = None
+            if captions is not None and episode.__subtitle_codec(filename, container) is not None:
+                inputs += ['-i', captions]
+                captions_index = index + 1
+            outputs += episode.__output_args(filename, container, index, captions_index)
+            index += 1 if captions_index is None else 2
+
+        def emit_progress(progress: Dict[str, str]):
+            for episode, _, _, _ in merges:
+                episode.__emit_ffmpeg_progress(progress)
+
+        started = time.monotonic()
+        failed = True
+        try:
+            status = run_process([get_ffmpeg_executable(ffmpeg_executable), '-loglevel', 'warning', '-nostats', '-progress', 'pipe:1', '-y'] + inputs + outputs,
+                                 cancelled, on_progress=emit_progress)
+            if status != 0:
+                raise SpdlError(f"ffmpeg exited with status {status} while writing {', '.join(m[2] for m in merges)}")
+            for _, _, filename, _ in merges:
+                if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+                    raise SpdlError(f"ffmpeg did not write {filename}")
+            failed = False
+        except BaseException:
+            remove_files([m[2] for m in merges])
+            raise
+        finally:
+            for episode, _, _, _ in merges:
+                instrumentation.emit('phase', phase='merge', duration=(time.monotonic() - started) / len(merges),
+                                     failed=failed, episode=episode.id, batch=len(merges))
+
+        log.info("Cleaning up...")
+        for _, part_files, _, _ in merges:
+            remove_files(part_files)
+            for d in set(os.path.dirname(f) for f in part_files):
+                if os.path.isfile(os.path.join(d, 'journal.jsonl')):
+                    shutil.rmtree(d, ignore_errors=True)
+
+    def download_captions(self, filename: str) -> Optional[str]:
+        """
+        Download the WebVTT captions of all videos of the episode into a single file. The cues of each video are
+        shifted by the duration of the videos before it.
+        :param filename: The file to save the captions to
+        :return: The file name, or None if the episode has no captions or they could not be downloaded
+        """
+        cues = []
+        offset = 0.
+        try:
+            for video in self.get_videos():
+                if video.captions:
+                    vtt = http_get(video.captions).decode('utf-8-sig', 'replace').replace('\r\n', '\n')
+                    # Drop the header of the file and shift the timestamps of the cues
+                    body = vtt.split('\n\n', 1)[1] if '\n\n' in vtt else ''
+                    cues.append(re.sub(r'(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})',
+                                       lambda m: format_vtt_timestamp(parse_vtt_timestamp(m.group(0)) + offset), body).strip())
+                offset += video.duration[0] if video.duration else 0
+        except (NetworkError, IndexError) as e:
+            log.warning("Could not download the captions of %s: %s", self, e)
+            return None
+        cues = [c for c in cues if c]
+        if not cues:
+            return None
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write("WEBVTT\n\n" + "\n\n".join(cues) + "\n")
+        return filename
+
+    def stream(self, filename: str, quality: str, executor: Executor, max_buffered: int = 16,
+               ffmpeg_executable: Optional[str] = None, cancelled: Optional[threading.Event] = None,
+               container: Optional[str] = None, captions: bool = False):
+        """
+        Downloads the episode and pipes its segments, in order, directly into a single ffmpeg process that writes the
+        final file. Unlike `download_parts()` and `merge_parts()`, no temporary files are written, so the episode only
+        hits the disk once - but an interrupted download can not be resumed.
+        :param filename: The file to save the episode to
+        :param quality: The desired quality, see `download()`
+        :param executor: The executor to download the segments on
+        :param max_buffered: The maximum number of segments that are downloaded concurrently or held in memory until the preceding segments are written
+        :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+        :param cancelled: An event that aborts the download with a `DownloadCancelled` exception when set
+        :param container: The container of the file, see `download()`
+        :param captions: Whether to embed the captions of the episode as a subtitle track
+        :raise ValueError: If one of the streams can not be downloaded natively (e.g. because it is encrypted)
+        """
+        try:
+            self.__stream(filename, quality, executor, max_buffered, ffmpeg_executable, cancelled, container, captions)
+        except SpdlError as e:
+            if not self.is_expired(e):
+                raise
+            # Nothing of the stream is kept, so it is simply started over
+            log.info("The stream urls of %s expired, resolving them again: %s", self, e)
+            self.refresh()
+            self.__stream(filename, quality, executor, max_buffered, ffmpeg_executable, cancelled, container, captions)
+
+    def __stream(self, filename: str, quality: str, executor: Executor, max_buffered: int,
+                 ffmpeg_executable: Optional[str], cancelled: Optional[threading.Event], container: Optional[str],
+                 captions: bool):
+        videos = self.get_videos()
+        with ThreadPoolExecutor(max_workers=max(len(videos), 1)) as part_pool:
+            parts = list(part_pool.map(lambda v: v.get_stream(quality=quality).get_segments(), videos))
+        report = VerificationReport()
+        repaired = [0] * len(parts)
+        written = [0] * len(parts)
+        problems = [[] for _ in parts]
+        for i, part in enumerate(parts):
+            instrumentation.emit('part', episode=self.id, part=i, state='started', segments=len(part), done=0)
+            for segment in part:
+                segment.context = {'episode': self.id, 'part': i}
+        segments = [segment for part in parts for segment in part]
+
+        captions_file = None
+        if captions and self.__subtitle_codec(filename, container) is not None:
+            captions_file = self.download_captions(os.path.join(get_tempdir(), escape_filename(f'{self.lang}-{self.id}-{time.time()}.vtt')))
+
+        import subprocess
+        log.info("Streaming %s segments into ffmpeg...", len(segments))
+        inputs = ['-f', 'mpegts', '-i', 'pipe:0'] + (['-i', captions_file] if captions_file else [])
+        p = subprocess.Popen([get_ffmpeg_executable(ffmpeg_executable), '-loglevel', 'warning', '-y'] + inputs
+                             + self.__output_args(filename, container, 0, 1 if captions_file else None), stdin=subprocess.PIPE)
+        try:
+            with instrumentation.phase('stream', episode=self.id):
+                try:
+                    for segment, data in zip(segments, iter_segments(segments, executor, max_buffered, cancelled)):
+                        problem = check_ts(data)
+                        if problem is not None:
+                            data = fetch_segment(segment)
+                            if check_ts(data) is None:
+                                repaired[segment.context['part']] += 1
+                            else:
+                                problems[segment.context['part']].append(f"segment {segment.sequence} is damaged: {problem}")
+                        p.stdin.write(data)
+                        written[segment.context['part']] += 1
+                finally:
+                    p.stdin.close()
+                if p.wait() != 0:
+                    raise SpdlError(f"ffmpeg exited with status {p.returncode} while writing {filename}")
+        except BaseException:
+            if p.poll() is None:
+                p.terminate()
+                p.wait()
+            remove_files([filename])
+            raise
+        finally:
+            if captions_file is not None:
+                remove_files([captions_file])
+        for i, (video, part) in enumerate(zip(videos, parts)):
+            report.add_part(i, written[i], len(part), sum(s.duration for s in part),
+                            video.duration[0] if video.duration else None, repaired[i],
+                            self.__check_part(video, part, written[i]) + problems[i])
+        self.verification = report
+        if not report.ok:
+            log.warning("Verification of %s failed: %s", self, "; ".join(report.problems))
+
+    def __ffmpeg_metadata(self) -> List[str]:
+        if self.__metadata_args is not None:
+            return self.__metadata_args
         metadata = []
         for k, v in {
                         "title": f"{self.title} (S{self.season} E{self.episode_number_in_season})",
@@ -238,21 +1184,117 @@ class Episode:
                     }.items():
             metadata.append("-metadata")
             metadata.append(f'{k}={escape_string(str(v))}')
-        subprocess.Popen([ffmpeg_executable, '-loglevel', 'warning', '-y',  '-i', f'concat:{"|".join(fns)}'] + metadata + ['-c:v', 'copy', f'{filename}']).wait()
+        self.__metadata_args = metadata
+        return metadata
 
-        log.info("Cleaning up...")
-        for f in fns:
-            os.remove(f)
+    def __subtitle_codec(self, filename: str, container: Optional[str]) -> Optional[str]:
+        container = get_container(filename, container)
+        return CONTAINERS[container][1] if container in CONTAINERS else None
 
-        log.info("Download of Episode \"%s\" (S%sE%s) done.", self.title, self.season, self.episode_number_in_season)
+    def __output_args(self, filename: str, container: Optional[str], index: int,
+                      captions_index: Optional[int] = None) -> List[str]:
+        args = ['-map', f'{index}:v:0', '-map', f'{index}:a:0?']
+        if captions_index is not None:
+            args += ['-map', f'{captions_index}:s:0', '-c:s', self.__subtitle_codec(filename, container),
+                     '-metadata:s:s:0', f'language={CAPTION_LANGUAGES.get(self.lang, "und")}']
+        container = get_container(filename, container)
+        return args + self.__ffmpeg_metadata() + ['-c:v', 'copy'] + (CONTAINERS[container][0] if container in CONTAINERS else []) + [filename]
+
+    def __download_part(self, video: Video, quality: str, journal: DownloadJournal, part: int, executor: Executor,
+                        max_concurrent: int, ffmpeg_executable: str, cancelled: Optional[threading.Event]) -> Dict[str, Any]:
+        started = time.monotonic()
+        stream = video.get_stream(quality=quality)
+        filename = journal.part_file(part)
+        try:
+            segments = stream.get_segments()
+        except ValueError as e:
+            signature = f"{stream.resolution}/ffmpeg"
+            if journal.is_part_done(part, signature):
+                instrumentation.emit('part', episode=self.id, part=part, state='skipped', segments=None)
+            else:
+                log.info("Falling back to ffmpeg for stream %s: %s", stream.url, e)
+                journal.start_part(part, signature)
+                instrumentation.emit('part', episode=self.id, part=part, state='started', segments=None, done=0)
+                status = run_process([ffmpeg_executable, '-loglevel', 'warning', '-nostats', '-progress', 'pipe:1', '-y', '-i', stream.url, '-codec', 'copy', filename],
+                                     cancelled, on_progress=self.__emit_ffmpeg_progress)
+                if status != 0:
+                    raise SpdlError(f"ffmpeg exited with status {status} while downloading {stream.url}")
+                journal.finish_part(part)
+                instrumentation.emit('part', episode=self.id, part=part, state='done', duration=time.monotonic() - started)
+            with instrumentation.phase('verify', episode=self.id, part=part):
+                problem = check_ts_file(filename)
+            return {'part': part, 'expected_duration': video.duration[0] if video.duration else None,
+                    'problems': [problem] if problem is not None else []}
+
+        signature = f"{stream.resolution}/{len(segments)}/{sum(s.duration for s in segments):.3f}"
+        for segment in segments:
+            segment.context = {'episode': self.id, 'part': part}
+        if journal.is_part_done(part, signature):
+            log.info("Part %s was downloaded before", part)
+            instrumentation.emit('part', episode=self.id, part=part, state='skipped', segments=len(segments))
+        else:
+            done = journal.start_part(part, signature)
+            if done:
+                log.info("Resuming part %s after segment %s of %s", part, done, len(segments))
+            instrumentation.emit('part', episode=self.id, part=part, state='started', segments=len(segments), done=done)
+            download_segments(segments[done:], filename, executor, max_concurrent, cancelled, append=True,
+                              on_segment=lambda segment, data: journal.add_segment(part, data))
+            journal.finish_part(part)
+            instrumentation.emit('part', episode=self.id, part=part, state='done', duration=time.monotonic() - started)
+
+        with instrumentation.phase('verify', episode=self.id, part=part):
+            problems = []
+            repaired = {}
+            damaged = journal.verify_part(part)
+            if damaged:
+                log.info("Fetching %s damaged segment(s) of part %s again", len(damaged), part)
+                for i, data in zip(damaged, executor.map(fetch_segment, [segments[i] for i in damaged])):
+                    problem = check_ts(data)
+                    if problem is None:
+                        repaired[i] = data
+                    else:
+                        problems.append(f"segment {i} is damaged: {problem}")
+                journal.replace_segments(part, repaired)
+            written = journal.written_segments(part)
+            problems += self.__check_part(video, segments, written)
+        return {'part': part, 'segments': written, 'expected_segments': len(segments),
+                'duration': sum(s.duration for s in segments),
+                'expected_duration': video.duration[0] if video.duration else None,
+                'repaired': len(repaired), 'problems': problems}
+
+    def __check_part(self, video: Video, segments: List[Segment], count: int) -> List[str]:
+        # `count` is the number of segments that ended up in the output, counted independently of the playlist
+        problems = []
+        if count != len(segments):
+            problems.append(f"{count} of {len(segments)} segments were downloaded")
+        duration = sum(s.duration for s in segments)
+        if video.duration and abs(duration - video.duration[0]) > self.DURATION_TOLERANCE:
+            problems.append(f"the playlist lasts {duration:.1f}s, but the video {video.duration[0]}s")
+        return problems
+
+    def __emit_ffmpeg_progress(self, progress: Dict[str, str]):
+        out_time = progress.get('out_time_us') or progress.get('out_time_ms')
+        instrumentation.emit('ffmpeg', episode=self.id,
+                             out_time=int(out_time) / 1e6 if out_time and out_time.isdigit() else None,
+                             total_size=int(progress['total_size']) if progress.get('total_size', '').isdigit() else None,
+                             speed=progress.get('speed', '').strip() or None)
+
+    def __resolve_video(self, mediagen: str, streams: bool) -> Video:
+        return self.__resolve_streams(self.__get_video(mediagen), streams)
+
+    @staticmethod
+    def __resolve_streams(video: Video, streams: bool) -> Video:
+        if streams:
+            video.get_streams()
+        return video
 
     def __get_video(self, mediagen: str) -> Video:
         if self.lang != "de":
             mediagen = mediagen.replace('device={device}', 'device=Android&deviceOsVersion=4.4.4&acceptMethods=hls')
         else:
             mediagen = mediagen.replace('device={device}', 'acceptMethods=hls')
-        xml = http_get(mediagen)
-        root = etree.fromstring(xml)
+        xml = http_get(mediagen, kind='mediagen', lang=self.lang)
+        root = _etree().fromstring(xml)
         rtmpe = []
         duration = []
         captions = ""
@@ -282,18 +1324,18 @@ class Episode:
             for item in root.getiterator('typographic'):
                 if item.attrib['src'] != None and item.attrib['format'] == "vtt":
                     captions = item.attrib['src']
-        return Video(rtmpe, duration, captions)
+        return Video(rtmpe, duration, captions, mediagen)
 
     def __get_mediagen(self) -> List[str]:
         mediagen = []
         comp = self.__mediagen_url()
-        feed = http_get(comp)
+        feed = http_get(comp, kind='feed', lang=self.lang)
         if self.lang == "se":
             jsondata = json.loads(feed)
             for media in jsondata["feed"]["items"]:
                 mediagen.append(media["group"]["content"])
         else:
-            root = etree.fromstring(feed)
+            root = _etree().fromstring(feed)
             if sys.version_info >= (2, 7):
                 for item in root.iter('{http://search.yahoo.com/mrss/}content'):
                     if item.attrib['url'] is not None:
@@ -339,6 +1381,9 @@ class SouthPark:
     A simple South Park interface supporting downloads and advanced video stream management.
     """
 
+    PAGE_SIZE = 30
+    """The number of episodes requested per page of a season feed"""
+
     def __init__(self, lang: str = 'en'):
         if lang not in DOMAIN_URL:
             raise ValueError(f"Unsupported language: {lang}. Supported languages are: {', '.join(DOMAIN_URL.keys())}")
@@ -349,7 +1394,7 @@ class SouthPark:
         Get a list of all season numbers of the current language.
         :return: A list containing the season numbers, as ints
         """
-        resp = http_get(ALL_SEASONS_URL[self.lang])
+        resp = http_get(ALL_SEASONS_URL[self.lang], default=b'', kind='season_numbers', lang=self.lang).decode('utf-8', 'replace')
         return sorted(set([int(x.group(1)) for x in re.finditer(r'data-value="season-(\d+)"', resp)])) or list(range(24))
 
     def get_all_seasons(self) -> List[Season]:
@@ -359,69 +1404,3417 @@ class SouthPark:
         to get a specific season alongside `get_season_numbers(str)` to get a list of all existing season numbers.
         :return: A list containing a Season object for each season
         """
-        for season in self.get_season_numbers():
-            yield self.get_season(season)
+        yield from self.iter_seasons(self.get_season_numbers())
 
-    def get_season(self, season: int) -> Season:
+    def get_seasons(self, seasons: Iterable[int], max_workers: int = 8) -> List[Season]:
         """
-        Get a Season object for a specific south park season.
-        :param season: The Season's number (as int)
+        Get multiple seasons at once. The season feeds are fetched concurrently.
+        :param seasons: The numbers of the seasons to get
+        :param max_workers: The maximum number of concurrent requests
+        :return: A list containing a Season object for each season, in the given order
         """
-        if self.lang == "de":
-            url = f"https://www.southpark.de/feeds/carousel/video/e3748950-6c2a-4201-8e45-89e255c06df1/30/1/json/!airdate/season-{season}"
-        elif self.lang == "se" and season < 23:  # SE doesn't have the 23rd season.
-            url = f"https://www.southparkstudios.nu/feeds/carousel/video/9bbbbea3-a853-4f1c-b5cf-dc6edb9d4c00/30/1/json/!airdate/season-{season}"
-        elif self.lang == "uk":
-            url = f"https://www.southparkstudios.co.uk/feeds/carousel/video/02ea1fb4-2e7c-45e2-ad42-ec8a04778e64/30/1/json/!airdate/season-{season}"
-        # cc.com is the ony one with jsons so descriptions will be in english
+        return list(self.iter_seasons(seasons, max_workers))
+
+    def iter_seasons(self, seasons: Iterable[int], prefetch: int = 4) -> Iterable[Season]:
+        """
+        Get multiple seasons, one after another, while the pages of the next seasons are fetched in the background.
+        :param seasons: The numbers of the seasons to get
+        :param prefetch: The maximum number of pages to fetch concurrently
+        :return: A generator yielding a Season object for each season, in the given order, as soon as all its pages arrived
+        """
+        episodes = []
+        for season, page, last in self.__iter_pages(seasons, prefetch):
+            episodes += page
+            if last:
+                yield Season(season, episodes)
+                episodes = []
+
+    def iter_episodes(self, seasons: Optional[Iterable[int]] = None, prefetch: int = 4) -> Iterable[Episode]:
+        """
+        Get the episodes of multiple seasons as soon as their pages arrive. The next pages are fetched in the
+        background, so that the first episodes can be used while later seasons are still loading.
+        :param seasons: The numbers of the seasons, defaults to all seasons
+        :param prefetch: The maximum number of pages to fetch concurrently
+        :return: A generator yielding the episodes in the order of the seasons and of the season feeds
+        """
+        for _, page, _ in self.__iter_pages(self.get_season_numbers() if seasons is None else seasons, prefetch):
+            yield from page
+
+    def get_season(self, season: int) -> Season:
+        """
+        Get a Season object for a specific south park season. All pages of the season feed are fetched.
+        :param season: The Season's number (as int)
+        """
+        episodes = []
+        for _, page, _ in self.__iter_pages([season], 1):
+            episodes += page
+        return Season(season, episodes)
+
+    def get_season_page(self, season: int, page: int = 1) -> List[Episode]:
+        """
+        Get a single page of the feed of a season. Each page contains up to `PAGE_SIZE` episodes.
+        :param season: The Season's number (as int)
+        :param page: The number of the page, starting at 1
+        :return: The episodes on the page; an empty list if the page is behind the last one
+        """
+        if self.lang == "de":
+            url = f"https://www.southpark.de/feeds/carousel/video/e3748950-6c2a-4201-8e45-89e255c06df1/{self.PAGE_SIZE}/{page}/json/!airdate/season-{season}"
+        elif self.lang == "se" and season < 23:  # SE doesn't have the 23rd season.
+            url = f"https://www.southparkstudios.nu/feeds/carousel/video/9bbbbea3-a853-4f1c-b5cf-dc6edb9d4c00/{self.PAGE_SIZE}/{page}/json/!airdate/season-{season}"
+        elif self.lang == "uk":
+            url = f"https://www.southparkstudios.co.uk/feeds/carousel/video/02ea1fb4-2e7c-45e2-ad42-ec8a04778e64/{self.PAGE_SIZE}/{page}/json/!airdate/season-{season}"
+        # cc.com is the ony one with jsons so descriptions will be in english
+        else:
+            url = f"https://southpark.cc.com/feeds/carousel/video/06bb4aa7-9917-4b6a-ae93-5ed7be79556a/{self.PAGE_SIZE}/{page}/json/!airdate/season-{season}?lang={self.lang}"
+
+        season_data = json.loads(http_get(url, kind='season', lang=self.lang))
+
+        episodes = []
+        for e in season_data["results"]:
+            episodes.append(Episode(
+                id=e.get("itemId").strip(),
+                title=e.get("title").strip(),
+                description=e.get("description").strip(),
+                short_description=e.get("shortDescription").strip(),
+                thumbnail=e.get("images").strip(),
+                date=int(e.get("originalAirDate", 0).strip()),
+                episode_number=e.get("episodeNumber").strip(),
+                episode_number_in_season=e.get("episodeNumber", "0")[-2:].strip(),
+                season=e.get("episodeNumber", "0")[:2].strip(),
+                _lang=self.lang
+            ))
+
+        return episodes
+
+    def __iter_pages(self, seasons: Iterable[int], prefetch: int) -> Iterable[Tuple[int, List[Episode], bool]]:
+        # Yields (season, new episodes of the page, whether it is the last page of the season). The first pages of
+        # the next seasons are fetched ahead; a further page is only requested when a page was full.
+        remaining = iter(seasons)
+        pending = collections.deque()
+        seen = set()
+        executor = ThreadPoolExecutor(max_workers=max(prefetch, 1))
+        try:
+            while True:
+                while len(pending) < max(prefetch, 1):
+                    season = next(remaining, None)
+                    if season is None:
+                        break
+                    pending.append((season, 1, executor.submit(self.get_season_page, season, 1)))
+                if not pending:
+                    break
+                season, number, future = pending.popleft()
+                if number == 1:
+                    seen = set()
+                episodes = future.result()
+                new = [e for e in episodes if e.id not in seen]
+                seen.update(e.id for e in new)
+                # Stop at a short page, and when the feed ignores the page number and repeats itself
+                last = len(episodes) < self.PAGE_SIZE or not new
+                if not last:
+                    pending.appendleft((season, number + 1, executor.submit(self.get_season_page, season, number + 1)))
+                yield season, new, last
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def __carousel(self, video_id: Optional[str] = None) -> Dict:
+        if self.lang == 'de':
+            url = f"https://www.southpark.de/feeds/carousel/video/{video_id or 'e3748950-6c2a-4201-8e45-89e255c06df1'}/30/1/json"
+        elif self.lang == 'se':
+            url = f"https://www.southparkstudios.nu/feeds/carousel/wiki/{video_id or '3fb9ffcb-1f70-42ed-907d-9171091a28f4'}/12/1/json"
+        elif self.lang == 'uk':
+            url = f"https://www.southparkstudios.co.uk/feeds/carousel/wiki/{video_id or '4d56eb84-60d9-417e-9550-31bbfa1e7fb9'}/12/1/json"
+        else:
+            url = f"https://southpark.cc.com/feeds/carousel/video/{video_id or '2b6c5ab4-d717-4e84-9143-918793a3b636'}/14/2/json/!airdate/?lang={self.lang.upper()}"
+        return json.loads(http_get(url, kind='season', lang=self.lang))
+
+
+class CatalogEntry(NamedTuple):
+    """
+    A compact, immutable record of an episode in the `Catalog`. Unlike an `Episode`, it does not hold any videos;
+    use `to_episode()` to download it.
+    """
+    lang: str
+    season: int
+    episode: int
+    """The episode number relative to its season"""
+    number: str
+    """The global episode number, e.g. "1908\""""
+    id: str
+    title: str
+    date: float
+    """The air date as a unix timestamp"""
+    added: float
+    """When the episode was added to the catalog, as a unix timestamp"""
+    description: str
+    short_description: str
+    thumbnail: str
+
+    @staticmethod
+    def from_episode(episode: Episode, added: float) -> 'CatalogEntry':
+        """
+        Create a record of an episode.
+        :param episode: The episode
+        :param added: When the episode was added to the catalog
+        """
+        return CatalogEntry(episode.lang, int(episode.season), int(episode.episode_number_in_season),
+                            episode.episode_number, episode.id, episode.title, float(episode.date), added,
+                            episode.description, episode.short_description, episode.thumbnail)
+
+    def to_episode(self) -> Episode:
+        """
+        Create an episode from the record. Its videos are resolved when needed.
+        """
+        return Episode(self.id, self.title, self.description, self.short_description, self.thumbnail, self.date,
+                       self.number, f"{self.season:02d}", f"{self.episode:02d}", self.lang)
+
+
+class Catalog:
+    """
+    A local index of the episodes of one or more languages, stored as a JSON file. Selections are answered from the
+    index without any network requests, so repeated lookups against the same catalog are instant. Besides the season
+    and episode selectors of `select_episodes()`, `select()` understands these terms:
+
+    - 'title:<words>': episodes whose title contains words starting with each of the given words, e.g. 'title:pandemic'
+    - 'date:<from>..<to>': episodes that aired in a date range; the dates are 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD' and
+      either end may be left out, e.g. 'date:2019-10..2019-12' or 'date:2020..'
+    - '#<number>': the episode with a global episode number, e.g. '#1803'
+    - 'new': episodes that were added to the catalog after a given time, e.g. the last sync
+
+    Terms separated by commas are combined, terms joined with '+' must all match, e.g. 'S20+title:member,S21E01'.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: The JSON file to store the catalog in. Defaults to 'catalog.json' in the user's cache directory.
+        """
+        self.path: str = path or os.path.join(get_cache_dir(), 'catalog.json')
+        """The JSON file the catalog is stored in"""
+        self.updated: Dict[str, float] = {}
+        """When the episodes of each language were last fetched, as unix timestamps"""
+        self.__entries: List[CatalogEntry] = []
+        self.__lock = threading.Lock()
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.updated = data.get('updated', {})
+            self.__entries = [CatalogEntry(*row) for row in data.get('episodes', [])]
+        self.__index()
+
+    @property
+    def languages(self) -> List[str]:
+        """The languages the catalog contains"""
+        return sorted(self.updated)
+
+    def update(self, southpark: SouthPark, seasons: Optional[Iterable[int]] = None, prefetch: int = 4) -> int:
+        """
+        Fetch the episodes of a language and save them to the catalog. Episodes that are already in the catalog keep
+        the time they were added.
+        :param southpark: The SouthPark instance to fetch the seasons from
+        :param seasons: The numbers of the seasons to fetch, defaults to all seasons. Only these seasons are replaced.
+        :param prefetch: The maximum number of season pages to fetch concurrently
+        :return: The number of episodes that were new to the catalog
+        """
+        lang = southpark.lang
+        now = time.time()
+        with self.__lock:
+            known = {e.id: e.added for e in self.__entries if e.lang == lang}
+        fetched = {}
+        for episode in southpark.iter_episodes(seasons, prefetch):
+            fetched.setdefault(episode.id, CatalogEntry.from_episode(episode, known.get(episode.id, now)))
+        replaced = None if seasons is None else set(e.season for e in fetched.values()) | set(seasons)
+        with self.__lock:
+            self.__entries = [e for e in self.__entries
+                              if e.lang != lang or (replaced is not None and e.season not in replaced)] \
+                             + list(fetched.values())
+            self.updated[lang] = now
+            self.__index()
+            self.__save()
+        return sum(1 for id in fetched if id not in known)
+
+    def get(self, lang: str, season: int, episode: int) -> Optional[CatalogEntry]:
+        """
+        Look up an episode by its season and episode number.
+        :param lang: The language
+        :param season: The season number
+        :param episode: The episode number relative to the season
+        :return: The record, or None if the catalog does not contain the episode
+        """
+        return self.__by_key.get((lang, season, episode))
+
+    def get_by_number(self, lang: str, number: str) -> Optional[CatalogEntry]:
+        """
+        Look up an episode by its global episode number.
+        :param lang: The language
+        :param number: The global episode number, e.g. "1803"
+        :return: The record, or None if the catalog does not contain the episode
+        """
+        return self.__by_number.get((lang, number.lstrip('0')))
+
+    def select(self, selector: str, lang: str, since: Optional[float] = None) -> List[CatalogEntry]:
+        """
+        Select episodes with a selector string, see `Catalog`.
+        :param selector: The selector, e.g. 'all', 'S01-S07', 'title:imaginationland' or 'date:2019..,new'
+        :param lang: The language to select the episodes of
+        :param since: The time that 'new' compares the time an episode was added to, e.g. the last download of the manifest. If None, 'new' selects no episodes.
+        :return: The selected records, sorted by season and episode and without duplicates
+        :raise ValueError: If the selector is invalid or a single selected episode does not exist
+        """
+        selected = set()
+        for group in map(str.strip, selector.split(',')):
+            matches = None
+            for term in map(str.strip, group.split('+')):
+                found = self.__match(term, lang, since)
+                matches = found if matches is None else matches & found
+            selected |= matches
+        return sorted(selected, key=lambda e: (e.season, e.episode))
+
+    def __match(self, term: str, lang: str, since: Optional[float]) -> set:
+        entries = self.__by_lang.get(lang, [])
+        if term.lower() == 'all':
+            return set(entries)
+        if term.lower() == 'new':
+            return set(e for e in entries if since is not None and e.added > since)
+        if term.startswith('#'):
+            entry = self.get_by_number(lang, term[1:])
+            if entry is None:
+                raise ValueError(f"Episode {term} does not exist.")
+            return {entry}
+        if term.lower().startswith('title:'):
+            return self.__search(lang, term[6:])
+        if term.lower().startswith('date:'):
+            start, sep, end = term[5:].partition('..')
+            start, end = _parse_date(start.strip(), False), _parse_date((end if sep else start).strip(), True)
+            dates = self.__dates.get(lang, ([], []))
+            return set(dates[1][bisect.bisect_left(dates[0], start):bisect.bisect_right(dates[0], end)])
+
+        if '-' in term:
+            if term.count('-') > 1:
+                raise ValueError(f"Invalid parameter: {term}")
+            start, end = map(parse_episode_string, map(str.strip, term.split('-', 1)))
+        else:
+            start = end = parse_episode_string(term)
+            if start[1] is not None and self.get(lang, *start) is None:
+                raise ValueError(f"Season {start[0]} Episode {start[1]} does not exist.")
+        low, high = (start[0], start[1] or 0), (end[0], end[1] or math.inf)
+        return set(e for season in range(start[0], end[0] + 1) for e in self.__by_season.get((lang, season), [])
+                   if low <= (e.season, e.episode) <= high)
+
+    def __search(self, lang: str, text: str) -> set:
+        found = None
+        for word in re.findall(r'\w+', text.lower()):
+            words = self.__vocabulary.get(lang, [])
+            matches = set()
+            i = bisect.bisect_left(words, word)
+            while i < len(words) and words[i].startswith(word):
+                matches |= self.__words[(lang, words[i])]
+                i += 1
+            found = matches if found is None else found & matches
+        return found or set()
+
+    def __index(self):
+        self.__by_lang: Dict[str, List[CatalogEntry]] = {}
+        self.__by_key: Dict[Tuple[str, int, int], CatalogEntry] = {}
+        self.__by_number: Dict[Tuple[str, str], CatalogEntry] = {}
+        self.__by_season: Dict[Tuple[str, int], List[CatalogEntry]] = {}
+        self.__words: Dict[Tuple[str, str], set] = {}
+        for e in sorted(self.__entries, key=lambda e: (e.lang, e.season, e.episode)):
+            self.__by_lang.setdefault(e.lang, []).append(e)
+            self.__by_key[(e.lang, e.season, e.episode)] = e
+            self.__by_number[(e.lang, e.number.lstrip('0'))] = e
+            self.__by_season.setdefault((e.lang, e.season), []).append(e)
+            for word in re.findall(r'\w+', e.title.lower()):
+                self.__words.setdefault((e.lang, word), set()).add(e)
+        self.__vocabulary: Dict[str, List[str]] = {}  # The sorted title words of each language, for prefix searches
+        for lang, word in sorted(self.__words):
+            self.__vocabulary.setdefault(lang, []).append(word)
+        self.__dates: Dict[str, Tuple[List[float], List[CatalogEntry]]] = {}
+        for lang, entries in self.__by_lang.items():
+            entries = sorted(entries, key=lambda e: e.date)
+            self.__dates[lang] = ([e.date for e in entries], entries)
+
+    def __save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1, 'updated': self.updated, 'episodes': self.__entries}, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} path={self.path} episodes={len(self.__entries)}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class Manifest:
+    """
+    A record of the episodes that were downloaded to a library, stored as a JSON file. It is used to find out which
+    episodes are missing, incomplete or of lower quality than requested by only comparing the records with the
+    files on disk, without any network requests.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The JSON file to store the manifest in. It is created when the first download is recorded.
+        """
+        self.path: str = path
+        """The JSON file the manifest is stored in"""
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        """The records of the downloaded files, by `Manifest.key()`"""
+        self.__lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.entries = data.get('episodes', {})
+            if data.get('version', 1) < 2:
+                # Version 1 kept a single record per episode and language
+                self.entries = {self.key(entry['path']): entry for entry in self.entries.values()}
+
+    @staticmethod
+    def key(filename: str) -> str:
+        """
+        Get the key of a record. Records are kept per file, as an episode may be downloaded in several languages and
+        qualities.
+        :param filename: The downloaded file
+        """
+        return os.path.realpath(filename)
+
+    def get(self, episode: Episode, filename: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Get the record of an episode.
+        :param episode: The episode
+        :param filename: The file the episode was saved to, or None to get the record of any file of the episode
+        :return: The record, or None if the episode was never downloaded (to the given file)
+        """
+        with self.__lock:
+            if filename is not None:
+                entries = [self.entries.get(self.key(filename))]
+            else:
+                entries = self.entries.values()
+            return next((e for e in entries if e is not None and e['id'] == episode.id and e['lang'] == episode.lang),
+                        None)
+
+    def needs_download(self, episode: Episode, filename: str, quality: str = 'max') -> Optional[str]:
+        """
+        Check whether an episode has to be downloaded to bring the library up to date. Only the file's size on disk is
+        checked, the file is not read.
+        :param episode: The episode
+        :param filename: The file the episode should be saved to
+        :param quality: The requested quality, see `Episode.download()`
+        :return: None if the file is up to date, otherwise the reason to download it: 'new', 'missing', 'truncated', 'damaged' (the verification found problems, see `VerificationReport`) or 'upgrade'
+        """
+        entry = self.get(episode, filename)
+        if entry is None:
+            return 'new'
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return 'missing'
+        if stat.st_size != entry['size']:
+            return 'truncated'
+        if entry.get('problems'):
+            return 'damaged'
+        if self.is_upgrade(entry, quality):
+            return 'upgrade'
+        return None
+
+    def last_download(self, lang: Optional[str] = None) -> Optional[float]:
+        """
+        Get the time of the latest recorded download, e.g. to select the episodes that are new since the last sync.
+        :param lang: Only consider downloads of this language
+        :return: The time as unix timestamp, or None if nothing was downloaded
+        """
+        with self.__lock:
+            return max((e['downloaded'] for e in self.entries.values() if lang is None or e['lang'] == lang),
+                       default=None)
+
+    @staticmethod
+    def is_upgrade(entry: Dict[str, Any], quality: str) -> bool:
+        """
+        Check whether downloading an episode with the requested quality would improve on a recorded download.
+        :param entry: The record of the episode
+        :param quality: The requested quality, see `Episode.download()`
+        """
+        if entry.get('downgraded'):
+            return True
+        if quality == entry['quality']:
+            return False
+        if quality == 'max':
+            return True
+        if re.match(r"\d+x\d+$", quality) and entry.get('resolution'):
+            width, height = map(int, quality.split("x"))
+            recorded_width, recorded_height = map(int, entry['resolution'].split("x"))
+            return width * height > recorded_width * recorded_height
+        return False
+
+    def record(self, episode: Episode, filename: str, quality: str, resolution: Optional[str] = None,
+               duration: Optional[float] = None, downgraded: bool = False, problems: Optional[List[str]] = None):
+        """
+        Record a finished download and save the manifest.
+        :param episode: The downloaded episode
+        :param filename: The file the episode was saved to
+        :param quality: The requested quality
+        :param resolution: The resolution that was actually downloaded, like '1920x1080'
+        :param duration: The duration of the episode in seconds
+        :param downgraded: Whether a lower quality than requested was downloaded, see `AdaptiveQuality`; such downloads are upgraded by the next sync
+        :param problems: The problems the verification of the download found, see `VerificationReport`; such downloads are repeated by the next sync
+        """
+        import hashlib
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        entry = {
+            'id': episode.id,
+            'lang': episode.lang,
+            'season': episode.season,
+            'episode': episode.episode_number_in_season,
+            'title': episode.title,
+            'path': os.path.realpath(filename),
+            'quality': quality,
+            'resolution': resolution,
+            'duration': duration,
+            'downgraded': downgraded,
+            'problems': problems or [],
+            'size': os.path.getsize(filename),
+            'sha1': sha1.hexdigest(),
+            'downloaded': time.time(),
+        }
+        with self.__lock:
+            self.entries[self.key(filename)] = entry
+            self.__save()
+
+    def __save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': 2, 'episodes': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+class ScratchSpace:
+    """
+    Manages the scratch volumes the parts of episodes are downloaded to before they are merged. Before an episode is
+    downloaded, its size is estimated from the bandwidth and duration of its streams, and the download is only
+    admitted once the projected usage fits the quota and the free space of a volume. Otherwise a batch of parallel
+    downloads could run out of space halfway through and leave several episodes damaged.
+    """
+
+    PLACEMENTS = ('free', 'round-robin')
+    """The strategies to pick a volume: the one with the most space left, or the next one in turn"""
+
+    STALE_DIR = re.compile(r'\.spdl-(?:(\d+)(?:@(.+))?-)?\d+(?:\.\d+)?$')
+    """Matches the temporary directories of `make_tempdir()`, including those of older versions without the host name"""
+
+    def __init__(self, volumes: Optional[List[str]] = None, quota: Optional[int] = None,
+                 placement: str = 'free', reserve: int = 256 * 1024 * 1024, default_size: int = 500 * 1024 * 1024):
+        """
+        :param volumes: The directories to download to, e.g. on different drives. Defaults to the system's temporary directory.
+        :param quota: The maximum number of bytes all admitted downloads may use together, or None to only respect the free space. A single download that is larger is admitted on its own.
+        :param placement: How to pick the volume of each download, one of `PLACEMENTS`
+        :param reserve: The number of bytes to leave free on each volume
+        :param default_size: The estimated size of an episode whose streams do not announce their bandwidth
+        """
+        if placement not in self.PLACEMENTS:
+            raise ValueError(f"Unknown placement: {placement}")
+        self.volumes: List[str] = [os.path.abspath(v) for v in volumes or [get_tempdir_root()]]
+        """The directories downloads are placed in"""
+        self.quota = quota
+        self.placement = placement
+        self.reserve = reserve
+        self.default_size = default_size
+        self.__cond = threading.Condition()
+        self.__reserved: Dict[int, int] = {}  # by device
+        self.__admitted: List[ScratchReservation] = []
+        self.__next = 0
+        self.__tempdirs: Dict[str, str] = {}
+        for volume in self.volumes:
+            os.makedirs(volume, exist_ok=True)
+
+    def estimate(self, episode: 'Episode', quality: str = 'max') -> int:
+        """
+        Estimate the size of the downloaded parts of an episode from the bandwidth and duration of its streams.
+        :param episode: The episode
+        :param quality: The quality to download, see `Episode.download()`
+        :return: The estimated size in bytes
+        """
+        size = 0
+        for video in episode.get_videos():
+            stream = video.get_stream(quality)
+            if stream.bandwidth is None or not video.duration:
+                return self.default_size
+            size += stream.bandwidth // 8 * video.duration[0]
+        return int(size * 1.05)
+
+    def admit(self, episode: 'Episode', quality: str = 'max', resume: bool = True,
+              cancelled: Optional[threading.Event] = None) -> 'ScratchReservation':
+        """
+        Wait until there is enough space to download an episode and reserve it. A download that can be resumed is
+        placed on the volume it was started on; if that volume is too full but another one has room for the whole
+        episode, the download starts over there and the progress on the first volume is discarded.
+        :param episode: The episode
+        :param quality: The quality to download, see `Episode.download()`
+        :param resume: Whether the download will be resumable, see `Episode.download_parts()`
+        :param cancelled: An event that stops waiting and raises a `DownloadCancelled` exception when set
+        :return: The reservation; release it once the parts are merged
+        :raise SpdlError: If the episode does not fit on any volume even if no other download is running
+        """
+        name = escape_filename(f"{episode.lang}-{episode.id}-{quality}")
+        total = size = self.estimate(episode, quality)
+        volumes = self.volumes
+        started = None
+        written = 0
+        if resume:
+            started = next((os.path.join(v, '.spdl-resume', name) for v in self.volumes
+                            if os.path.isdir(os.path.join(v, '.spdl-resume', name))), None)
+            if started is not None:
+                volumes = [os.path.dirname(os.path.dirname(started))]
+                written = get_size(started)
+                size = max(size - written, 0)
+
+        with self.__cond:
+            while True:
+                volume = self.__place(volumes, size)
+                if volume is None and started is not None:
+                    volume = self.__place(self.volumes, total)
+                    if volume is not None:
+                        log.info("Not enough space to resume %s in %s, starting over in %s", episode, started, volume)
+                        shutil.rmtree(started, ignore_errors=True)
+                        size = total
+                        written = 0
+                if volume is not None:
+                    break
+                if not self.__admitted:
+                    raise SpdlError(f"Not enough scratch space to download {episode} (about {size // 1024 ** 2} MB)")
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled()
+                log.debug("Waiting for %s MB of scratch space for %s", size // 1024 ** 2, episode)
+                self.__cond.wait(0.25)
+            device = self.__device(volume)
+            self.__reserved[device] = self.__reserved.get(device, 0) + size
+            if resume:
+                directory = os.path.join(volume, '.spdl-resume', name)
+            else:
+                directory = os.path.join(self.__tempdir(volume), escape_filename(f"{episode.lang}-{episode.id}-{quality}-{time.time()}"))
+            reservation = ScratchReservation(self, volume, directory, size, written)
+            self.__admitted.append(reservation)
+        instrumentation.emit('scratch', episode=episode.id, volume=volume, size=size)
+        return reservation
+
+    def release(self, reservation: 'ScratchReservation'):
+        """
+        Release the space of an admitted download, see `ScratchReservation.release()`.
+        :param reservation: The reservation
+        """
+        with self.__cond:
+            if reservation not in self.__admitted:
+                return
+            self.__admitted.remove(reservation)
+            self.__reserved[self.__device(reservation.volume)] -= reservation.size
+            self.__cond.notify_all()
+
+    @property
+    def reserved(self) -> int:
+        """The number of bytes reserved by the admitted downloads"""
+        with self.__cond:
+            return sum(self.__reserved.values())
+
+    def sweep(self, max_age: float = 24 * 60 * 60) -> int:
+        """
+        Delete the temporary directories that earlier runs left behind on the volumes, e.g. because they crashed.
+        Directories of processes that are still running on this machine are kept, and so are the resume directories.
+        Directories of other machines, which may share a volume, are only deleted once nothing in them changed for
+        `max_age` seconds.
+        :param max_age: The age in seconds after which a directory of an unknown process is deleted
+        :return: The number of deleted directories
+        """
+        removed = 0
+        hostname = get_hostname()
+        for volume in self.volumes:
+            for name in os.listdir(volume):
+                match = self.STALE_DIR.match(name)
+                path = os.path.join(volume, name)
+                if match is None or not os.path.isdir(path) or path in self.__tempdirs.values() or path == tempdir:
+                    continue
+                pid = int(match.group(1)) if match.group(1) else None
+                if pid is not None and match.group(2) == hostname and os.name != 'nt':
+                    stale = not is_process_alive(pid)
+                else:
+                    try:
+                        stale = time.time() - get_last_modified(path) > max_age
+                    except OSError:
+                        continue
+                if stale:
+                    log.info("Deleting stale temporary directory %s", path)
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+        return removed
+
+    def __place(self, volumes: List[str], size: int) -> Optional[str]:
+        if self.quota is not None and self.__admitted and sum(self.__reserved.values()) + size > self.quota:
+            return None
+        # The free space already lacks what the admitted downloads wrote, so only the rest of their size is subtracted
+        pending = {}
+        for reservation in self.__admitted:
+            device = self.__device(reservation.volume)
+            pending[device] = pending.get(device, 0) + reservation.remaining
+        available = {}
+        for volume in volumes:
+            try:
+                free = shutil.disk_usage(volume).free
+            except OSError as e:
+                log.warning("Can not use scratch volume %s: %s", volume, e)
+                continue
+            left = free - self.reserve - pending.get(self.__device(volume), 0)
+            if left >= size:
+                available[volume] = left
+        if not available:
+            return None
+        if self.placement == 'free':
+            return max(available, key=available.get)
+        for i in range(len(self.volumes)):
+            volume = self.volumes[(self.__next + i) % len(self.volumes)]
+            if volume in available:
+                self.__next = (self.__next + i + 1) % len(self.volumes)
+                return volume
+        return None
+
+    @staticmethod
+    def __device(volume: str) -> int:
+        # Volumes on the same file system share its free space
+        return os.stat(volume).st_dev
+
+    def __tempdir(self, volume: str) -> str:
+        if get_tempdir_root() == volume:
+            return get_tempdir()
+        if volume not in self.__tempdirs:
+            self.__tempdirs[volume] = make_tempdir(volume)
+        return self.__tempdirs[volume]
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} volumes={self.volumes} quota={self.quota} reserved={self.reserved}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class ScratchReservation(object):
+    """
+    The space reserved for downloading the parts of an episode, see `ScratchSpace.admit()`.
+    """
+
+    def __init__(self, space: ScratchSpace, volume: str, directory: str, size: int, written: int = 0):
+        self.space: ScratchSpace = space
+        """The scratch space the reservation belongs to"""
+        self.volume: str = volume
+        """The volume the episode is downloaded to"""
+        self.directory: str = directory
+        """The directory to download the parts to, see `Episode.download_parts()`"""
+        self.size: int = size
+        """The number of reserved bytes"""
+        self.written: int = written
+        """The number of bytes that were in the directory when the space was reserved, e.g. of a resumed download"""
+
+    @property
+    def remaining(self) -> int:
+        """The number of reserved bytes that were not written to the directory yet"""
+        return max(self.size - (get_size(self.directory) - self.written), 0)
+
+    def release(self):
+        """
+        Release the reserved space. Releasing a reservation more than once has no effect.
+        """
+        self.space.release(self)
+
+    def __enter__(self) -> 'ScratchReservation':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} directory={self.directory} size={self.size}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class PriorityThreadPool(Executor):
+    """
+    A thread pool executor that runs queued tasks by priority instead of submission order. Tasks with a lower
+    priority value run first; tasks of the same priority run in submission order.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers: int = max_workers
+        """The maximum number of worker threads"""
+        self.__queue = queue.PriorityQueue()
+        self.__counter = itertools.count()
+        self.__threads = []
+        self.__lock = threading.Lock()
+        self.__shutdown = False
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.submit_prioritized(0, fn, *args, **kwargs)
+
+    def submit_prioritized(self, priority: int, fn, *args, **kwargs) -> Future:
+        """
+        Schedule a callable to be executed with the given priority.
+        :param priority: The priority of the task; lower values run first
+        :return: A Future representing the execution of the callable
+        """
+        future = Future()
+        with self.__lock:
+            if self.__shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            self.__queue.put((priority, next(self.__counter), future, fn, args, kwargs))
+            if len(self.__threads) < self.max_workers:
+                t = threading.Thread(target=self.__worker, daemon=True)
+                t.start()
+                self.__threads.append(t)
+        return future
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of tasks waiting for a worker"""
+        return self.__queue.qsize()
+
+    def with_priority(self, priority: int) -> Executor:
+        """
+        Get an executor that submits all its tasks to this pool with the given priority.
+        :param priority: The priority of the tasks; lower values run first
+        """
+        return _PrioritizedExecutor(self, priority)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        with self.__lock:
+            self.__shutdown = True
+            if cancel_futures:
+                while True:
+                    try:
+                        item = self.__queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    item[2].cancel()
+            for _ in self.__threads:
+                self.__queue.put((math.inf, next(self.__counter), None, None, None, None))
+        if wait:
+            for t in self.__threads:
+                t.join()
+
+    def __worker(self):
+        while True:
+            _, _, future, fn, args, kwargs = self.__queue.get()
+            if future is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class _PrioritizedExecutor(Executor):
+    def __init__(self, pool: PriorityThreadPool, priority: int):
+        self.__pool = pool
+        self.__priority = priority
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.__pool.submit_prioritized(self.__priority, fn, *args, **kwargs)
+
+
+class DownloadJob(object):
+    def __init__(self, episode: Episode, filename: str, priority: int, quality: str = 'max'):
+        self.episode: Episode = episode
+        """The episode to download"""
+        self.filename: str = filename
+        """The file the episode is saved to"""
+        self.priority: int = priority
+        """The priority of the job; jobs with lower values get the network workers first"""
+        self.state: str = 'queued'
+        """The state of the job: 'queued', 'downloading', 'merging', 'done', 'failed', 'cancelled' or 'copied'. A job is 'copied' when another job transfers the same streams, see `copy_of`."""
+        self.requested_quality: str = quality
+        """The requested quality, see `Episode.download()`"""
+        self.quality: Optional[str] = None
+        """The quality the episode is downloaded in; differs from the requested quality if it was lowered by `AdaptiveQuality`"""
+        self.copies: List[Tuple[str, str]] = []
+        """Further files, alongside their requested quality, that the same streams were requested for. They receive a copy of the file once it is written."""
+        self.copy_errors: Dict[str, BaseException] = {}
+        """The files of `copies` that could not be written, alongside the exception copying failed with"""
+        self.copy_of: Optional[DownloadJob] = None
+        """The job that transfers the same streams, if any; it copies its file to the file of this job once it is finished, see `copies`"""
+        self.downgraded: bool = False
+        """Whether the quality was lowered by `AdaptiveQuality`"""
+        self.error: Optional[BaseException] = None
+        """The exception the job failed with, if any"""
+        self.cancelled: threading.Event = threading.Event()
+        """Set to cancel the job"""
+        self.scratch: Optional[ScratchReservation] = None
+        """The scratch space reserved for the parts of the episode, see `ScratchSpace`"""
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} episode={self.episode} state={self.state}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class MuxPool:
+    """
+    Merges downloaded episodes on a bounded number of ffmpeg workers, independently of the network workers. Merges
+    that are waiting when a worker becomes free are written by a single ffmpeg process with one output per episode
+    (see `Episode.merge_batch()`), so a backlog of finished downloads does not start and probe a process per episode.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, batch_size: int = 4, ffmpeg_executable: Optional[str] = None,
+                 container: Optional[str] = None):
+        """
+        :param max_workers: The maximum number of ffmpeg processes to run concurrently; capped at and defaults to the number of CPUs
+        :param batch_size: The maximum number of episodes to merge with a single ffmpeg process
+        :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+        :param container: The container of the files, see `Episode.download()`
+        """
+        cpus = os.cpu_count() or 1
+        self.max_workers: int = min(max_workers or cpus, cpus)
+        """The maximum number of ffmpeg processes that run concurrently"""
+        self.batch_size = batch_size
+        self.ffmpeg_executable = ffmpeg_executable
+        self.container = container
+        self.__pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.__pending: collections.deque = collections.deque()
+        self.__lock = threading.Lock()
+
+    def submit(self, episode: Episode, part_files: List[str], filename: str,
+               cancelled: Optional[threading.Event] = None, captions: Optional[str] = None,
+               on_start: Optional[Callable[[], None]] = None) -> Future:
+        """
+        Queue the merge of an episode, see `Episode.merge_parts()`.
+        :param episode: The episode
+        :param part_files: The part files, e.g. as returned by `Episode.download_parts()`
+        :param filename: The file to save the merged episode to
+        :param cancelled: An event that cancels the merge when set
+        :param captions: A WebVTT file to embed as subtitle track
+        :param on_start: A callback that is called (from a worker thread) right before ffmpeg is started
+        :return: A future that is done when the file is written, or that raises the error the merge failed with
+        :raise RuntimeError: If the pool was shut down
+        """
+        future = Future()
+        merge = (episode, part_files, filename, cancelled, captions, on_start, future)
+        with self.__lock:
+            self.__pending.append(merge)
+        try:
+            self.__pool.submit(self.__work)
+        except RuntimeError:
+            with self.__lock:
+                self.__pending.remove(merge)
+            raise
+        return future
+
+    def shutdown(self, wait: bool = False):
+        """
+        Stop the workers. Merges that did not start yet are cancelled.
+        :param wait: Whether to wait for the running merges
+        """
+        self.__pool.shutdown(wait=wait, cancel_futures=True)
+        with self.__lock:
+            pending = list(self.__pending)
+            self.__pending.clear()
+        for merge in pending:
+            if merge[6].set_running_or_notify_cancel():
+                merge[6].set_exception(DownloadCancelled())
+
+    def __work(self):
+        batch = []
+        with self.__lock:
+            while self.__pending and len(batch) < self.batch_size:
+                batch.append(self.__pending.popleft())
+        # Every submitted merge schedules a worker run, so runs may find the queue emptied by an earlier batch
+        batch = [m for m in batch if m[6].set_running_or_notify_cancel()]
+        for merge in [m for m in batch if m[3] is not None and m[3].is_set()]:
+            merge[6].set_exception(DownloadCancelled())
+            batch.remove(merge)
+        for merge in batch:
+            if merge[5] is not None:
+                try:
+                    merge[5]()
+                except Exception as e:
+                    log.warning("Merge start callback failed: %s", e)
+
+        if len(batch) > 1:
+            log.info("Merging %s episodes with one ffmpeg process...", len(batch))
+            try:
+                Episode.merge_batch([m[:3] + (m[4],) for m in batch], self.ffmpeg_executable, self.container,
+                                    _AnyEvent([m[3] for m in batch]))
+            except BaseException as e:
+                log.info("Merging %s episodes at once failed, merging them one by one: %s", len(batch), e)
+            else:
+                for merge in batch:
+                    merge[6].set_result(None)
+                return
+
+        for episode, part_files, filename, cancelled, captions, _, future in batch:
+            try:
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled()
+                episode.merge_parts(part_files, filename, self.ffmpeg_executable, cancelled, self.container, captions)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(None)
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} max_workers={self.max_workers} batch_size={self.batch_size}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class _AnyEvent:
+    """Looks like a `threading.Event` that is set if any of the given events is set."""
+
+    def __init__(self, events: Iterable[Optional[threading.Event]]):
+        self.events = [e for e in events if e is not None]
+
+    def is_set(self) -> bool:
+        return any(e.is_set() for e in self.events)
+
+
+class StreamManager:
+    """
+    Keeps the stream urls of queued downloads valid. The stream urls handed out by the mediagen documents may be
+    signed with an expiry, so episodes that were resolved long before their download starts are resolved again
+    through the whole mediagen chain right before they are needed, and the next episodes are resolved in the
+    background just ahead of their turn. Urls without a known expiry are treated as valid for `max_age` seconds.
+    """
+
+    def __init__(self, prefetch: int = 2, margin: float = 300., max_age: Optional[float] = 3600.,
+                 max_workers: int = 4):
+        """
+        :param prefetch: The number of upcoming episodes to resolve in the background when a download starts
+        :param margin: The number of seconds the urls must at least stay valid when a download starts
+        :param max_age: The number of seconds urls without a known expiry are used, or None to use them forever
+        :param max_workers: The maximum number of episodes to resolve concurrently in the background
+        """
+        self.prefetch_count = prefetch
+        self.margin = margin
+        self.max_age = max_age
+        self.refreshed: int = 0
+        """The number of episodes whose videos were resolved again because their urls (nearly) expired"""
+        self.__pool = ThreadPoolExecutor(max_workers=max(max_workers, 1))
+        self.__pending: Dict[int, Future] = {}  # by id() of the episode
+        self.__lock = threading.Lock()
+
+    def valid_until(self, episode: Episode) -> Optional[float]:
+        """
+        Get the time until the resolved stream urls of an episode can be used.
+        :param episode: The episode
+        :return: A unix timestamp, math.inf if the urls never expire, or None if the episode is not resolved
+        """
+        if episode.resolved is None:
+            return None
+        expires = episode.expires
+        if expires is not None:
+            return expires
+        return episode.resolved + self.max_age if self.max_age is not None else math.inf
+
+    def ensure(self, episode: Episode):
+        """
+        Make sure the stream urls of an episode stay valid for at least `margin` seconds, resolving the episode (again)
+        if needed. A background resolution started by `prefetch()` is waited for.
+        :param episode: The episode
+        :raise NetworkError: If the episode could not be resolved
+        """
+        with self.__lock:
+            pending = self.__pending.get(id(episode))
+        if pending is not None:
+            try:
+                pending.result()
+            except Exception as e:
+                log.info("Resolving %s ahead failed: %s", episode, e)
+        self.__refresh(episode)
+
+    def prefetch(self, episodes: Iterable[Episode]):
+        """
+        Resolve the next episodes in the background, like `ensure()`.
+        :param episodes: The upcoming episodes, in the order they are downloaded; only the first `prefetch_count` ones are resolved
+        """
+        for episode in itertools.islice(episodes, self.prefetch_count):
+            with self.__lock:
+                if id(episode) in self.__pending:
+                    continue
+                try:
+                    future = self.__pool.submit(self.__refresh, episode)
+                except RuntimeError:
+                    return  # shut down
+                self.__pending[id(episode)] = future
+            future.add_done_callback(lambda _, key=id(episode): self.__done(key))
+
+    def shutdown(self):
+        """
+        Stop resolving episodes in the background.
+        """
+        self.__pool.shutdown(wait=False, cancel_futures=True)
+
+    def __refresh(self, episode: Episode):
+        valid_until = self.valid_until(episode)
+        if valid_until is None:
+            episode.resolve_videos()
+        elif valid_until - self.margin < time.time():
+            log.info("The stream urls of %s expire soon, resolving them again", episode)
+            episode.refresh()
+            with self.__lock:
+                self.refreshed += 1
+
+    def __done(self, key: int):
+        with self.__lock:
+            self.__pending.pop(key, None)
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} prefetch={self.prefetch_count} refreshed={self.refreshed}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class DownloadScheduler:
+    """
+    Downloads many episodes at once. All episodes share one bounded pool of network workers, which serves the
+    segments of earlier jobs first, and merging the parts with ffmpeg happens on separate workers so that the
+    network keeps busy while episodes are merged. Downloads of the same streams, e.g. of an episode that is requested
+    in two qualities but only available in one, are only transferred once.
+    """
+
+    def __init__(self, quality: str = 'max', max_episodes: int = 2, max_threads: int = 8, max_threads_per_part: int = 4,
+                 max_merges: int = 1, ffmpeg_executable: Optional[str] = None, resume: bool = True,
+                 streaming: bool = False, max_buffered: int = 16, manifest: Optional[Manifest] = None,
+                 adaptive: Optional[AdaptiveQuality] = None, on_update: Optional[Callable[[DownloadJob], None]] = None,
+                 container: Optional[str] = None, captions: bool = False, scratch: Optional[ScratchSpace] = None,
+                 streams: Optional[StreamManager] = None):
+        """
+        :param quality: The desired quality, see `Episode.download()`; downloads may request another one, see `start()`
+        :param max_episodes: The maximum number of episodes to download concurrently
+        :param max_threads: The maximum number of segments to download concurrently across all episodes
+        :param max_threads_per_part: The maximum number of segments to download concurrently for a single video part
+        :param max_merges: The maximum number of ffmpeg processes to run concurrently, capped at the number of CPUs; finished downloads that wait for a merge are merged together, see `MuxPool`
+        :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+        :param resume: Whether to continue interrupted downloads and keep the progress of cancelled ones, see `DownloadJournal`
+        :param streaming: Whether to pipe the segments of each episode directly into ffmpeg instead of writing the parts to temporary files first, see `Episode.stream()`. Streamed downloads can not be resumed.
+        :param max_buffered: The maximum number of segments per episode that are downloaded concurrently or held in memory in streaming mode
+        :param manifest: A manifest to record finished downloads in
+        :param adaptive: Lowers the quality of episodes that would be downloaded from slow hosts
+        :param on_update: A callback that is called (from a worker thread) whenever the state of a job changes
+        :param container: The container of the files, see `Episode.download()`
+        :param captions: Whether to embed the captions of the episodes as subtitle tracks
+        :param scratch: Where to download the parts to; each download waits until its estimated size fits, see `ScratchSpace`. Defaults to the temporary directory without any checks.
+        :param streams: Keeps the stream urls of the episodes valid until their download starts and resolves the next episodes ahead, see `StreamManager`. Defaults to a new one.
+        """
+        self.quality = quality
+        self.max_threads_per_part = max_threads_per_part
+        self.ffmpeg_executable = ffmpeg_executable
+        self.resume = resume
+        self.streaming = streaming
+        self.max_buffered = max_buffered
+        self.manifest = manifest
+        self.adaptive = adaptive
+        self.on_update = on_update
+        self.container = container
+        self.captions = captions
+        self.scratch = scratch
+        self.streams: StreamManager = streams or StreamManager()
+        """Keeps the stream urls valid"""
+        self.jobs: List[DownloadJob] = []
+        """All jobs that were started so far"""
+        self.feed_error: Optional[BaseException] = None
+        """The exception enumerating the downloads failed with, if any; the jobs started before are not affected"""
+        self.__network_pool = PriorityThreadPool(max_threads)
+        self.__episode_pool = ThreadPoolExecutor(max_workers=max_episodes)
+        self.__mux_pool = MuxPool(max_merges, ffmpeg_executable=ffmpeg_executable, container=container)
+        self.__episode_slots = threading.Semaphore(max_episodes)
+        self.__inflight = threading.Semaphore(max_episodes + max_merges)
+        self.__lock = threading.Lock()
+        self.__unfinished = 0
+        self.__feeding = False
+        self.__all_done = threading.Event()
+        self.__all_done.set()
+        self.__cancelled = False
+        self.__sources: Dict[tuple, DownloadJob] = {}
+        self.__priorities = itertools.count()
+        self.__submitted: Optional[queue.Queue] = None
+
+    def start(self, downloads: Iterable[Tuple], lookahead: Optional[int] = None):
+        """
+        Start downloading episodes in the background. Returns immediately.
+        :param downloads: The episodes to download alongside the file to save each one to and optionally the quality to download it in, in order of priority
+        :param lookahead: The number of episodes to take from `downloads` ahead of their turn, so that their streams are resolved while earlier episodes download; defaults to the prefetch count of `streams`. Pass 0 if taking a download blocks or claims it, e.g. for `QueueWorker.claims()`.
+        """
+        with self.__lock:
+            self.__feeding = True
+            self.__all_done.clear()
+        lookahead = self.streams.prefetch_count if lookahead is None else lookahead
+        threading.Thread(target=self.__feed, args=(downloads, lookahead), daemon=True).start()
+
+    def submit(self, episode: Episode, filename: str, quality: Optional[str] = None) -> DownloadJob:
+        """
+        Queue a single download, e.g. for a caller that adds downloads one by one. Returns immediately; the download
+        starts after the ones submitted before it, and shares the workers with the downloads of `start()`.
+        :param episode: The episode to download
+        :param filename: The file to save the episode to
+        :param quality: The desired quality, see `Episode.download()`; defaults to the quality of the scheduler
+        :return: The job of the download; it is added to `jobs` once it starts
+        """
+        job = DownloadJob(episode, filename, next(self.__priorities), quality or self.quality)
+        self.__emit(job)
+        with self.__lock:
+            cancelled = self.__cancelled
+            if not cancelled:
+                self.__unfinished += 1
+                self.__all_done.clear()
+                if self.__submitted is None:
+                    self.__submitted = queue.Queue()
+                    threading.Thread(target=self.__feed_submitted, args=(self.__submitted,), daemon=True).start()
+                self.__submitted.put(job)
+        if cancelled:
+            job.error = DownloadCancelled()
+            self.__update(job, 'cancelled')
+        return job
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until all downloads are finished.
+        :param timeout: The maximum number of seconds to wait, or None to wait forever
+        :return: True if all downloads are finished, False if the timeout expired
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.__all_done.wait(0.25):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def run(self, downloads: Iterable[Tuple], lookahead: Optional[int] = None) -> List[DownloadJob]:
+        """
+        Download episodes and wait until all of them are finished.
+        :param downloads: The episodes to download alongside the file to save each one to and optionally the quality to download it in, in order of priority
+        :param lookahead: The number of episodes to take from `downloads` ahead of their turn, see `start()`
+        :return: All jobs
+        """
+        self.start(downloads, lookahead)
+        self.wait()
+        return self.jobs
+
+    def cancel_running(self):
+        """
+        Cancel all jobs that are currently downloading or merging. Queued jobs are started afterwards as usual.
+        """
+        with self.__lock:
+            for job in self.jobs:
+                if job.state in ('downloading', 'merging'):
+                    job.cancelled.set()
+
+    def cancel_all(self):
+        """
+        Cancel all running and queued jobs.
+        """
+        with self.__lock:
+            self.__cancelled = True
+            for job in self.jobs:
+                job.cancelled.set()
+
+    def shutdown(self):
+        """
+        Release the worker threads. Call this when the scheduler is not needed anymore.
+        """
+        self.cancel_all()
+        with self.__lock:
+            if self.__submitted is not None:
+                self.__submitted.put(None)
+        self.__episode_pool.shutdown(wait=False)
+        self.__mux_pool.shutdown(wait=False)
+        self.__network_pool.shutdown(wait=False, cancel_futures=True)
+        self.streams.shutdown()
+
+    def __feed(self, downloads: Iterable[Tuple], lookahead: int):
+        downloads = iter(downloads)
+        upcoming = collections.deque()  # the downloads after the current one, taken from the iterable ahead of time
+        try:
+            while True:
+                # The next download is only taken once it can start, so that a source that claims its downloads,
+                # like `QueueWorker.claims()`, does not hand out more than this scheduler works on
+                self.__inflight.acquire()
+                self.__episode_slots.acquire()
+                job = None
+                try:
+                    if not upcoming:
+                        upcoming.extend(itertools.islice(downloads, 1))
+                    with self.__lock:
+                        if upcoming and not self.__cancelled:
+                            episode, filename, *quality = upcoming.popleft()
+                            job = DownloadJob(episode, filename, next(self.__priorities),
+                                              quality[0] if quality else self.quality)
+                            self.jobs.append(job)
+                            self.__unfinished += 1
+                finally:
+                    if job is None:
+                        self.__inflight.release()
+                        self.__episode_slots.release()
+                if job is None:
+                    break
+                self.__emit(job)
+                self.__episode_pool.submit(self.__download, job)
+                # Resolve the episodes of the next downloads while this one runs, just ahead of their turn
+                while len({id(e) for e, *_ in upcoming if e is not episode}) < lookahead:
+                    download = next(downloads, None)
+                    if download is None:
+                        break
+                    upcoming.append(download)
+                self.streams.prefetch({id(e): e for e, *_ in upcoming if e is not episode}.values())
+        except BaseException as e:
+            log.error("Could not enumerate the episodes to download: %s", e)
+            self.feed_error = e
+        finally:
+            with self.__lock:
+                self.__feeding = False
+                if self.__unfinished == 0:
+                    self.__all_done.set()
+
+    def __feed_submitted(self, submitted: queue.Queue):
+        # Starts the jobs of submit() in order, like __feed() the downloads of start()
+        for job in iter(submitted.get, None):
+            self.__inflight.acquire()
+            self.__episode_slots.acquire()
+            with self.__lock:
+                cancelled = self.__cancelled
+                if not cancelled:
+                    self.jobs.append(job)
+            if cancelled:
+                self.__episode_slots.release()
+                self.__finish(job, DownloadCancelled())
+                continue
+            try:
+                self.__episode_pool.submit(self.__download, job)
+            except RuntimeError:  # shut down
+                self.__episode_slots.release()
+                self.__finish(job, DownloadCancelled())
+
+    def __download(self, job: DownloadJob):
+        try:
+            try:
+                if job.cancelled.is_set():
+                    raise DownloadCancelled()
+                self.streams.ensure(job.episode)
+                if self.__deduplicate(job):
+                    log.info("%s is downloaded for %s already, copying it to %s", job.episode, job.copy_of.filename,
+                             job.filename)
+                    self.__update(job, 'copied')
+                    self.__release(job)
+                    return
+                job.quality = job.requested_quality
+                if self.adaptive is not None:
+                    job.quality, job.downgraded = self.adaptive.choose(job.episode, job.requested_quality)
+                self.__update(job, 'downloading')
+                executor = self.__network_pool.with_priority(job.priority)
+                fns = captions = None
+                if not self.streaming or not self.__stream(job, executor):
+                    if self.scratch is not None:
+                        job.scratch = self.scratch.admit(job.episode, job.quality, self.resume, job.cancelled)
+                    fns = job.episode.download_parts(job.quality, executor, self.max_threads_per_part,
+                                                     self.ffmpeg_executable, job.cancelled, self.resume,
+                                                     job.scratch.directory if job.scratch is not None else None)
+                    if self.captions and fns:
+                        captions = job.episode.download_captions(os.path.join(os.path.dirname(fns[0]), 'captions.vtt'))
+            finally:
+                self.__episode_slots.release()
+            if fns is not None:
+                self.__mux_pool.submit(job.episode, fns, job.filename, job.cancelled, captions,
+                                       on_start=lambda: self.__update(job, 'merging')) \
+                    .add_done_callback(lambda future: self.__merged(job, future))
+                return
+            self.__complete(job)
+        except BaseException as e:
+            self.__finish(job, e)
+        else:
+            self.__finish(job, None)
+
+    def __deduplicate(self, job: DownloadJob) -> bool:
+        # Turns the job into a copy of a running job that transfers the same streams, if there is one. This resolves
+        # the streams, so it runs on the episode workers rather than on the thread that feeds the jobs.
+        source = self.__source(job.episode, job.requested_quality)
+        if source is None:
+            return False
+        with self.__lock:
+            primary = self.__sources.setdefault(source, job)
+            if primary is job:
+                return False
+            primary.copies.append((job.filename, job.requested_quality))
+            job.copy_of = primary
+            self.jobs.remove(job)
+            return True
+
+    def __source(self, episode: Episode, quality: str) -> Optional[tuple]:
+        # Identifies the streams a download transfers, so that the same streams are not downloaded twice. Only the
+        # resolution and the path of each stream count: the host depends on the mirror that was picked for the
+        # quality, and the query may hold a signature that changes when the episode is resolved again.
+        try:
+            return episode.lang, episode.id, tuple((s.resolution, urllib.parse.urlsplit(s.url).path)
+                                                   for s in (v.get_stream(quality) for v in episode.get_videos()))
+        except (SpdlError, ValueError, IndexError) as e:
+            log.debug("Could not resolve the streams of %s: %s", episode, e)
+            return None
+
+    def __stream(self, job: DownloadJob, executor: Executor) -> bool:
+        try:
+            job.episode.stream(job.filename, job.quality, executor, self.max_buffered, self.ffmpeg_executable,
+                               job.cancelled, self.container, self.captions)
+        except ValueError as e:
+            log.info("Can not stream %s, downloading its parts instead: %s", job.episode, e)
+            return False
+        return True
+
+    def __merged(self, job: DownloadJob, future: Future):
+        try:
+            future.result()
+            self.__complete(job)
+        except BaseException as e:
+            self.__finish(job, e)
+        else:
+            self.__finish(job, None)
+
+    def __complete(self, job: DownloadJob):
+        # The file is finished at this point; failing copies or manifest updates must not fail (and remove) it
+        self.__forget(job)
+        for filename, _ in job.copies:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+                shutil.copyfile(job.filename, filename)
+            except OSError as e:
+                log.error("Could not copy %s to %s: %s", job.filename, filename, e)
+                remove_files([filename])
+                job.copy_errors[filename] = e
+        if self.manifest is not None:
+            for filename, quality in [(job.filename, job.requested_quality)] + job.copies:
+                if filename in job.copy_errors:
+                    continue
+                try:
+                    self.manifest.record(job.episode, filename, **_describe_download(job, quality))
+                except Exception as e:
+                    log.error("Could not record %s in the manifest: %s", filename, e)
+
+    def __forget(self, job: DownloadJob):
+        # Downloads of the same streams that arrive from now on start a new job
+        with self.__lock:
+            for source, other in list(self.__sources.items()):
+                if other is job:
+                    del self.__sources[source]
+
+    def __finish(self, job: DownloadJob, error: Optional[BaseException]):
+        self.__forget(job)
+        if job.scratch is not None:
+            job.scratch.release()
+        if error is not None and job.state == 'merging':
+            remove_files([job.filename])
+            if not isinstance(error, DownloadCancelled):
+                log.error("Download of %s failed: %s", job.episode, error)
+        job.error = error
+        self.__update(job, 'done' if error is None else 'cancelled' if isinstance(error, DownloadCancelled) else 'failed')
+        self.__release(job)
+
+    def __release(self, job: DownloadJob):
+        # The job does not hold any resources anymore; it is finished or was turned into a copy of another job
+        self.__inflight.release()
+        with self.__lock:
+            self.__unfinished -= 1
+            if self.__unfinished == 0 and not self.__feeding:
+                self.__all_done.set()
+
+    def __update(self, job: DownloadJob, state: str):
+        job.state = state
+        self.__emit(job)
+        if self.on_update is not None:
+            try:
+                self.on_update(job)
+            except Exception as e:
+                log.warning("Download update callback failed: %s", e)
+
+    def __emit(self, job: DownloadJob):
+        _emit_job_event(job, self.__network_pool.queue_depth)
+
+
+def _emit_job_event(job: DownloadJob, queue_depth: int):
+    e = job.episode
+    instrumentation.emit('episode', episode=e.id, title=e.title, season=e.season, number=e.episode_number_in_season,
+                         state=job.state, quality=job.quality, queue_depth=queue_depth,
+                         error=str(job.error) if job.error is not None else None)
+
+
+def _describe_download(job: DownloadJob, quality: str) -> Dict[str, Any]:
+    # The arguments of Manifest.record() for a finished job, besides the episode and the file
+    videos = job.episode.get_videos()
+    return {
+        'quality': quality,
+        'resolution': videos[0].get_stream(job.quality).resolution if videos else None,
+        'duration': sum(v.duration[0] for v in videos if v.duration),
+        'downgraded': job.downgraded,
+        'problems': job.episode.verification.problems if job.episode.verification is not None else None,
+    }
+
+
+class WorkQueue:
+    """
+    A queue of episodes to download that is shared by several processes, possibly on different machines, through a
+    SQLite database. Workers claim episodes with a lease that they renew while downloading; the episodes of workers
+    that crashed or lost their connection are handed out again once their lease expired. Put the database on a file
+    system with working file locks.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        """
+        :param path: The SQLite database file. It is created if it does not exist.
+        :param max_attempts: How often an episode is handed out before it is given up as failed
+        """
+        self.path: str = path
+        """The SQLite database file"""
+        self.max_attempts = max_attempts
+        self.__db = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(filename: str) -> str:
+        """
+        Get the key of a download in the queue.
+        :param filename: The file the episode is saved to
+        """
+        return Manifest.key(filename)
+
+    def add(self, episode: Episode, filename: str, priority: int = 0, quality: str = 'max') -> bool:
+        """
+        Add an episode to the queue. A file that is queued or being downloaded is not added again; one that was
+        downloaded or given up before is queued again.
+        :param episode: The episode
+        :param filename: The file to save the episode to; all workers must be able to write it
+        :param priority: The priority of the episode; lower values are handed out first
+        :param quality: The desired quality, see `Episode.download()`
+        :return: Whether the episode was added
+        """
+        with self.__transaction() as db:
+            row = db.execute("SELECT state FROM jobs WHERE key = ?", (self.key(filename),)).fetchone()
+            if row is not None and row[0] in ('queued', 'leased'):
+                return False
+            db.execute("INSERT OR REPLACE INTO jobs (key, episode, filename, quality, priority, state, attempts, "
+                       "updated) VALUES (?, ?, ?, ?, ?, 'queued', 0, ?)",
+                       (self.key(filename), json.dumps(episode.to_dict()), filename, quality, priority, time.time()))
+            return True
+
+    def claim(self, worker: str, lease: float = 60.) -> Optional[Tuple[str, Episode, str, str]]:
+        """
+        Claim the next episode to download. Episodes whose lease expired are handed out again.
+        :param worker: The name of the claiming worker
+        :param lease: The number of seconds the worker may hold the episode without calling `heartbeat()`
+        :return: The key, the episode, the file to save it to and the desired quality, or None if no episode is available right now
+        """
+        now = time.time()
+        with self.__transaction() as db:
+            db.execute("UPDATE jobs SET state = 'failed', error = 'Lease expired too often', updated = ? "
+                       "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, self.max_attempts))
+            row = db.execute("SELECT key, episode, filename, quality, worker FROM jobs "
+                             "WHERE state = 'queued' OR (state = 'leased' AND lease_until < ?) "
+                             "ORDER BY priority, key LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            key, episode, filename, quality, previous = row
+            if previous is not None and previous != worker:
+                log.info("Reclaiming %s from %s", key, previous)
+            db.execute("UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                       "updated = ? WHERE key = ?", (worker, now + lease, now, key))
+        return key, Episode.from_dict(json.loads(episode)), filename, quality
+
+    def heartbeat(self, key: str, worker: str, lease: float = 60.) -> bool:
+        """
+        Renew the lease of a claimed episode.
+        :param key: The key of the episode
+        :param worker: The name of the worker holding it
+        :param lease: The number of seconds until the lease expires, counted from now
+        :return: Whether the worker still holds the episode; False if its lease had expired and it was handed to another worker
+        """
+        with self.__transaction() as db:
+            return db.execute("UPDATE jobs SET lease_until = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+                              (time.time() + lease, key, worker)).rowcount > 0
+
+    def complete(self, key: str, worker: str, result: Optional[Dict[str, Any]] = None,
+                 error: Optional[str] = None):
+        """
+        Report the result of a claimed episode. Failed episodes are queued again until they were tried `max_attempts` times.
+        :param key: The key of the episode
+        :param worker: The name of the worker holding it
+        :param result: Details of the finished download, e.g. the arguments of `Manifest.record()`
+        :param error: The error the download failed with, or None if it succeeded
+        """
+        with self.__transaction() as db:
+            if error is None:
+                state = 'done'
+            else:
+                row = db.execute("SELECT attempts FROM jobs WHERE key = ?", (key,)).fetchone()
+                state = 'failed' if row is None or row[0] >= self.max_attempts else 'queued'
+            db.execute("UPDATE jobs SET state = ?, result = ?, error = ?, lease_until = NULL, updated = ? "
+                       "WHERE key = ? AND worker = ? AND state = 'leased'",
+                       (state, json.dumps(result) if result is not None else None, error, time.time(), key, worker))
+
+    def release(self, key: str, worker: str):
+        """
+        Give a claimed episode back to the queue without counting the attempt, e.g. because the worker is shutting down.
+        :param key: The key of the episode
+        :param worker: The name of the worker holding it
+        """
+        with self.__transaction() as db:
+            db.execute("UPDATE jobs SET state = 'queued', lease_until = NULL, attempts = attempts - 1, updated = ? "
+                       "WHERE key = ? AND worker = ? AND state = 'leased'", (time.time(), key, worker))
+
+    def counts(self, exclude: Optional[str] = None) -> Dict[str, int]:
+        """
+        Count the episodes in each state: 'queued', 'leased', 'done' and 'failed'.
+        :param exclude: The name of a worker whose leased episodes are not counted
+        """
+        with self.__transaction() as db:
+            if exclude is None:
+                counts = dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            else:
+                counts = dict(db.execute("SELECT state, COUNT(*) FROM jobs WHERE state != 'leased' OR worker != ? "
+                                         "GROUP BY state", (exclude,)).fetchall())
+        return {state: counts.get(state, 0) for state in ('queued', 'leased', 'done', 'failed')}
+
+    def finished(self, since: float = 0.) -> List[Tuple[Episode, str, Dict[str, Any]]]:
+        """
+        Get the episodes that were downloaded successfully.
+        :param since: Only return episodes that finished after this unix timestamp
+        :return: The episode, its file and the result reported by the worker, see `complete()`
+        """
+        with self.__transaction() as db:
+            rows = db.execute("SELECT episode, filename, result, updated FROM jobs WHERE state = 'done' AND updated > ?",
+                              (since,)).fetchall()
+        return [(Episode.from_dict(json.loads(episode)), filename, dict(json.loads(result or '{}'), finished=updated))
+                for episode, filename, result, updated in rows]
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        with self.__lock:
+            db = self.__connection()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def __connection(self):
+        if self.__db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            import sqlite3
+            self.__db = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, episode TEXT NOT NULL, "
+                              "filename TEXT NOT NULL, priority INTEGER NOT NULL, state TEXT NOT NULL, worker TEXT, "
+                              "lease_until REAL, attempts INTEGER NOT NULL, result TEXT, error TEXT, "
+                              "updated REAL NOT NULL, quality TEXT NOT NULL DEFAULT 'max')")
+            columns = [row[1] for row in self.__db.execute("PRAGMA table_info(jobs)")]
+            if 'quality' not in columns:
+                self.__db.execute("ALTER TABLE jobs ADD COLUMN quality TEXT NOT NULL DEFAULT 'max'")
+        return self.__db
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} path={self.path}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class QueueWorker:
+    """
+    Downloads the episodes of a `WorkQueue`: `claims()` feeds claimed episodes into a `DownloadScheduler`, a background
+    thread renews their leases, and `report()` (the scheduler's `on_update` callback) reports their results.
+    """
+
+    def __init__(self, queue: WorkQueue, name: Optional[str] = None, lease: float = 60., poll: float = 5.,
+                 on_update: Optional[Callable[[DownloadJob], None]] = None):
+        """
+        :param queue: The queue
+        :param name: The name of the worker, unique across all machines; defaults to the host name and process id
+        :param lease: The number of seconds a lease lasts; it is renewed every third of that
+        :param poll: How many seconds to wait before looking for work again while other workers hold the remaining episodes
+        :param on_update: Another callback to call from `report()`
+        """
+        self.queue: WorkQueue = queue
+        import socket
+        self.name: str = name or f"{socket.gethostname()}-{os.getpid()}"
+        """The name of the worker"""
+        self.lease = lease
+        self.poll = poll
+        self.on_update = on_update
+        self.__held: Dict[str, Optional[DownloadJob]] = {}
+        self.__lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__heartbeat = threading.Thread(target=self.__beat, daemon=True)
+        self.__heartbeat.start()
+
+    def claims(self) -> Iterable[Tuple[Episode, str, str]]:
+        """
+        Claim episodes from the queue until it is empty, e.g. as the downloads of `DownloadScheduler.start()` with a
+        lookahead of 0. While other workers hold the remaining episodes, this waits in case their leases expire.
+        :return: An iterator of the claimed episodes alongside the file to save each one to and the desired quality
+        """
+        while not self.__closed.is_set():
+            claimed = self.queue.claim(self.name, self.lease)
+            if claimed is None:
+                counts = self.queue.counts(exclude=self.name)
+                if counts['queued'] + counts['leased'] == 0:
+                    return
+                self.__closed.wait(self.poll)
+                continue
+            key, episode, filename, quality = claimed
+            with self.__lock:
+                self.__held[key] = None
+            yield episode, filename, quality
+
+    def report(self, job: DownloadJob):
+        """
+        Track a job and report its result to the queue once it finished. Pass this as `on_update` to the scheduler.
+        :param job: The job whose state changed
+        """
+        key = self.queue.key(job.filename)
+        with self.__lock:
+            if key not in self.__held:
+                return
+            if job.state == 'copied':
+                # The job that transfers the same streams renews the lease of this file and reports its result
+                self.__held[key] = job.copy_of
+                keys, started = [], False
+            else:
+                # Claimed files that the scheduler added to this job as copies share its result and its lease renewals
+                keys = [(key, job.filename, job.requested_quality)] + [(self.queue.key(filename), filename, quality)
+                                                                        for filename, quality in job.copies]
+                keys = [(k, filename, quality) for k, filename, quality in keys if k in self.__held]
+                started = self.__held[key] is None
+                for k, _, _ in keys:
+                    if job.state in ('done', 'failed', 'cancelled'):
+                        del self.__held[k]
+                    else:
+                        self.__held[k] = job
+        if started and job.state not in ('done', 'failed', 'cancelled') \
+                and not self.queue.heartbeat(key, self.name, self.lease):
+            # The lease was not renewed while the episode waited for its turn, and it expired
+            log.warning("Lost the lease of %s to another worker", key)
+            with self.__lock:
+                self.__held.pop(key, None)
+            job.cancelled.set()
+            return
+        for k, filename, quality in keys:
+            if job.state == 'done' and filename in job.copy_errors:
+                self.queue.complete(k, self.name, error=str(job.copy_errors[filename]))
+            elif job.state == 'done':
+                self.queue.complete(k, self.name, _describe_download(job, quality))
+            elif job.state == 'failed':
+                self.queue.complete(k, self.name, error=str(job.error))
+            elif job.state == 'cancelled':
+                self.queue.release(k, self.name)
+        if self.on_update is not None:
+            self.on_update(job)
+
+    def close(self):
+        """
+        Stop claiming episodes and renewing leases, and give the episodes that were not finished back to the queue.
+        """
+        self.__closed.set()
+        self.__heartbeat.join()
+        with self.__lock:
+            held = list(self.__held)
+            self.__held.clear()
+        for key in held:
+            self.queue.release(key, self.name)
+
+    def __beat(self):
+        import sqlite3
+        while not self.__closed.wait(self.lease / 3):
+            # Only the leases of started downloads are renewed; an episode that waits for its turn longer than its
+            # lease goes back to the queue for other workers
+            with self.__lock:
+                held = [(key, job) for key, job in self.__held.items() if job is not None]
+            for key, job in held:
+                try:
+                    if not self.queue.heartbeat(key, self.name, self.lease):
+                        log.warning("Lost the lease of %s to another worker", key)
+                        with self.__lock:
+                            self.__held.pop(key, None)
+                        if key == self.queue.key(job.filename):
+                            job.cancelled.set()
+                except sqlite3.Error as e:
+                    log.warning("Could not renew the lease of %s: %s", key, e)
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} name={self.name} held={len(self.__held)}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class DownloadProgress(object):
+    def __init__(self, episode: Episode, filename: str):
+        self.episode: Episode = episode
+        """The episode that is downloaded"""
+        self.filename: str = filename
+        """The file the episode is saved to"""
+        self.state: str = 'queued'
+        """The state of the download: 'queued', 'downloading', 'merging', 'done', 'failed' or 'cancelled', or 'copied' while another download transfers the same streams"""
+        self.segments: int = 0
+        """The number of downloaded segments, including those downloaded by an earlier, interrupted download"""
+        self.total_segments: int = 0
+        """The number of segments of the parts that were started so far"""
+        self.bytes: int = 0
+        """The number of bytes downloaded by this download"""
+        self.merged: float = 0.
+        """The duration of the video ffmpeg has written so far, in seconds"""
+        self.error: Optional[BaseException] = None
+        """The exception the download failed with, if any"""
+
+    @property
+    def fraction(self) -> float:
+        """The fraction of the segments of the started parts that are downloaded, between 0 and 1"""
+        return self.segments / self.total_segments if self.total_segments else 0.
+
+    def update(self, event: Dict[str, Any]):
+        """
+        Apply an instrumentation event of the episode (see `EventSink`).
+        :param event: The event
+        """
+        kind = event['event']
+        if kind == 'segment':
+            self.segments += 1
+            self.bytes += event['bytes']
+        elif kind == 'part' and event['state'] in ('started', 'skipped') and event.get('segments'):
+            self.total_segments += event['segments']
+            self.segments += event['segments'] if event['state'] == 'skipped' else event.get('done', 0)
+        elif kind == 'ffmpeg' and event.get('out_time') is not None:
+            self.merged = event['out_time']
+        elif kind == 'episode':
+            self.state = event['state']
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} episode={self.episode} state={self.state} segments={self.segments}/{self.total_segments}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class AsyncSouthPark:
+    """
+    An asyncio interface to South Park. The blocking work runs on bounded thread pools that are shared by all calls,
+    so an event loop can drive hundreds of concurrent resolutions and downloads without a thread per call: video
+    resolution chains its requests without blocking a worker, and downloads are submitted to a `DownloadScheduler`.
+    """
+
+    def __init__(self, lang: str = 'en', max_requests: int = 16, max_episodes: int = 2, max_threads: int = 8,
+                 max_threads_per_part: int = 4, max_merges: int = 1, ffmpeg_executable: Optional[str] = None,
+                 resume: bool = True, streaming: bool = False, max_buffered: int = 16, container: Optional[str] = None,
+                 captions: bool = False, scratch: Optional[ScratchSpace] = None, manifest: Optional[Manifest] = None,
+                 adaptive: Optional[AdaptiveQuality] = None, streams: Optional[StreamManager] = None):
+        """
+        :param lang: The language, see `SouthPark`
+        :param max_requests: The maximum number of concurrent metadata requests
+        :param max_episodes: The maximum number of episodes to download concurrently
+        :param max_threads: The maximum number of segments to download concurrently across all episodes
+        :param max_threads_per_part: The maximum number of segments to download concurrently for a single video part
+        :param max_merges: The maximum number of ffmpeg processes to run concurrently, see `MuxPool`
+        :param ffmpeg_executable: The path to the ffmpeg executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+        :param resume: Whether to continue interrupted downloads and keep the progress of cancelled ones, see `DownloadJournal`
+        :param streaming: Whether to pipe the segments directly into ffmpeg instead of writing the parts to temporary files first, see `Episode.stream()`
+        :param max_buffered: The maximum number of segments per episode that are downloaded concurrently or held in memory in streaming mode
+        :param container: The container of the files, see `Episode.download()`
+        :param captions: Whether to embed the captions of the episodes as subtitle tracks
+        :param scratch: Where to download the parts to, see `DownloadScheduler`
+        :param manifest: A manifest to record finished downloads in
+        :param adaptive: Lowers the quality of episodes that would be downloaded from slow hosts
+        :param streams: Keeps the stream urls of the episodes valid until their download starts, see `StreamManager`
+        """
+        self.southpark: SouthPark = SouthPark(lang)
+        """The blocking interface the requests are performed with"""
+        self.max_requests = max_requests
+        self.scheduler: DownloadScheduler = DownloadScheduler(
+            max_episodes=max_episodes, max_threads=max_threads, max_threads_per_part=max_threads_per_part,
+            max_merges=max_merges, ffmpeg_executable=ffmpeg_executable, resume=resume, streaming=streaming,
+            max_buffered=max_buffered, manifest=manifest, adaptive=adaptive, on_update=self.__on_update,
+            container=container, captions=captions, scratch=scratch, streams=streams)
+        """The scheduler the downloads run on"""
+        self.__metadata_pool = ThreadPoolExecutor(max_workers=max_requests)
+        self.__waiters: Dict[DownloadJob, List[Callable[[DownloadJob], None]]] = {}
+        self.__lock = threading.Lock()
+
+    async def get_season_numbers(self) -> List[int]:
+        """
+        Get a list of all season numbers of the current language, see `SouthPark.get_season_numbers()`.
+        """
+        return await self.__run(self.southpark.get_season_numbers)
+
+    async def get_season(self, season: int) -> Season:
+        """
+        Get a single season, see `SouthPark.get_season()`.
+        :param season: The Season's number (as int)
+        """
+        return await self.__run(self.southpark.get_season, season)
+
+    async def get_seasons(self, seasons: Iterable[int]) -> List[Season]:
+        """
+        Get multiple seasons concurrently.
+        :param seasons: The numbers of the seasons to get
+        :return: A list containing a Season object for each season, in the given order
+        """
+        import asyncio
+        return list(await asyncio.gather(*(self.get_season(s) for s in seasons)))
+
+    async def select_episodes(self, selector: str) -> List[Episode]:
+        """
+        Select episodes with a selector string, see `select_episodes()`.
+        :param selector: The selector, e.g. 'all', 'S01', 'S01E02', 'S01-S07' or 'S01,S02-S04,S05E01-S05E04'
+        :return: The selected episodes, sorted and without duplicates
+        """
+        return await self.__run(select_episodes, self.southpark, selector, self.max_requests)
+
+    async def get_videos(self, episode: Episode, streams: bool = True) -> List[Video]:
+        """
+        Fetch the videos (and their streams) of an episode, see `Episode.resolve()`. Afterwards, the blocking
+        `Episode.get_videos()` and `Video.get_streams()` return without network requests.
+        :param episode: The episode
+        :param streams: Whether to fetch the streams of each video, too
+        :return: The videos of the episode
+        """
+        import asyncio
+        return await asyncio.wrap_future(episode.resolve(self.__metadata_pool, streams))
+
+    async def resolve_episodes(self, episodes: Iterable[Episode], streams: bool = True) -> List[Episode]:
+        """
+        Fetch the videos and streams of many episodes concurrently, like `resolve_episodes()`. Episodes that fail to
+        resolve are logged and left unresolved.
+        :param episodes: The episodes to resolve
+        :param streams: Whether to fetch the streams of each video, too
+        :return: The episodes
+        """
+        episodes = list(episodes)
+        import asyncio
+        results = await asyncio.gather(*(self.get_videos(e, streams) for e in episodes), return_exceptions=True)
+        for e, result in zip(episodes, results):
+            if isinstance(result, Exception):
+                log.warning("Could not resolve the videos of %s: %s", e, result)
+        return episodes
+
+    async def download(self, episode: Episode, filename: Optional[str] = None,
+                       quality: str = 'max') -> AsyncIterator[DownloadProgress]:
+        """
+        Download an episode and yield its progress, whenever it changed. The same `DownloadProgress` object is
+        yielded every time; the last one has the state 'done'. Downloads are served in the order they were started.
+        Cancelling the consuming task (or leaving the loop early) cancels the download: ffmpeg is stopped and the
+        partial output file is removed, while the downloaded segments are kept for resuming if `resume` is enabled.
+        A download of the same streams as a running one (see `DownloadScheduler`) waits for that one and receives a
+        copy of its file, even if it is cancelled meanwhile.
+        :param episode: The episode to download
+        :param filename: The file to save the download to, see `Episode.download()`
+        :param quality: The desired quality, see `Episode.download()`
+        :return: An async generator of the progress
+        :raise SpdlError: If the download failed
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        progress = DownloadProgress(episode, episode.get_filename(filename))
+        updates = asyncio.Queue()
+        done = loop.create_future()
+
+        def on_event(event: Dict[str, Any]):
+            if event.get('episode') == episode.id:
+                loop.call_soon_threadsafe(updates.put_nowait, event)
+
+        def on_finished(finished: DownloadJob):
+            if finished.state == 'copied':
+                # The file is written by the job that transfers the same streams
+                self.__when_finished(finished.copy_of, on_finished)
+            else:
+                loop.call_soon_threadsafe(lambda: done.done() or done.set_result(finished))
+
+        instrumentation.add_sink(on_event)
+        update = None
+        job = self.scheduler.submit(episode, progress.filename, quality)
+        self.__when_finished(job, on_finished)
+        try:
+            yield progress
+            while not done.done():
+                update = asyncio.ensure_future(updates.get())
+                await asyncio.wait((done, update), return_when=asyncio.FIRST_COMPLETED)
+                if update.done():
+                    progress.update(update.result())
+                while not updates.empty():
+                    progress.update(updates.get_nowait())
+                if not done.done():
+                    yield progress
+            finished = done.result()
+            progress.state, progress.error = finished.state, finished.error
+            if finished.state == 'done' and progress.filename in finished.copy_errors:
+                progress.state, progress.error = 'failed', finished.copy_errors[progress.filename]
+            if progress.error is not None:
+                raise progress.error
+            yield progress
+        finally:
+            if update is not None:
+                update.cancel()
+            instrumentation.remove_sink(on_event)
+            job.cancelled.set()
+
+    async def close(self):
+        """
+        Cancel all running downloads and release the worker threads.
+        """
+        self.__metadata_pool.shutdown(wait=False)
+        self.scheduler.shutdown()
+
+    async def __aenter__(self) -> 'AsyncSouthPark':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def __run(self, fn, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self.__metadata_pool, fn, *args)
+
+    def __when_finished(self, job: DownloadJob, callback: Callable[[DownloadJob], None]):
+        # Calls the callback (on any thread) once the job reached a final state
+        with self.__lock:
+            self.__waiters.setdefault(job, []).append(callback)
+        if job.state in ('done', 'failed', 'cancelled', 'copied'):
+            self.__on_update(job)
+
+    def __on_update(self, job: DownloadJob):
+        if job.state not in ('done', 'failed', 'cancelled', 'copied'):
+            return
+        with self.__lock:
+            callbacks = self.__waiters.pop(job, [])
+        for callback in callbacks:
+            callback(job)
+
+
+class HTTPResponse(object):
+    def __init__(self, url: str, status: int, headers: Dict[str, str], body: bytes, latency: float = 0.,
+                 elapsed: float = 0., retries: int = 0):
+        self.url: str = url
+        """The url the response was received from, after following redirects"""
+        self.status: int = status
+        """The HTTP status code"""
+        self.headers: Dict[str, str] = headers
+        """The response headers, with lower case names"""
+        self.body: bytes = body
+        """The response body"""
+        self.latency: float = latency
+        """The time from sending the request until the response headers arrived, in seconds"""
+        self.elapsed: float = elapsed
+        """The time from sending the request until the whole body was received, in seconds"""
+        self.retries: int = retries
+        """The number of times the request was retried before this response was received"""
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} status={self.status} url=\"{self.url}\">"
+
+    def __repr__(self):
+        return str(self)
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket. Tokens are refilled continuously at a fixed rate up to the bucket's capacity;
+    consuming more tokens than available blocks until the bucket has refilled.
+    """
+
+    def __init__(self, rate: Optional[float], capacity: Optional[float] = None):
+        """
+        :param rate: The number of tokens added per second, or None for an unlimited bucket
+        :param capacity: The maximum number of tokens in the bucket (the allowed burst); defaults to one second worth of tokens
+        """
+        self.__cond = threading.Condition()
+        self.__rate = None
+        self.__capacity = 0.
+        self.__tokens = 0.
+        self.__last = time.monotonic()
+        self.set_rate(rate, capacity)
+
+    @property
+    def rate(self) -> Optional[float]:
+        """The number of tokens added per second, or None if the bucket is unlimited"""
+        return self.__rate
+
+    def set_rate(self, rate: Optional[float], capacity: Optional[float] = None):
+        """
+        Change the rate of the bucket. Consumers that are currently waiting pick up the new rate immediately.
+        :param rate: The number of tokens added per second, or None (or 0) for an unlimited bucket
+        :param capacity: The maximum number of tokens in the bucket; defaults to one second worth of tokens
+        """
+        with self.__cond:
+            self.__refill()
+            self.__rate = rate or None
+            self.__capacity = capacity or max(rate or 0, 1)
+            self.__tokens = min(self.__tokens, self.__capacity) if rate else 0.
+            self.__cond.notify_all()
+
+    def consume(self, amount: float):
+        """
+        Take tokens from the bucket, waiting until enough tokens are available. Amounts larger than the capacity are
+        allowed; they put the bucket into debt that is paid off before the next consumer may proceed.
+        :param amount: The number of tokens to take
+        """
+        with self.__cond:
+            while self.__rate is not None:
+                self.__refill()
+                needed = min(amount, self.__capacity)
+                if self.__tokens >= needed:
+                    self.__tokens -= amount
+                    return
+                self.__cond.wait((needed - self.__tokens) / self.__rate)
+
+    def __refill(self):
+        now = time.monotonic()
+        if self.__rate is not None:
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last) * self.__rate)
+        self.__last = now
+
+
+class RateLimiter:
+    """
+    Limits the bandwidth of all requests of an `HTTPClient` (bytes per second, across all hosts) and the number of
+    requests per second to each host. The limits can be changed at any time, e.g. through a control file.
+    """
+
+    def __init__(self, bytes_per_second: Optional[float] = None, requests_per_second: Optional[float] = None):
+        """
+        :param bytes_per_second: The maximum number of bytes to download per second, or None for no limit
+        :param requests_per_second: The maximum number of requests to send to each host per second, or None for no limit
+        """
+        self.__bytes = TokenBucket(bytes_per_second)
+        self.__requests_per_second = requests_per_second
+        self.__hosts: Dict[str, TokenBucket] = {}
+        self.__lock = threading.Lock()
+        self.__control_file = None
+        self.__control_mtime = None
+
+    @property
+    def bytes_per_second(self) -> Optional[float]:
+        """The maximum number of bytes to download per second, or None for no limit"""
+        return self.__bytes.rate
+
+    @property
+    def requests_per_second(self) -> Optional[float]:
+        """The maximum number of requests to send to each host per second, or None for no limit"""
+        return self.__requests_per_second
+
+    def set_limits(self, bytes_per_second: Optional[float] = None, requests_per_second: Optional[float] = None):
+        """
+        Change the limits. Requests that are currently waiting pick up the new limits immediately.
+        :param bytes_per_second: The maximum number of bytes to download per second, or None for no limit
+        :param requests_per_second: The maximum number of requests to send to each host per second, or None for no limit
+        """
+        self.__bytes.set_rate(bytes_per_second)
+        with self.__lock:
+            self.__requests_per_second = requests_per_second
+            for bucket in self.__hosts.values():
+                bucket.set_rate(requests_per_second)
+        log.info("Rate limits: %s bytes/s, %s requests/s per host", bytes_per_second or 'unlimited',
+                 requests_per_second or 'unlimited')
+
+    def acquire_request(self, host: str):
+        """
+        Wait until a request to a host is allowed.
+        :param host: The host name
+        """
+        with self.__lock:
+            bucket = self.__hosts.get(host)
+            if bucket is None:
+                bucket = self.__hosts[host] = TokenBucket(self.__requests_per_second)
+        bucket.consume(1)
+
+    def consume_bytes(self, amount: int):
+        """
+        Wait until downloading the given number of bytes is allowed.
+        :param amount: The number of bytes
+        """
+        self.__bytes.consume(amount)
+
+    def watch(self, control_file: str, interval: float = 5.):
+        """
+        Apply the limits from a control file now and whenever it changes. The file contains lines like 'rate=2M'
+        (bytes per second; suffixes k, M and G are supported) and 'requests=10' (requests per second per host);
+        missing or empty values mean no limit.
+        :param control_file: The control file
+        :param interval: How often to check the file for changes, in seconds
+        """
+        self.__control_file = control_file
+        self.reload()
+
+        def poll():
+            while self.__control_file == control_file:
+                time.sleep(interval)
+                try:
+                    mtime = os.stat(control_file).st_mtime
+                except OSError:
+                    continue
+                if mtime != self.__control_mtime:
+                    self.reload()
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def reload(self):
+        """
+        Apply the limits from the control file set by `watch()` immediately.
+        """
+        if self.__control_file is None:
+            return
+        try:
+            self.__control_mtime = os.stat(self.__control_file).st_mtime
+            with open(self.__control_file, 'r', encoding='utf-8') as f:
+                values = dict(line.split('=', 1) for line in map(str.strip, f) if '=' in line and not line.startswith('#'))
+            self.set_limits(parse_size(values.get('rate', '').strip()) or None,
+                            float(values.get('requests', '').strip() or 0) or None)
+        except (OSError, ValueError) as e:
+            log.warning("Could not read the rate control file %s: %s", self.__control_file, e)
+
+
+class HTTPClient:
+    """
+    A thread-safe HTTP client that keeps persistent connections per host and retries failed requests with
+    exponential backoff. All network requests of this module go through the client in `http_client`.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    CHUNK_SIZE = 64 * 1024
+    REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout: float = 30., retries: int = 3, backoff: float = 0.5, max_backoff: float = 30.,
+                 max_idle_per_host: int = 16, max_redirects: int = 5):
+        """
+        :param timeout: The timeout for connecting and for each read, in seconds
+        :param retries: How often to retry a request that failed due to a timeout, a connection error or a 5xx/429 response
+        :param backoff: The base delay between retries in seconds; it doubles with every retry and is randomized (jitter)
+        :param max_backoff: The maximum delay between retries in seconds
+        :param max_idle_per_host: The maximum number of idle connections to keep open per host
+        :param max_redirects: The maximum number of redirects to follow
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_idle_per_host = max_idle_per_host
+        self.max_redirects = max_redirects
+        self.headers: Dict[str, str] = {
+            'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:78.0) Gecko/20100101 Firefox/78.0',
+            'Accept-Encoding': 'gzip',
+        }
+        """Headers that are sent with every request"""
+        self.rate_limiter: Optional[RateLimiter] = None
+        """Limits the bandwidth and request rate of the client, if set"""
+        self.host_overrides: Dict[str, str] = {}
+        """Connect to another server for some hosts, e.g. {'southpark.cc.com': 'http://127.0.0.1:8000'}. The key '*' matches all hosts. The request path and the Host header are not changed, so the server can tell the original hosts apart."""
+        self.__idle: Dict[Tuple[str, str, int], List['http.client.HTTPConnection']] = {}
+        self.__lock = threading.Lock()
+        self.__ssl_context = None
+
+    def get(self, url: str, headers: Optional[Dict[str, str]] = None) -> bytes:
+        """
+        Perform a GET request and return the response body.
+        :param url: The url to fetch
+        :param headers: Additional request headers
+        :return: The response body, as bytes
+        :raise HTTPError: If the server responded with an error status
+        :raise NetworkError: If the request failed after all retries
+        """
+        return self.request(url, headers).body
+
+    def request(self, url: str, headers: Optional[Dict[str, str]] = None) -> HTTPResponse:
+        """
+        Perform a GET request, following redirects and retrying on temporary errors.
+        :param url: The url to fetch
+        :param headers: Additional request headers
+        :return: The response; responses with status 304 (Not Modified) are returned, too
+        :raise HTTPError: If the server responded with an error status
+        :raise NetworkError: If the request failed after all retries
+        """
+        import http.client
+        attempt = 0
+        redirects = 0
+        while True:
+            try:
+                resp = self.__request_once(url, headers)
+            except (OSError, http.client.HTTPException) as e:
+                error = NetworkError(f"Request to {url} failed: {e}", url)
+                retry_after = None
+            else:
+                if resp.status in self.REDIRECT_STATUS and 'location' in resp.headers:
+                    redirects += 1
+                    if redirects > self.max_redirects:
+                        raise HTTPError(f"Too many redirects for {url}", url, resp.status)
+                    url = urllib.parse.urljoin(url, resp.headers['location'])
+                    continue
+                if resp.status < 400 or resp.status == 304:
+                    resp.retries = attempt
+                    return resp
+                error = HTTPError(f"HTTP {resp.status} for {url}", url, resp.status)
+                if resp.status not in self.RETRY_STATUS:
+                    raise error
+                retry_after = resp.headers.get('retry-after')
+            if attempt >= self.retries:
+                raise error
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, min(self.max_backoff, int(retry_after)))
+            attempt += 1
+            log.debug("%s; retrying in %.1fs (attempt %s of %s)", error, delay, attempt, self.retries)
+            instrumentation.emit('retry', url=url, attempt=attempt, delay=delay, error=str(error))
+            time.sleep(delay)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def __request_once(self, url: str, headers: Optional[Dict[str, str]]) -> HTTPResponse:
+        import http.client
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise NetworkError(f"Unsupported url: {url}", url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        all_headers = dict(self.headers, **(headers or {}))
+        override = self.host_overrides.get(parts.hostname) or self.host_overrides.get('*')
+        if override is not None:
+            target = urllib.parse.urlsplit(override)
+            key = (target.scheme, target.hostname, target.port or (443 if target.scheme == 'https' else 80))
+            all_headers['Host'] = parts.netloc
+        limiter = self.rate_limiter
+        if limiter is not None:
+            limiter.acquire_request(parts.hostname)
+
+        conn, reused = self.__acquire(key)
+        started = time.monotonic()
+        try:
+            try:
+                conn.request('GET', path, headers=all_headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if not reused:
+                    raise
+                # The server closed the idle connection in the meantime; retry once on a fresh one
+                conn.close()
+                conn, reused = self.__connect(key), False
+                conn.request('GET', path, headers=all_headers)
+                resp = conn.getresponse()
+            latency = time.monotonic() - started
+            if limiter is None:
+                body = resp.read()
+            else:
+                chunks = []
+                for chunk in iter(lambda: resp.read(self.CHUNK_SIZE), b''):
+                    limiter.consume_bytes(len(chunk))
+                    chunks.append(chunk)
+                body = b''.join(chunks)
+        except BaseException:
+            conn.close()
+            raise
+
+        resp_headers = {k.lower(): v for k, v in resp.getheaders()}
+        # The body is read completely, so the connection can be reused before it is decoded
+        if resp.will_close:
+            conn.close()
+        else:
+            self.__release(key, conn)
+        if resp_headers.get('content-encoding') == 'gzip':
+            import gzip
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError, zlib.error) as e:
+                raise NetworkError(f"Could not decompress the response of {url}: {e}", url)
+        return HTTPResponse(url, resp.status, resp_headers, body, latency, time.monotonic() - started)
+
+    def __acquire(self, key: Tuple[str, str, int]) -> Tuple['http.client.HTTPConnection', bool]:
+        with self.__lock:
+            conns = self.__idle.get(key)
+            if conns:
+                return conns.pop(), True
+        return self.__connect(key), False
+
+    def __release(self, key: Tuple[str, str, int], conn: 'http.client.HTTPConnection'):
+        with self.__lock:
+            conns = self.__idle.setdefault(key, [])
+            if len(conns) < self.max_idle_per_host:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def __connect(self, key: Tuple[str, str, int]) -> 'http.client.HTTPConnection':
+        import http.client
+        scheme, host, port = key
+        if scheme == 'https':
+            import ssl
+            if self.__ssl_context is None:
+                self.__ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout, context=self.__ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+
+class OfflineError(NetworkError):
+    """Raised in offline mode when a url is not in the metadata cache."""
+
+
+class MetadataCache:
+    """
+    A persistent SQLite cache for metadata requests (season feeds, mediagen feeds, playlists), keyed by url and
+    language. Every kind of metadata has its own time to live; stale entries are revalidated with the server using
+    their ETag or Last-Modified header, so unchanged responses are not downloaded again. Entries whose url or content
+    carries signed urls (see `url_expiry()`) are only fresh until shortly before the first of them expires, and are
+    fetched again in full afterwards.
+    """
+
+    DEFAULT_TTLS = {
+        'season_numbers': 24 * 3600,
+        'season': 6 * 3600,
+        'feed': 7 * 24 * 3600,
+        'mediagen': 3600,
+        'playlist': 600,
+    }
+    """The default time to live of each kind of metadata, in seconds"""
+
+    def __init__(self, path: Optional[str] = None, ttls: Optional[Dict[str, float]] = None, offline: bool = False,
+                 refresh: bool = False, margin: float = 300.):
+        """
+        :param path: The SQLite database file. Defaults to 'metadata.sqlite' in the user's cache directory.
+        :param ttls: Time to live overrides per kind of metadata, in seconds, see `DEFAULT_TTLS`
+        :param offline: Never perform network requests; serve stale entries and raise `OfflineError` on misses
+        :param refresh: Revalidate every entry with the server regardless of its age
+        :param margin: The number of seconds before the signed urls of an entry expire that it becomes stale
+        """
+        self.path: str = path or os.path.join(get_cache_dir(), 'metadata.sqlite')
+        """The SQLite database file"""
+        self.ttls: Dict[str, float] = dict(self.DEFAULT_TTLS, **(ttls or {}))
+        """The time to live of each kind of metadata, in seconds"""
+        self.offline: bool = offline
+        """Whether to never perform network requests"""
+        self.refresh: bool = refresh
+        """Whether to revalidate every entry regardless of its age"""
+        self.margin: float = margin
+        """The number of seconds before the signed urls of an entry expire that it becomes stale"""
+        self.__db = None
+        self.__lock = threading.Lock()
+
+    def get(self, url: str, kind: str, lang: str = '') -> bytes:
+        """
+        Get the response body for a url, from the cache if possible.
+        :param url: The url to fetch
+        :param kind: The kind of metadata, which determines the time to live; one of the keys of `ttls`
+        :param lang: The language the metadata is requested for
+        :return: The response body
+        :raise OfflineError: If the url is not cached and the cache is in offline mode
+        :raise NetworkError: If the request failed
+        """
+        row = self.__query("SELECT body, etag, last_modified, fetched, expires FROM responses WHERE url = ? AND lang = ?",
+                           (url, lang))
+        expired = False
+        if row is not None:
+            body, etag, last_modified, fetched, expires = row
+            now = time.time()
+            expired = expires is not None and now >= expires - self.margin
+            if self.offline or (not self.refresh and not expired and now - fetched < self.ttls.get(kind, 0)):
+                return body
+        elif self.offline:
+            raise OfflineError(f"{url} is not cached (offline mode)", url)
+
+        # Expired signed urls are not revalidated, since the server would confirm the old urls
+        headers = {}
+        if row is not None and etag and not expired:
+            headers['If-None-Match'] = etag
+        if row is not None and last_modified and not expired:
+            headers['If-Modified-Since'] = last_modified
+        resp = http_client.request(url, headers)
+        if resp.status == 304 and row is not None:
+            log.debug("Revalidated cached %s: %s", kind, url)
+            self.__execute("UPDATE responses SET fetched = ? WHERE url = ? AND lang = ?", (time.time(), url, lang))
+            return body
+        expiries = [e for e in (url_expiry(url), content_expiry(resp.body)) if e is not None]
+        self.__execute("INSERT OR REPLACE INTO responses (url, lang, kind, body, etag, last_modified, fetched, expires) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (url, lang, kind, resp.body, resp.headers.get('etag'), resp.headers.get('last-modified'),
+                        time.time(), min(expiries, default=None)))
+        return resp.body
+
+    def invalidate(self, url: str, lang: str = ''):
+        """
+        Remove a url from the cache.
+        :param url: The url to remove
+        :param lang: The language the url was cached for
+        """
+        self.__execute("DELETE FROM responses WHERE url = ? AND lang = ?", (url, lang))
+
+    def clear(self, kind: Optional[str] = None):
+        """
+        Remove all entries, or all entries of one kind, from the cache.
+        :param kind: The kind of metadata to remove, or None to remove everything
+        """
+        if kind is None:
+            self.__execute("DELETE FROM responses", ())
         else:
-            url = f"https://southpark.cc.com/feeds/carousel/video/06bb4aa7-9917-4b6a-ae93-5ed7be79556a/30/1/json/!airdate/season-{season}?lang={self.lang}"
+            self.__execute("DELETE FROM responses WHERE kind = ?", (kind,))
+
+    def close(self):
+        """
+        Close the database connection.
+        """
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+    def __query(self, sql: str, params: tuple) -> Optional[tuple]:
+        with self.__lock:
+            return self.__connection().execute(sql, params).fetchone()
+
+    def __execute(self, sql: str, params: tuple):
+        with self.__lock:
+            db = self.__connection()
+            db.execute(sql, params)
+            db.commit()
+
+    def __connection(self):
+        if self.__db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            import sqlite3
+            self.__db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT NOT NULL, lang TEXT NOT NULL, "
+                              "kind TEXT NOT NULL, body BLOB NOT NULL, etag TEXT, last_modified TEXT, "
+                              "fetched REAL NOT NULL, expires REAL, PRIMARY KEY (url, lang))")
+            columns = [row[1] for row in self.__db.execute("PRAGMA table_info(responses)")]
+            if 'expires' not in columns:
+                self.__db.execute("ALTER TABLE responses ADD COLUMN expires REAL")
+            self.__db.commit()
+        return self.__db
+
+
+class EventSink:
+    """
+    The base class of instrumentation sinks. A sink is called with every event that is emitted by `Instrumentation`;
+    events are dicts with at least the keys 'event' (the kind of event) and 'time' (a unix timestamp). Sinks are
+    called from the worker threads, so they have to be thread-safe.
+
+    The kinds of events are:
+     * 'segment': A segment was fetched (host, rendition, sequence, bytes, latency, elapsed, retries, episode, part)
+     * 'part': A video part was 'started', 'skipped' (downloaded before) or is 'done' (episode, part, segments, done, duration)
+     * 'episode': The state of a `DownloadJob` changed (episode, title, season, number, state, quality, queue_depth, error)
+     * 'phase': A phase of the work is finished (phase: 'resolve', 'transfer', 'stream' or 'merge', duration, failed, episode)
+     * 'retry': A request failed and is retried (url, attempt, delay, error)
+     * 'ffmpeg': An ffmpeg process reported its progress (episode, out_time, total_size, speed)
+    """
+
+    def __call__(self, event: Dict[str, Any]):
+        pass
+
+    def close(self):
+        """
+        Flush and release the sink. It does not receive events afterwards.
+        """
+
+
+class Instrumentation:
+    """
+    Distributes instrumentation events (see `EventSink`) to any number of sinks. Emitting an event is a no-op while
+    no sinks are registered. All events of this module go through the instance in `instrumentation`.
+    """
+
+    def __init__(self):
+        self.sinks: List[Callable[[Dict[str, Any]], None]] = []
+        """The registered sinks; any callable accepting an event dict can be used"""
+        self.__lock = threading.Lock()
+
+    def add_sink(self, sink: Callable[[Dict[str, Any]], None]) -> Callable[[Dict[str, Any]], None]:
+        """
+        Register a sink.
+        :param sink: The sink, usually an `EventSink`
+        :return: The sink
+        """
+        with self.__lock:
+            self.sinks = self.sinks + [sink]
+        return sink
 
-        season_data = json.loads(http_get(url))
+    def remove_sink(self, sink: Callable[[Dict[str, Any]], None]):
+        """
+        Unregister a sink. It is not closed.
+        :param sink: The sink
+        """
+        with self.__lock:
+            self.sinks = [s for s in self.sinks if s is not sink]
 
-        episodes = []
-        for e in season_data["results"]:
-            episodes.append(Episode(
-                id=e.get("itemId").strip(),
-                title=e.get("title").strip(),
-                description=e.get("description").strip(),
-                short_description=e.get("shortDescription").strip(),
-                thumbnail=e.get("images").strip(),
-                date=int(e.get("originalAirDate", 0).strip()),
-                episode_number=e.get("episodeNumber").strip(),
-                episode_number_in_season=e.get("episodeNumber", "0")[-2:].strip(),
-                season=e.get("episodeNumber", "0")[:2].strip(),
-                _lang=self.lang
-            ))
+    def emit(self, event: str, **fields):
+        """
+        Send an event to all sinks. Errors raised by sinks are logged and otherwise ignored.
+        :param event: The kind of event, see `EventSink`
+        :param fields: The fields of the event
+        """
+        sinks = self.sinks
+        if not sinks:
+            return
+        record = dict(event=event, time=time.time(), **fields)
+        for sink in sinks:
+            try:
+                sink(record)
+            except Exception as e:
+                log.warning("Instrumentation sink %s failed: %s", sink, e)
 
-        return Season(season, episodes)
+    @contextlib.contextmanager
+    def phase(self, name: str, **fields):
+        """
+        Measure the duration of a phase of the work and emit a 'phase' event when it is finished.
+        :param name: The name of the phase, e.g. 'transfer'
+        :param fields: Additional fields of the event, like the episode
+        """
+        started = time.monotonic()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.emit('phase', phase=name, duration=time.monotonic() - started, failed=failed, **fields)
 
-    def __carousel(self, video_id: Optional[str] = None) -> Dict:
-        if self.lang == 'de':
-            url = f"https://www.southpark.de/feeds/carousel/video/{video_id or 'e3748950-6c2a-4201-8e45-89e255c06df1'}/30/1/json"
-        elif self.lang == 'se':
-            url = f"https://www.southparkstudios.nu/feeds/carousel/wiki/{video_id or '3fb9ffcb-1f70-42ed-907d-9171091a28f4'}/12/1/json"
-        elif self.lang == 'uk':
-            url = f"https://www.southparkstudios.co.uk/feeds/carousel/wiki/{video_id or '4d56eb84-60d9-417e-9550-31bbfa1e7fb9'}/12/1/json"
+    def close(self):
+        """
+        Unregister and close all sinks.
+        """
+        with self.__lock:
+            sinks, self.sinks = self.sinks, []
+        for sink in sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+
+class RunStats(EventSink):
+    """
+    Aggregates the instrumentation events of a run into summary statistics: the amount of data and the average
+    throughput, percentiles of the segment latency and the time spent in each phase.
+    """
+
+    def __init__(self):
+        self.started: float = time.time()
+        """The time the statistics were started, as a unix timestamp"""
+        self.finished: Optional[float] = None
+        """The time of the last segment, as a unix timestamp"""
+        self.bytes: int = 0
+        """The number of bytes of all fetched segments"""
+        self.segments: int = 0
+        """The number of fetched segments"""
+        self.retries: int = 0
+        """The number of retried requests"""
+        self.episodes: Dict[str, int] = {}
+        """The number of episodes that reached a final state ('done', 'failed', 'cancelled' or 'copied'), by state"""
+        self.phases: Dict[str, float] = {}
+        """The time spent in each phase in seconds, summed over all episodes running in parallel"""
+        self.queue_depth: int = 0
+        """The number of segment requests that were waiting for a network worker at the last episode event"""
+        self.latencies: List[float] = []
+        """The time until the response headers of each segment arrived, in seconds"""
+        self.elapsed: List[float] = []
+        """The time to fetch each segment, in seconds"""
+        self.__lock = threading.Lock()
+
+    def __call__(self, event: Dict[str, Any]):
+        kind = event['event']
+        with self.__lock:
+            if kind == 'segment':
+                self.bytes += event['bytes']
+                self.segments += 1
+                self.latencies.append(event['latency'])
+                self.elapsed.append(event['elapsed'])
+                self.finished = event['time']
+            elif kind == 'retry':
+                self.retries += 1
+            elif kind == 'phase':
+                self.phases[event['phase']] = self.phases.get(event['phase'], 0.) + event['duration']
+            elif kind == 'episode':
+                self.queue_depth = event.get('queue_depth', self.queue_depth)
+                if event['state'] in ('done', 'failed', 'cancelled', 'copied'):
+                    self.episodes[event['state']] = self.episodes.get(event['state'], 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Get the summary statistics.
+        :return: A dict with the keys bytes, segments, retries, seconds, rate (in bytes per second), latency_p50, latency_p95, elapsed_p50, elapsed_p95, phases and episodes
+        """
+        with self.__lock:
+            seconds = max((self.finished or time.time()) - self.started, 1e-6)
+            latencies, elapsed = sorted(self.latencies), sorted(self.elapsed)
+            return {
+                'bytes': self.bytes,
+                'segments': self.segments,
+                'retries': self.retries,
+                'seconds': seconds,
+                'rate': self.bytes / seconds,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95),
+                'elapsed_p50': percentile(elapsed, 50),
+                'elapsed_p95': percentile(elapsed, 95),
+                'phases': dict(self.phases),
+                'episodes': dict(self.episodes),
+            }
+
+    def format(self) -> str:
+        """
+        Format the summary statistics for humans.
+        :return: The summary, in multiple lines
+        """
+        s = self.summary()
+        lines = [f"Transferred {s['bytes'] / 2 ** 20:.1f} MB in {s['segments']} segments within {s['seconds']:.1f}s "
+                 f"({s['rate'] / 2 ** 20:.2f} MB/s), {s['retries']} request(s) retried"]
+        if s['segments']:
+            lines.append(f"Segment latency: p50 {s['latency_p50']:.3f}s, p95 {s['latency_p95']:.3f}s; "
+                         f"segment time: p50 {s['elapsed_p50']:.3f}s, p95 {s['elapsed_p95']:.3f}s")
+        if s['phases']:
+            lines.append("Time per phase: " + ", ".join(f"{k} {v:.1f}s" for k, v in s['phases'].items()))
+        return "\n".join(lines)
+
+    def __str__(self):
+        return f"<{type(self).__name__} at {id(self)} bytes={self.bytes} segments={self.segments} retries={self.retries}>"
+
+    def __repr__(self):
+        return str(self)
+
+
+class EventLogSink(EventSink):
+    """
+    Writes every instrumentation event as a line of JSON to a file.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The file to append the events to
+        """
+        self.path: str = path
+        """The file the events are appended to"""
+        self.__file = open(path, 'a', encoding='utf-8')
+        self.__lock = threading.Lock()
+
+    def __call__(self, event: Dict[str, Any]):
+        line = json.dumps(event, default=str)
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.write(line + "\n")
+                self.__file.flush()
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+class MetricsSink(EventSink):
+    """
+    Exports the statistics of a `RunStats` in the Prometheus text format to a file, e.g. for the textfile collector
+    of the node exporter. The file is replaced atomically at most every `interval` seconds and when the sink is closed.
+    """
+
+    def __init__(self, path: str, interval: float = 10., stats: Optional[RunStats] = None):
+        """
+        :param path: The file to write the metrics to
+        :param interval: The minimum time between two writes, in seconds
+        :param stats: The statistics to export; a new `RunStats` is created if not given. An existing one must be registered as a sink separately.
+        """
+        self.path: str = path
+        """The file the metrics are written to"""
+        self.interval: float = interval
+        """The minimum time between two writes, in seconds"""
+        self.stats: RunStats = stats or RunStats()
+        """The exported statistics"""
+        self.__own_stats = stats is None
+        self.__written = 0.
+        self.__lock = threading.Lock()
+
+    def __call__(self, event: Dict[str, Any]):
+        if self.__own_stats:
+            self.stats(event)
+        with self.__lock:
+            if time.monotonic() - self.__written < self.interval:
+                return
+            self.__written = time.monotonic()
+        self.write()
+
+    def write(self):
+        """
+        Write the current metrics to the file.
+        """
+        s = self.stats.summary()
+        lines = [
+            "# HELP spdl_bytes_total The number of bytes of all fetched segments.",
+            "# TYPE spdl_bytes_total counter",
+            f"spdl_bytes_total {s['bytes']}",
+            "# HELP spdl_segments_total The number of fetched segments.",
+            "# TYPE spdl_segments_total counter",
+            f"spdl_segments_total {s['segments']}",
+            "# HELP spdl_retries_total The number of retried requests.",
+            "# TYPE spdl_retries_total counter",
+            f"spdl_retries_total {s['retries']}",
+            "# HELP spdl_throughput_bytes_per_second The average download rate of the run.",
+            "# TYPE spdl_throughput_bytes_per_second gauge",
+            f"spdl_throughput_bytes_per_second {s['rate']:.1f}",
+            "# HELP spdl_network_queue_depth The number of segment requests waiting for a network worker.",
+            "# TYPE spdl_network_queue_depth gauge",
+            f"spdl_network_queue_depth {self.stats.queue_depth}",
+            "# HELP spdl_segment_latency_seconds The time until the response headers of a segment arrived.",
+            "# TYPE spdl_segment_latency_seconds summary",
+            f"spdl_segment_latency_seconds{{quantile=\"0.5\"}} {s['latency_p50']:.6f}",
+            f"spdl_segment_latency_seconds{{quantile=\"0.95\"}} {s['latency_p95']:.6f}",
+            f"spdl_segment_latency_seconds_count {s['segments']}",
+            "# HELP spdl_phase_seconds_total The time spent in each phase, summed over parallel episodes.",
+            "# TYPE spdl_phase_seconds_total counter",
+        ]
+        lines += [f"spdl_phase_seconds_total{{phase=\"{k}\"}} {v:.3f}" for k, v in sorted(s['phases'].items())]
+        lines += ["# HELP spdl_episodes_total The number of finished episodes, by state.",
+                  "# TYPE spdl_episodes_total counter"]
+        lines += [f"spdl_episodes_total{{state=\"{k}\"}} {v}" for k, v in sorted(s['episodes'].items())]
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.path)
+
+    def close(self):
+        self.write()
+
+
+class ProgressSink(EventSink):
+    """
+    Shows a live progress line with the number of finished episodes, the current download rate and the progress of
+    each running episode. On terminals, the line is redrawn in place; otherwise, a new line is written every
+    `interval` seconds.
+    """
+
+    def __init__(self, stream=None, interval: float = 0.5, total: Optional[int] = None, window: float = 5.):
+        """
+        :param stream: The text stream to write to, defaults to sys.stderr
+        :param interval: The minimum time between two updates, in seconds
+        :param total: The number of episodes that will be downloaded, if known
+        :param window: The time span to calculate the current download rate over, in seconds
+        """
+        self.stream = stream or sys.stderr
+        self.interval: float = interval
+        self.total: Optional[int] = total
+        self.window: float = window
+        self.__tty = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self.__running: Dict[str, Dict[str, Any]] = {}
+        self.__finished = 0
+        self.__recent = collections.deque()
+        self.__bytes = 0
+        self.__drawn = 0.
+        self.__width = 0
+        self.__lock = threading.Lock()
+
+    def __call__(self, event: Dict[str, Any]):
+        kind = event['event']
+        with self.__lock:
+            if kind == 'segment':
+                self.__bytes += event['bytes']
+                self.__recent.append((time.monotonic(), event['bytes']))
+                if event.get('episode') in self.__running:
+                    self.__running[event['episode']]['done'] += 1
+            elif kind == 'part' and event.get('episode') in self.__running:
+                progress = self.__running[event['episode']]
+                if event['state'] in ('started', 'skipped') and event.get('segments'):
+                    progress['total'] += event['segments']
+                    progress['done'] += event['segments'] if event['state'] == 'skipped' else event.get('done', 0)
+            elif kind == 'episode':
+                if event['state'] == 'downloading':
+                    self.__running[event['episode']] = {'name': f"S{event['season']}E{event['number']}",
+                                                        'state': 'downloading', 'total': 0, 'done': 0}
+                elif event['state'] == 'merging' and event['episode'] in self.__running:
+                    self.__running[event['episode']]['state'] = 'merging'
+                elif event['state'] in ('done', 'failed', 'cancelled'):
+                    self.__running.pop(event['episode'], None)
+                    self.__finished += 1
+                elif event['state'] == 'copied':
+                    # Another download of the episode transfers the streams and is still running
+                    self.__finished += 1
+            if time.monotonic() - self.__drawn >= self.interval:
+                self.__draw()
+
+    def close(self):
+        with self.__lock:
+            self.__draw()
+            if self.__tty:
+                self.stream.write("\n")
+                self.stream.flush()
+
+    def __draw(self):
+        now = time.monotonic()
+        self.__drawn = now
+        while self.__recent and self.__recent[0][0] < now - self.window:
+            self.__recent.popleft()
+        rate = sum(size for _, size in self.__recent) / self.window
+
+        episodes = f"{self.__finished}/{self.total}" if self.total is not None else f"{self.__finished}"
+        line = f"[{episodes} episodes] {self.__bytes / 2 ** 20:.1f} MB at {rate / 2 ** 20:.2f} MB/s"
+        for progress in self.__running.values():
+            if progress['state'] == 'merging':
+                line += f" | {progress['name']} merging"
+            elif progress['total']:
+                line += f" | {progress['name']} {progress['done'] * 100 // progress['total']}%"
+            else:
+                line += f" | {progress['name']}"
+        if self.__tty:
+            self.stream.write("\r" + line.ljust(self.__width))
+            self.__width = len(line)
         else:
-            url = f"https://southpark.cc.com/feeds/carousel/video/{video_id or '2b6c5ab4-d717-4e84-9143-918793a3b636'}/14/2/json/!airdate/?lang={self.lang.upper()}"
-        return json.loads(http_get(url))
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+
+http_client: HTTPClient = HTTPClient()
+"""The HTTP client used for all requests. Replace it to change timeouts, retries or other request settings."""
+
+throughput_monitor: ThroughputMonitor = ThroughputMonitor()
+"""Measures the throughput of all segment downloads."""
+
+metadata_cache: Optional[MetadataCache] = None
+"""The cache for metadata requests, or None to disable caching. Set it to a `MetadataCache` to enable caching."""
 
+instrumentation: Instrumentation = Instrumentation()
+"""Distributes the instrumentation events of all downloads. Add a sink (e.g. `RunStats`) to it to receive them."""
 
-def http_get(url: str, default: Any = '') -> bytes:
+
+_RAISE = object()
+
+
+def http_get(url: str, default: Any = _RAISE, kind: Optional[str] = None, lang: str = '') -> bytes:
     """
-    Perform a simple HTTP GET request and return the response body as bytes.
+    Perform a HTTP GET request using the shared `http_client` and return the response body as bytes.
     :param url: The url to fetch
-    :param default: A default value to return on network errors.
+    :param default: A default value to return on network errors. If it is not given, errors are raised.
+    :param kind: The kind of metadata that is requested (see `MetadataCache.DEFAULT_TTLS`). If given, the response is cached in `metadata_cache`.
+    :param lang: The language the metadata is requested for
     :return: The response body, as bytes
+    :raise NetworkError: If the request failed and no default was given
     """
     try:
-        with urllib.request.urlopen(url) as resp:
-            return resp.read()
-    except:
+        if kind is not None and metadata_cache is not None:
+            return metadata_cache.get(url, kind, lang)
+        return http_client.get(url)
+    except NetworkError:
+        if default is _RAISE:
+            raise
         return default
 
 
+def parse_media_playlist(playlist: bytes, url: str) -> List[Segment]:
+    """
+    Parse an HLS media playlist (the playlist of a single rendition, not the variant playlist) into its segments.
+    :param playlist: The raw playlist, as bytes
+    :param url: The url the playlist was fetched from; relative segment urls are resolved against it
+    :return: A list of the segments, in playback order
+    :raise ValueError: If the playlist is not a media playlist or its segments are encrypted
+    """
+    lines = [line.strip().decode("utf-8") for line in playlist.splitlines()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise ValueError("Not an HLS playlist")
+
+    segments = []
+    sequence = 0
+    duration = 0.
+    for line in lines[1:]:
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-KEY:") and "METHOD=NONE" not in line:
+            raise ValueError("Encrypted HLS streams are not supported")
+        elif line.startswith("#EXT-X-STREAM-INF:"):
+            raise ValueError("Expected a media playlist but got a variant playlist")
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+        elif line and not line.startswith("#"):
+            segments.append(Segment(urllib.parse.urljoin(url, line), duration, sequence))
+            sequence += 1
+            duration = 0.
+    if not segments:
+        raise ValueError("The playlist does not contain any segments")
+    return segments
+
+
+def download_segments(segments: List[Segment], filename: str, executor: Executor, max_concurrent: int = 4,
+                      cancelled: Optional[threading.Event] = None, append: bool = False,
+                      on_segment: Optional[Callable[[Segment, bytes], None]] = None):
+    """
+    Download HLS segments in parallel and write them, in order, to a single file. At most `max_concurrent` segments
+    are in flight (or waiting to be written) at any time, which bounds the memory used for reordering.
+    :param segments: The segments to download, e.g. from `Stream.get_segments()`
+    :param filename: The file to write the concatenated segments to
+    :param executor: The executor to perform the requests on; share one executor to bound the total concurrency
+    :param max_concurrent: The maximum number of segments of this call to download concurrently
+    :param cancelled: An event that aborts the download with a `DownloadCancelled` exception when set
+    :param append: Whether to append to the file instead of overwriting it
+    :param on_segment: A callback that is called with each segment and its data after it was written to the file
+    """
+    with open(filename, 'ab' if append else 'wb') as f:
+        for segment, data in zip(segments, iter_segments(segments, executor, max_concurrent, cancelled)):
+            f.write(data)
+            if on_segment is not None:
+                f.flush()
+                on_segment(segment, data)
+
+
+def iter_segments(segments: List[Segment], executor: Executor, max_concurrent: int = 4,
+                  cancelled: Optional[threading.Event] = None) -> Iterable[bytes]:
+    """
+    Download HLS segments in parallel and yield their data in order. At most `max_concurrent` segments are in
+    flight (or waiting to be consumed) at any time, which bounds the memory used for reordering.
+    :param segments: The segments to download, e.g. from `Stream.get_segments()`
+    :param executor: The executor to perform the requests on; share one executor to bound the total concurrency
+    :param max_concurrent: The maximum number of segments of this call to download concurrently
+    :param cancelled: An event that aborts the download with a `DownloadCancelled` exception when set
+    :return: A generator yielding the data of each segment
+    """
+    pending = collections.deque()
+    remaining = iter(segments)
+    try:
+        while True:
+            while len(pending) < max_concurrent:
+                segment = next(remaining, None)
+                if segment is None:
+                    break
+                pending.append(executor.submit(fetch_segment, segment))
+            if not pending:
+                break
+            if cancelled is not None and cancelled.is_set():
+                raise DownloadCancelled()
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def fetch_segment(segment: Segment) -> bytes:
+    """
+    Fetch the data of a single segment.
+    :param segment: The segment to fetch
+    :return: The segment data
+    :raise NetworkError: If the segment could not be fetched
+    """
+    resp = http_client.request(segment.url)
+    host = urllib.parse.urlsplit(segment.url).hostname
+    throughput_monitor.record(host, segment.rendition, len(resp.body), resp.elapsed, resp.latency)
+    instrumentation.emit('segment', host=host, rendition=segment.rendition, sequence=segment.sequence,
+                         bytes=len(resp.body), latency=resp.latency, elapsed=resp.elapsed, retries=resp.retries,
+                         **segment.context)
+    return resp.body
+
+
+def select_episodes(southpark: SouthPark, selector: str, max_workers: int = 8) -> List[Episode]:
+    """
+    Select episodes with a selector string, like the command line interface does. All seasons that are needed are
+    fetched concurrently.
+    :param southpark: The SouthPark instance to fetch the seasons from
+    :param selector: The selector, e.g. 'all', 'S01', 'S01E02', 'S01-S07' or 'S01,S02-S04,S05E01-S05E04'
+    :param max_workers: The maximum number of seasons to fetch concurrently
+    :return: The selected episodes, sorted and without duplicates
+    """
+    return list(iter_selected_episodes(southpark, selector, max_workers))
+
+
+def iter_selected_episodes(southpark: SouthPark, selector: str, prefetch: int = 4) -> Iterable[Episode]:
+    """
+    Select episodes with a selector string like `select_episodes()`, but yield them season by season as soon as the
+    pages of each season arrived, while the next seasons are fetched in the background.
+    :param southpark: The SouthPark instance to fetch the seasons from
+    :param selector: The selector, e.g. 'all', 'S01', 'S01E02', 'S01-S07' or 'S01,S02-S04,S05E01-S05E04'
+    :param prefetch: The maximum number of season pages to fetch concurrently
+    :return: A generator yielding the selected episodes, sorted and without duplicates
+    :raise ValueError: If the selector is invalid. If a single selected episode does not exist, the generator raises it once the season arrived.
+    """
+    ranges = []
+    if selector == 'all':
+        ranges = [((n, None), (n, None)) for n in southpark.get_season_numbers()]
+    else:
+        for el in map(str.strip, selector.split(",")):
+            if '-' in el:
+                if el.count('-') > 1:
+                    raise ValueError(f"Invalid parameter: {el} in {selector}")
+                start, end = map(parse_episode_string, map(str.strip, el.split("-", 1)))
+            else:
+                start = end = parse_episode_string(el)
+            ranges.append((start, end))
+
+    def selected(season: int, episode: int) -> bool:
+        for start, end in ranges:
+            if start[0] <= season <= end[0] \
+                    and (start[1] is None or season != start[0] or episode >= start[1]) \
+                    and (end[1] is None or season != end[0] or episode <= end[1]):
+                return True
+        return False
+
+    def generate() -> Iterable[Episode]:
+        numbers = sorted(set(i for start, end in ranges for i in range(start[0], end[0] + 1)))
+        seen = set()
+        for season in southpark.iter_seasons(numbers, prefetch):
+            episodes = {}
+            for e in season.episodes:
+                if e.id not in seen and selected(season.season_num, int(e.episode_number_in_season)):
+                    episodes.setdefault(e.id, e)
+            for start, end in ranges:
+                if start == end and start[0] == season.season_num and start[1] is not None \
+                        and not any(int(e.episode_number_in_season) == start[1] for e in season.episodes):
+                    raise ValueError(f"Season {start[0]} Episode {start[1]} does not exist.")
+            seen.update(episodes)
+            yield from sorted(episodes.values())
+
+    return generate()
+
+
+def resolve_episodes(episodes: Iterable[Episode], max_workers: int = 16, streams: bool = True) -> List[Episode]:
+    """
+    Fetch the videos and streams of many episodes at once. All mediagen feeds, mediagen documents and playlists
+    are requested concurrently, so that the episodes can be downloaded afterwards without further metadata requests.
+    Episodes that fail to resolve are logged and left unresolved; they are resolved again when they are used.
+    :param episodes: The episodes to resolve
+    :param max_workers: The maximum number of concurrent requests
+    :param streams: Whether to fetch the streams of each video, too
+    :return: The episodes
+    """
+    episodes = list(episodes)
+    with instrumentation.phase('resolve', episodes=len(episodes)), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [e.resolve(executor, streams) for e in episodes]
+        for e, future in zip(episodes, futures):
+            try:
+                future.result()
+            except Exception as error:
+                log.warning("Could not resolve the videos of %s: %s", e, error)
+    return episodes
+
+
+def iter_resolved_episodes(episodes: Iterable[Episode], max_workers: int = 16, lookahead: int = 32,
+                           streams: bool = True) -> Iterable[Episode]:
+    """
+    Resolve episodes like `resolve_episodes()`, but yield each episode as soon as it is resolved, in order, while up
+    to `lookahead` of the following episodes are resolved in the background. The episodes are taken from the
+    iterable lazily, so it may be a generator that is still fetching them, like `iter_selected_episodes()`.
+    :param episodes: The episodes to resolve
+    :param max_workers: The maximum number of concurrent requests
+    :param lookahead: The maximum number of episodes to resolve ahead of the one that was yielded last
+    :param streams: Whether to fetch the streams of each video, too
+    :return: A generator yielding the episodes
+    """
+    def resolve(e: Episode) -> Future:
+        started = time.monotonic()
+        future = e.resolve(executor, streams)
+        future.add_done_callback(lambda f: instrumentation.emit('phase', phase='resolve', duration=time.monotonic() - started,
+                                                                failed=f.exception() is not None, episode=e.id))
+        return future
+
+    remaining = iter(episodes)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            while len(pending) < max(lookahead, 1):
+                e = next(remaining, None)
+                if e is None:
+                    break
+                pending.append((e, resolve(e)))
+            if not pending:
+                break
+            e, future = pending.popleft()
+            try:
+                future.result()
+            except Exception as error:
+                log.warning("Could not resolve the videos of %s: %s", e, error)
+            yield e
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def gather_futures(futures: List[Future]) -> Future:
+    """
+    Combine multiple futures into one.
+    :param futures: The futures to combine
+    :return: A future that completes with the list of all results once all futures are done, or with the first exception
+    """
+    result = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(i: int, future: Future):
+        try:
+            results[i] = future.result()
+        except BaseException as e:
+            with lock:
+                if not result.done():
+                    result.set_exception(e)
+            return
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0 and not result.done():
+                result.set_result(results)
+
+    if not futures:
+        result.set_result([])
+    for i, future in enumerate(futures):
+        future.add_done_callback(functools.partial(on_done, i))
+    return result
+
+
+def get_resume_dir() -> str:
+    """
+    Get the directory that keeps the progress of interrupted downloads (see `DownloadJournal`). It is located next to
+    the temporary directory, but unlike that, it is kept when the script exits.
+    """
+    return os.path.join(get_tempdir_root(), '.spdl-resume')
+
+
+def get_cache_dir() -> str:
+    """
+    Get the directory to store persistent caches in, following the conventions of the platform.
+    :return: The cache directory of spdl; it might not exist yet
+    """
+    if os.name == 'nt':
+        root = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        return os.path.join(root, 'spdl', 'Cache')
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Caches/spdl')
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'spdl')
+
+
+def get_ffmpeg_executable(ffmpeg_executable: Optional[str] = None) -> str:
+    """
+    Get the ffmpeg executable to use.
+    :param ffmpeg_executable: An explicitly configured executable, returned as is if given
+    :return: The executable, defaults to 'ffmpeg' on unix and 'ffmpeg.exe' on windows
+    """
+    if ffmpeg_executable is None:
+        return 'ffmpeg.exe' if os.name == 'nt' else 'ffmpeg'
+    return ffmpeg_executable
+
+
+def run_process(args: List[str], cancelled: Optional[threading.Event] = None,
+                on_progress: Optional[Callable[[Dict[str, str]], None]] = None) -> int:
+    """
+    Run a child process (usually ffmpeg) and wait for it to exit.
+    :param args: The command line of the process
+    :param cancelled: An event that terminates the process and raises a `DownloadCancelled` exception when set
+    :param on_progress: A callback for the progress reports ffmpeg writes to stdout with '-progress pipe:1'. It is called with the key-value pairs of each report.
+    :return: The exit code of the process
+    """
+    import subprocess
+    p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE if on_progress is not None else None)
+    reader = None
+    if on_progress is not None:
+        reader = threading.Thread(target=_read_progress, args=(p.stdout, on_progress), daemon=True)
+        reader.start()
+    try:
+        while True:
+            try:
+                return p.wait(0.25)
+            except subprocess.TimeoutExpired:
+                if cancelled is not None and cancelled.is_set():
+                    raise DownloadCancelled()
+    finally:
+        if p.poll() is None:
+            p.terminate()
+            p.wait()
+        if reader is not None:
+            reader.join(5)
+
+
+def _read_progress(stdout, on_progress: Callable[[Dict[str, str]], None]):
+    progress = {}
+    for line in stdout:
+        key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+        progress[key] = value
+        if key == 'progress':
+            try:
+                on_progress(progress)
+            except Exception as e:
+                log.warning("Progress callback failed: %s", e)
+            progress = {}
+    stdout.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _etree():
+    # lxml is faster, but optional
+    try:
+        from lxml import etree
+    except ImportError:
+        import xml.etree.ElementTree as etree
+    return etree
+
+
+def check_ts(data: bytes) -> Optional[str]:
+    """
+    Check that data looks like an MPEG transport stream, i.e. consists of whole 188 byte packets that each start
+    with the sync byte. This catches truncated segments and error pages without decoding any video.
+    :param data: The data, e.g. of a segment
+    :return: A description of the problem, or None if the data looks fine
+    """
+    if not data:
+        return "no data"
+    if len(data) % TS_PACKET_SIZE:
+        return f"{len(data)} bytes are no whole number of packets"
+    sync = data[::TS_PACKET_SIZE]
+    if sync.count(TS_SYNC_BYTE) != len(sync):
+        return f"packet {next(i for i, b in enumerate(sync) if b != TS_SYNC_BYTE)} has no sync byte"
+    return None
+
+
+def check_ts_file(filename: str) -> Optional[str]:
+    """
+    Check that a file looks like an MPEG transport stream, see `check_ts()`.
+    :param filename: The file
+    :return: A description of the problem, or None if the file looks fine
+    """
+    offset = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(TS_PACKET_SIZE * 4096), b''):
+            problem = check_ts(chunk)
+            if problem is not None:
+                return f"{problem} (after byte {offset})"
+            offset += len(chunk)
+    return None if offset else "no data"
+
+
+def url_expiry(url: str) -> Optional[float]:
+    """
+    Get the time a signed url expires, from the expiry its query carries, e.g. 'Expires=1700000000' or an Akamai token
+    like 'hdnea=exp=1700000000~acl=...~hmac=...'.
+    :param url: The url
+    :return: The time as unix timestamp, or None if the url carries no expiry
+    """
+    query = urllib.parse.unquote(urllib.parse.urlsplit(url).query)
+    m = re.search(r'(?:^|[&~;,=])(?:exp|expires)=(\d{9,11})(?:$|[&~;,])', query, re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+
+def content_expiry(content: bytes) -> Optional[float]:
+    """
+    Get the time the first of the signed urls in a document, e.g. a mediagen document or a playlist, expires.
+    :param content: The document
+    :return: The time as unix timestamp, or None if none of its urls carries an expiry, see `url_expiry()`
+    """
+    text = urllib.parse.unquote(content.decode('latin-1'))
+    return min((float(m.group(1)) for m in re.finditer(r'[?&~;,=](?:exp|expires)=(\d{9,11})(?!\d)', text, re.IGNORECASE)),
+               default=None)
+
+
+def get_container(filename: str, container: Optional[str] = None) -> Optional[str]:
+    """
+    Get the container a file is written in.
+    :param filename: The file name
+    :param container: An explicitly configured container, returned as is if given
+    :return: One of the keys of `CONTAINERS`, or the extension of the file name if it is no supported container
+    """
+    if container is not None:
+        return container
+    ext = os.path.splitext(filename)[1].lstrip('.').lower()
+    return 'mp4' if ext in ('mp4', 'm4v', 'mov') else ext or None
+
+
+def parse_vtt_timestamp(timestamp: str) -> float:
+    """
+    Parse a WebVTT timestamp like "01:02:03.456" or "02:03.456".
+    :param timestamp: The timestamp
+    :return: The time in seconds
+    """
+    seconds = 0.
+    for field in timestamp.split(':'):
+        seconds = seconds * 60 + float(field)
+    return seconds
+
+
+def format_vtt_timestamp(seconds: float) -> str:
+    """
+    Format a time as WebVTT timestamp.
+    :param seconds: The time in seconds
+    :return: The timestamp, e.g. "01:02:03.456"
+    """
+    millis = round(seconds * 1000)
+    return f"{millis // 3600000:02d}:{millis // 60000 % 60:02d}:{millis // 1000 % 60:02d}.{millis % 1000:03d}"
+
+
+def get_size(path: str) -> int:
+    """
+    Get the size of a file or the total size of the files in a directory.
+    :param path: The file or directory
+    :return: The size in bytes, 0 if the path does not exist
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+def get_last_modified(path: str) -> float:
+    """
+    Get the time anything in a directory was modified last.
+    :param path: The directory
+    :return: The latest modification time of the directory and everything in it, as unix timestamp
+    :raise OSError: If the directory does not exist
+    """
+    last = os.path.getmtime(path)
+    for root, dirs, files in os.walk(path):
+        for f in dirs + files:
+            try:
+                last = max(last, os.path.getmtime(os.path.join(root, f)))
+            except OSError:
+                pass
+    return last
+
+
+def is_process_alive(pid: int) -> bool:
+    """
+    Check whether a process is running. Only supported on unix.
+    :param pid: The process id
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Running as another user
+    return True
+
+
+def remove_files(filenames: Iterable[str]):
+    """
+    Remove the given files, ignoring those that do not exist.
+    :param filenames: The files to remove
+    """
+    for f in filenames:
+        if os.path.isfile(f):
+            os.remove(f)
+
+
 def escape_filename(string: str) -> str:
     """
     Escape a string to put it into a file name. This removes special chars from the string that
@@ -442,6 +4835,54 @@ def escape_string(string: str) -> str:
     return string.replace('"', '\"').replace("\n", "\\n").replace("\r", "\\r")
 
 
+def parse_size(string: str) -> int:
+    """
+    Parses a size like "500k", "2M" or "1G" into a number of bytes. The suffixes are binary (k = 1024).
+    :param string: The size string
+    :return: The number of bytes, 0 for an empty string
+    """
+    m = re.match(r'(\d+(?:\.\d+)?)\s*([kmg]?)i?b?$', string.strip().lower())
+    if not m:
+        if not string.strip():
+            return 0
+        raise ValueError(f"Invalid size: \"{string}\". Valid examples: '500k', '2M' or '1G'")
+    return int(float(m.group(1)) * 1024 ** " kmg".index(m.group(2) or " "))
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Get a percentile of some values using the nearest-rank method.
+    :param values: The values, sorted ascending
+    :param p: The percentile, between 0 and 100
+    :return: The percentile, or 0 if there are no values
+    """
+    if not values:
+        return 0.
+    return values[max(math.ceil(p / 100. * len(values)) - 1, 0)]
+
+
+def _parse_date(string: str, end: bool) -> float:
+    # Parses 'YYYY', 'YYYY-MM' or 'YYYY-MM-DD' into the first (or, for the end of a range, the last) second of that
+    # period in UTC; an empty string leaves the range open
+    if not string:
+        return math.inf if end else -math.inf
+    m = re.match(r'(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?$', string)
+    if not m:
+        raise ValueError(f"Invalid date: \"{string}\". Valid examples: '2019', '2019-10' or '2019-10-02'")
+    import datetime
+    year, month, day = int(m.group(1)), int(m.group(2) or 1), int(m.group(3) or 1)
+    start = datetime.datetime(year, month, day, tzinfo=datetime.timezone.utc)
+    if not end:
+        return start.timestamp()
+    if m.group(3):
+        following = start + datetime.timedelta(days=1)
+    elif m.group(2):
+        following = start.replace(year=year + month // 12, month=month % 12 + 1)
+    else:
+        following = start.replace(year=year + 1)
+    return following.timestamp() - 1e-6
+
+
 def parse_episode_string(string: str) -> Tuple[int, int]:
     """
     Parses a string like "S04E12" into a tuple like (4, 12). Leading zeros are optional. If
@@ -459,95 +4900,313 @@ if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(os.path.basename(__file__), description="Download South Park Seasons or Episodes")
-    parser.add_argument('what',
-                        help="Specify what to download. Examples: 'all', 'S01', 'S01E02', 'S01-S07', 'S01,S02-S04,S05E01-S05E04'")
+    parser.add_argument('what', nargs='?',
+                        help="Specify what to download. Examples: 'all', 'S01', 'S01E02', 'S01-S07', 'S01,S02-S04,S05E01-S05E04'. With --catalog also 'title:<words>', 'date:<from>..<to>', '#<global episode number>', 'new' and terms joined with '+', e.g. 'S20+title:member,date:2019-10..2019-12'")
     parser.add_argument('-p', '--path', default='South Park/Season %s/%e - %t.mp4',
-                        help=f"Specify where to save downloaded episodes and how the files are called. Directories that do not exist are created automatically. '%%s' is replaced with the current season number, '%%e' with the current episode number, '%%t' with the episode's title and '%%g' with the global episode number (e.g. \"1803\")")
+                        help=f"Specify where to save downloaded episodes and how the files are called. Directories that do not exist are created automatically. '%%s' is replaced with the current season number, '%%e' with the current episode number, '%%t' with the episode's title, '%%g' with the global episode number (e.g. \"1803\"), '%%l' with the language and '%%q' with the quality")
     parser.add_argument('-l', '--language', default='en',
-                        help=f"Set the language for the downloads. The default language is english (en). Supported languages are: {', '.join(DOMAIN_URL.keys())}")
+                        help=f"Set the language for the downloads. Separate multiple languages with commas, e.g. 'en,de'; --path must then contain '%%l'. The default language is english (en). Supported languages are: {', '.join(DOMAIN_URL.keys())}")
     parser.add_argument('-q', '--quality', default='max',
-                        help="The video quality to use for downloads. Either 'max', 'medium', 'min' or a resolution string like '1920x1080' to use the closest matching resolution that is available. Default: max")
+                        help="The video quality to use for downloads. Either 'max', 'medium', 'min' or a resolution string like '1920x1080' to use the closest matching resolution that is available. Separate multiple qualities with commas, e.g. 'max,960x540'; --path must then contain '%%q'. Qualities that resolve to the same stream are downloaded once. Default: max")
     parser.add_argument('-b', "--ffmpeg-binary", default=None,
                         help="Specify the path of the ffmpeg binary. Default on unix is 'ffmpeg', on windows it's 'ffmpeg.exe'")
-    parser.add_argument('-t', '--threads', default=4, type=int,
-                        help="Specify the maximum number of threads to download video parts concurrently. Default: 4")
-    parser.add_argument('-f', '--tempdir', default=tempdir,
-                        help="Specify where to put temporary files. This option can be useful for example if you do not have enough space left on your harddrive and want to work on an external drive.")
+    parser.add_argument('-t', '--threads', default=8, type=int,
+                        help="Specify the maximum number of video segments to download concurrently. Default: 8")
+    parser.add_argument('--part-threads', default=4, type=int,
+                        help="Specify the maximum number of video segments to download concurrently per video part. Default: 4")
+    parser.add_argument('-e', '--episodes', default=2, type=int,
+                        help="Specify the maximum number of episodes to download concurrently. All episodes share the segment download threads given by --threads. Default: 2")
+    parser.add_argument('--merges', default=1, type=int,
+                        help="Specify the maximum number of ffmpeg processes to run concurrently, capped at the number of CPUs. Merges run independently of the download threads; episodes that finish while all merges are busy are merged together by one process. Default: 1")
+    parser.add_argument('--resolve-threads', default=16, type=int,
+                        help="Specify the maximum number of concurrent requests to resolve episode metadata. Default: 16")
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help="Specify how many of the next episodes to resolve in the background when a download starts. Episodes whose stream urls expire before their turn are resolved again. Default: 2")
+    parser.add_argument('--timeout', default=30., type=float,
+                        help="Specify the network timeout in seconds. Default: 30")
+    parser.add_argument('--retries', default=3, type=int,
+                        help="Specify how often failed network requests are retried. Default: 3")
+    parser.add_argument('--limit-rate', default=None,
+                        help="Limit the download bandwidth, e.g. '500k' or '2M' bytes per second. Default: no limit")
+    parser.add_argument('--limit-requests', default=None, type=float,
+                        help="Limit the number of requests per second to each host. Default: no limit")
+    parser.add_argument('--rate-control', default=None,
+                        help="Read the rate limits from a file that is checked for changes while downloading. It contains lines like 'rate=2M' and 'requests=10'. On unix, sending SIGHUP reloads it immediately.")
+    parser.add_argument('--adaptive', default=None,
+                        help="Lower the quality of episodes whose hosts deliver less than this rate per request, e.g. '1M' bytes per second. Lowered episodes are upgraded by the next --sync. Default: off")
+    parser.add_argument('--offline', action='store_true',
+                        help="Do not fetch any episode metadata from the network but only use the metadata cache.")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Revalidate all cached episode metadata with the server instead of trusting its age.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Disable the persistent episode metadata cache.")
+    parser.add_argument('--cache-dir', default=None,
+                        help="Specify where to store the metadata cache and the episode catalog. Default: the user's cache directory")
+    parser.add_argument('--catalog', action='store_true',
+                        help="Select the episodes from the local episode catalog without any network requests. It understands additional selectors: 'title:<words>' searches the titles, 'date:<from>..<to>' selects an air date range ('YYYY', 'YYYY-MM' or 'YYYY-MM-DD'; either end may be left out), '#<number>' selects a global episode number and 'new' the episodes added to the catalog since the last download in the manifest. Languages that are not in the catalog yet are fetched once.")
+    parser.add_argument('--update-catalog', action='store_true',
+                        help="Fetch all seasons and update the local episode catalog before selecting episodes; implies --catalog.")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="Do not continue interrupted downloads and do not keep the progress of downloads that are interrupted.")
+    parser.add_argument('-s', '--sync', action='store_true',
+                        help="Only download episodes that are new, missing, incomplete or available in a better quality than the downloaded file, according to the manifest.")
+    parser.add_argument('--manifest', default=None,
+                        help="Specify the manifest file that records the downloaded episodes. Default: '.spdl-manifest.json' in the top-most download directory")
+    parser.add_argument('--stream-mux', action='store_true',
+                        help="Pipe downloaded segments directly into ffmpeg instead of writing temporary files first. This halves the disk writes, but interrupted downloads can not be resumed.")
+    parser.add_argument('--stream-buffer', default=16, type=int,
+                        help="Specify the maximum number of segments per episode to download concurrently or hold in memory with --stream-mux. Default: 16")
+    parser.add_argument('--container', default=None, choices=sorted(CONTAINERS),
+                        help="The container to save the episodes in; replaces the extension of --path. mp4 files are written with the index at the start for fast playback start. Default: the extension of --path")
+    parser.add_argument('--captions', action='store_true',
+                        help="Embed the episodes' captions as a subtitle track.")
+    parser.add_argument('--progress', action='store_true',
+                        help="Show a live progress line with the download rate and the progress of each running episode.")
+    parser.add_argument('--events', default=None,
+                        help="Append a JSON line for every segment, part, episode, retry and ffmpeg progress event to this file.")
+    parser.add_argument('--metrics', default=None,
+                        help="Write download metrics in the Prometheus text format to this file while downloading, e.g. for the node exporter's textfile collector.")
+    parser.add_argument('-f', '--tempdir', action='append', default=None,
+                        help="Specify where to put temporary files. This option can be useful for example if you do not have enough space left on your harddrive and want to work on an external drive. Give it multiple times to spread the downloads over several drives.")
+    parser.add_argument('--scratch-quota', default=None,
+                        help="Limit the space the temporary files of all running downloads may use, e.g. '20G'. Downloads wait until their estimated size fits. Default: only the free space is checked")
+    parser.add_argument('--scratch-placement', default='free', choices=ScratchSpace.PLACEMENTS,
+                        help="How to spread the downloads over multiple --tempdir directories: onto the one with the most free space or onto each one in turn. Default: free")
+    parser.add_argument('--enqueue', default=None, metavar='QUEUE',
+                        help="Do not download anything, but add the episodes to a work queue (a SQLite file) that workers started with --worker download from. Episodes the workers finished since the last run are recorded in the manifest first.")
+    parser.add_argument('--worker', default=None, metavar='QUEUE',
+                        help="Download the episodes of a work queue filled with --enqueue, alongside other workers on this or other machines, until it is empty. 'what' and --path are taken from the queue.")
+    parser.add_argument('--lease', default=60., type=float,
+                        help="Specify after how many seconds without a sign of life a worker's episodes are handed to other workers. Default: 60")
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help="Start downloading without asking for confirmation.")
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Give a more verbose output of what is currently happening.")
 
     args = parser.parse_args()
+    if args.what is None and args.worker is None:
+        parser.error("the following arguments are required: what")
+    if args.enqueue and args.worker:
+        parser.error("--enqueue and --worker can not be combined")
 
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
-    s = SouthPark(args.language)
+    http_client.timeout = args.timeout
+    http_client.retries = args.retries
+    if args.limit_rate or args.limit_requests or args.rate_control:
+        http_client.rate_limiter = RateLimiter(parse_size(args.limit_rate or '') or None, args.limit_requests)
+        if args.rate_control:
+            http_client.rate_limiter.watch(args.rate_control)
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, lambda *_: http_client.rate_limiter.reload())
+    if not args.no_cache:
+        metadata_cache = MetadataCache(os.path.join(args.cache_dir, 'metadata.sqlite') if args.cache_dir else None,
+                                       offline=args.offline, refresh=args.refresh)
+    elif args.offline:
+        parser.error("--offline requires the metadata cache")
 
-    print("Collecting episodes to download...")
-    to_download = []
-    if args.what == 'all':
-        for season in s.get_all_seasons():
-            for e in season.episodes:
-                to_download.append(e)
-    else:
-        for el in map(str.strip, args.what.split(",")):
-            if '-' in el:
-                if el.count('-') > 1:
-                    raise ValueError(f"Invalid parameter: {el} in {args.what}")
-                start, end = map(parse_episode_string, map(str.strip, el.split("-", 1)))
-                for i in range(start[0], end[0] + 1):
-                    season = s.get_season(i)
-                    for e in season.episodes:
-                        if start[1] is not None and i == start[0] and int(e.episode_number_in_season) < start[1] \
-                                or end[1] is not None and i == end[0] and int(e.episode_number_in_season) > end[1]:
-                            continue
-                        to_download.append(e)
+    languages = [l.strip().lower() for l in args.language.split(',') if l.strip()]
+    qualities = [q.strip() for q in args.quality.split(',') if q.strip()]
+    for l in languages:
+        if l not in DOMAIN_URL:
+            parser.error(f"Unsupported language: {l}. Supported languages are: {', '.join(DOMAIN_URL.keys())}")
+
+    if os.path.isdir(args.path):
+        args.path = os.path.join(args.path, 'Season %s/%e - %t.mp4')
+    if args.container is not None:
+        args.path = os.path.splitext(args.path)[0] + f'.{args.container}'
+    if len(languages) > 1 and '%l' not in args.path:
+        parser.error("--path must contain '%l' to download multiple languages")
+    if len(qualities) > 1 and '%q' not in args.path:
+        parser.error("--path must contain '%q' to download multiple qualities")
+
+    def target_path(e: Episode, quality: str) -> str:
+        return os.path.realpath(
+            args.path.replace("%s", e.season).replace("%e", e.episode_number_in_season).replace("%g", e.episode_number).replace("%t", escape_filename(e.title))
+            .replace("%l", e.lang).replace("%q", escape_filename(quality)))
+
+    manifest = Manifest(args.manifest or os.path.join(os.path.dirname(args.path.split('%', 1)[0]) or '.', '.spdl-manifest.json'))
+    up_to_date = []
+    wanted: Dict[int, List[str]] = {}  # The qualities each selected episode is needed in, by id() of the episode
+
+    if args.worker is None:
+        try:
+            if args.catalog or args.update_catalog:
+                catalog = Catalog(os.path.join(args.cache_dir, 'catalog.json') if args.cache_dir else None)
+                for l in languages:
+                    if args.update_catalog or l not in catalog.updated:
+                        print(f"Updating the episode catalog ({l})...")
+                        print(f"{catalog.update(SouthPark(l), prefetch=args.resolve_threads)} new episode(s).")
+                selection = [entry.to_episode() for l in languages
+                             for entry in catalog.select(args.what, l, manifest.last_download(l))]
             else:
-                season, episode = parse_episode_string(el)
-                if episode is not None:
-                    for e in s.get_season(season).episodes:
-                        if int(e.episode_number_in_season) == episode:
-                            to_download.append(e)
-                            break
-                    else:
-                        raise ValueError(f"Season {season} Episode {episode} does not exist.")
-                else:
-                    for e in s.get_season(season).episodes:
-                        to_download.append(e)
+                # The languages are collected one after another; each episode is resolved once for all qualities
+                selection = itertools.chain.from_iterable([iter_selected_episodes(SouthPark(l), args.what, args.resolve_threads)
+                                                           for l in languages])
+        except ValueError as e:
+            parser.error(str(e))
+        except SpdlError as e:
+            print(f"Could not update the episode catalog: {e}")
+            exit(1)
 
-    to_download.sort()
+        if not args.yes and not isinstance(selection, list):
+            # Before asking, collect the episodes so that their number is shown and invalid selections fail right away
+            try:
+                selection = list(selection)
+            except ValueError as e:
+                parser.error(str(e))
+            except SpdlError as e:
+                print(f"Could not collect the episodes to download: {e}")
+                exit(1)
+
+        print(f"{'Enqueue' if args.enqueue else 'Download'}: {args.what}" + (" (only new, missing, incomplete or upgradable episodes)" if args.sync else ""))
+        if isinstance(selection, list):
+            print(f"Selected {len(selection)} episode(s) from {len(set(e.season for e in selection))} season(s).")
+        print(f"Language: {', '.join(languages)}")
+        print(f"Quality:  {', '.join(qualities)}")
+        print(f"Save to:  {args.path}")
 
-    print(f"Downloading {len(to_download)} episode(s) from {len(set(x.season for x in to_download))} season(s).")
-    print(f"Language: {args.language}")
-    print(f"Quality:  {args.quality}")
-    print(f"Save to:  {args.path}")
+        if not args.yes and input("Continue? [y/n] ") in ["n", "no", "abort", "exit", "stop", "cancel"]:
+            print("Aborted by user.")
+            exit()
+
+    def needed() -> Iterable[Episode]:
+        for e in selection:
+            wanted[id(e)] = []
+            for q in qualities:
+                if args.sync and not manifest.needs_download(e, target_path(e, q), q):
+                    up_to_date.append((e, q))
+                else:
+                    wanted[id(e)].append(q)
+            if wanted[id(e)]:
+                yield e
+            else:
+                del wanted[id(e)]
 
-    if input("Continue? [y/n] ") in ["n", "no", "abort", "exit", "stop", "cancel"]:
-        print("Aborted by user.")
+    if args.enqueue:
+        queue = WorkQueue(args.enqueue)
+        recorded = 0
+        for e, filename, result in queue.finished():
+            entry = manifest.get(e, filename)
+            finished = result.pop('finished')
+            if os.path.isfile(filename) and (entry is None or entry['downloaded'] < finished):
+                manifest.record(e, filename, **result)
+                recorded += 1
+        if recorded:
+            print(f"Recorded {recorded} download(s) the workers finished in the manifest.")
+        added = sum(queue.add(e, target_path(e, q), priority, q)
+                    for priority, (e, q) in enumerate((e, q) for e in needed() for q in wanted.pop(id(e))))
+        counts = queue.counts()
+        if args.sync:
+            print(f"{len(up_to_date)} download(s) were up to date.")
+        print(f"Added {added} download(s) to the queue. Queued: {counts['queued']}, downloading: {counts['leased']}, "
+              f"done: {counts['done']}, failed: {counts['failed']}")
         exit()
 
-    if os.path.isdir(args.path):
-        args.path = os.path.join(args.path, 'Season %s/%e - %t.mp4')
-    if args.tempdir != tempdir:
-        set_tempdir(args.tempdir)
+    if args.tempdir:
+        set_tempdir(args.tempdir[0])
+    scratch = ScratchSpace(args.tempdir, parse_size(args.scratch_quota) if args.scratch_quota else None,
+                           args.scratch_placement)
+    scratch.sweep()
+
+    stats = instrumentation.add_sink(RunStats())
+    if args.events:
+        instrumentation.add_sink(EventLogSink(args.events))
+    if args.metrics:
+        instrumentation.add_sink(MetricsSink(args.metrics, stats=stats))
+    if args.progress:
+        instrumentation.add_sink(ProgressSink())
 
-    for i, e in enumerate(to_download):
-        path = os.path.realpath(
-            args.path.replace("%s", e.season).replace("%e", e.episode_number_in_season).replace("%g", e.episode_number).replace("%t", escape_filename(e.title)))
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if args.worker is not None:
+        print(f"Downloading the episodes of the queue {args.worker}...")
+    elif not isinstance(selection, list):
+        print("Collecting episodes to download; downloads start as soon as the first season arrived...")
 
-        print(f"Downloading season {e.season} episode {e.episode_number_in_season} - {e.title}...")
-        log.debug("Saving to: %s", path)
+    def download_targets():
+        # Episodes are collected, filtered and resolved lazily, so that the first downloads start while later
+        # seasons are still being fetched
+        if worker is not None:
+            for e, path, q in worker.claims():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                yield e, path, q
+            return
+        # Resolve only as far ahead as the scheduler prefetches, so that the stream urls are fresh when they are used
+        for e in iter_resolved_episodes(needed(), args.resolve_threads, lookahead=args.prefetch):
+            for q in wanted.pop(id(e)):
+                path = target_path(e, q)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                yield e, path, q
+
+    def print_update(job: DownloadJob):
+        e = job.episode
+        if job.state == 'downloading':
+            lowered = f" (quality lowered to {job.quality})" if job.downgraded else ""
+            variant = f" [{e.lang}, {job.requested_quality}]" if len(languages) > 1 or len(qualities) > 1 else ""
+            print(f"Downloading season {e.season} episode {e.episode_number_in_season} - {e.title}{variant}{lowered}...")
+            log.debug("Saving to: %s", job.filename)
+        elif job.state == 'done':
+            copies = f" (copied to {len(job.copies)} more file(s) of the same stream)" if job.copies else ""
+            print(f"Finished season {e.season} episode {e.episode_number_in_season} - {e.title}{copies}")
+            for filename, error in job.copy_errors.items():
+                print(f"Could not copy season {e.season} episode {e.episode_number_in_season} - {e.title} to {filename}: {error}")
+        elif job.state == 'cancelled':
+            print(f"Cancelled download of season {e.season} episode {e.episode_number_in_season} - {e.title}")
+        elif job.state == 'failed':
+            print(f"Download of season {e.season} episode {e.episode_number_in_season} - {e.title} failed: {job.error}")
+
+    # Workers report their downloads to the queue; the coordinator records them in the manifest
+    worker = QueueWorker(WorkQueue(args.worker), lease=args.lease, on_update=print_update) if args.worker else None
+    scheduler = DownloadScheduler(quality=qualities[0], max_episodes=args.episodes, max_threads=args.threads,
+                                  max_threads_per_part=args.part_threads, max_merges=args.merges,
+                                  ffmpeg_executable=args.ffmpeg_binary, resume=not args.no_resume,
+                                  streaming=args.stream_mux, max_buffered=args.stream_buffer,
+                                  manifest=manifest if worker is None else None,
+                                  adaptive=AdaptiveQuality(parse_size(args.adaptive)) if args.adaptive else None,
+                                  on_update=print_update if worker is None else worker.report,
+                                  container=args.container, captions=args.captions, scratch=scratch,
+                                  streams=StreamManager(prefetch=args.prefetch))
+    # Claiming an episode from the queue leases it, so a worker does not take episodes ahead of their turn
+    scheduler.start(download_targets(), lookahead=0 if worker is not None else None)
+    while True:
         try:
-            e.download(path, quality=args.quality, ffmpeg_executable=args.ffmpeg_binary, max_threads=args.threads)
+            scheduler.wait()
+            break
         except KeyboardInterrupt:
             time.sleep(0.5)
-            if input(f"Press return to skip only this download (S{e.season} E{e.episode_number_in_season}) or enter 'exit' to cancel all remaining downloads.") in ('exit', 'e', 'all'):
-                print(f"Downloaded {i} episode(s) of {len(to_download)} ({round(i * 100. / len(to_download), 1)}%).")
+            if input("Press return to skip only the running download(s) or enter 'exit' to cancel all remaining downloads.") in ('exit', 'e', 'all'):
+                scheduler.shutdown()
+                if worker is not None:
+                    worker.close()
+                instrumentation.close()
+                done = sum(1 for j in scheduler.jobs if j.state == 'done')
+                print(f"Downloaded {done} of {len(scheduler.jobs)} started episode(s).")
                 print("Aborted by user.")
                 exit()
-            if os.path.isfile(path):
-                os.remove(path)
-            print(f"Cancelled download of season {e.season} episode {e.episode_number_in_season} - {e.title}")
+            scheduler.cancel_running()
+    scheduler.shutdown()
+    if worker is not None:
+        worker.close()
+    instrumentation.close()
 
+    if args.sync and worker is None:
+        print(f"{len(up_to_date)} of {len(up_to_date) + sum(1 + len(j.copies) for j in scheduler.jobs)} download(s) were up to date.")
+    if scheduler.feed_error is not None:
+        print(f"Could not collect all episodes to download: {scheduler.feed_error}")
+    if not scheduler.jobs:
+        print("Nothing to do.")
+        exit(1 if scheduler.feed_error is not None else 0)
+    print(stats.format())
+    if scheduler.streams.refreshed:
+        print(f"Resolved the stream urls of {scheduler.streams.refreshed} episode(s) again because they expired.")
+    damaged = [j for j in scheduler.jobs if j.state == 'done' and j.episode.verification is not None and not j.episode.verification.ok]
+    if damaged:
+        print(f"{len(damaged)} download(s) are damaged and are repeated by the next --sync:")
+        for j in damaged:
+            print(f"  S{j.episode.season}E{j.episode.episode_number_in_season} - {j.episode.title}: {'; '.join(j.episode.verification.problems)}")
+    failed = [j for j in scheduler.jobs if j.state == 'failed']
+    if failed:
+        print(f"{len(failed)} download(s) failed:")
+        for j in failed:
+            print(f"  S{j.episode.season}E{j.episode.episode_number_in_season} - {j.episode.title}: {j.error}")
     print("All done.")
@@ -0,0 +1,187 @@
+"""
+Tests of `DownloadScheduler` and the queue workers against the fake CDN of the benchmarks. The parts are merged by a
+stand-in for ffmpeg that concatenates its inputs, so that no real ffmpeg is needed.
+
+Run with `python -m unittest discover tests`.
+"""
+
+import asyncio
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import spdl
+from fake_cdn import FakeCDN
+
+FAKE_FFMPEG = f"""#!{sys.executable}
+import sys
+args = sys.argv[1:]
+inputs, outputs, i = [], [], 0
+while i < len(args):
+    if args[i] == '-i':
+        inputs.append(args[i + 1])
+        i += 1
+    elif args[i].startswith('-'):
+        i += args[i] not in ('-y', '-nostats')
+    else:
+        outputs.append(args[i])
+    i += 1
+for source, output in zip(inputs, outputs):
+    with open(output, 'wb') as out:
+        if source == 'pipe:0':
+            out.write(sys.stdin.buffer.read())
+        else:
+            for part in source[len('concat:'):].split('|'):
+                with open(part, 'rb') as f:
+                    out.write(f.read())
+"""
+
+
+class SchedulerTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cdn = FakeCDN(seasons=1, episodes=3, parts=2, segments=3, segment_size=4096)
+        spdl.http_client.host_overrides['*'] = cls.cdn.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        spdl.http_client.host_overrides.pop('*', None)
+        cls.cdn.stop()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='spdl-test-')
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.ffmpeg = os.path.join(self.directory, 'ffmpeg')
+        with open(self.ffmpeg, 'w') as f:
+            f.write(FAKE_FFMPEG)
+        os.chmod(self.ffmpeg, os.stat(self.ffmpeg).st_mode | stat.S_IEXEC)
+
+    def episodes(self, lang: str = 'en'):
+        return spdl.SouthPark(lang).get_season(1).episodes
+
+    def scheduler(self, **kwargs) -> spdl.DownloadScheduler:
+        scheduler = spdl.DownloadScheduler(ffmpeg_executable=self.ffmpeg, resume=False, **kwargs)
+        self.addCleanup(scheduler.shutdown)
+        return scheduler
+
+    def path(self, *names: str) -> str:
+        return os.path.join(self.directory, *names)
+
+
+class DeduplicationTest(SchedulerTestCase):
+    def run_scheduler(self, downloads):
+        updates = []
+        scheduler = self.scheduler(on_update=lambda job: updates.append((job, job.state)))
+        return scheduler.run(downloads), updates
+
+    def test_same_streams_are_transferred_once(self):
+        e = self.episodes()[0]
+        # '1920x1080' is the highest rendition, so it selects the same streams as 'max'
+        jobs, updates = self.run_scheduler([(e, self.path('max.mp4'), 'max'), (e, self.path('hd.mp4'), '1920x1080'),
+                                            (e, self.path('min.mp4'), 'min')])
+
+        self.assertEqual([j.state for j in jobs], ['done', 'done'])
+        primary = next(j for j in jobs if j.copies)
+        self.assertEqual({primary.filename, primary.copies[0][0]}, {self.path('max.mp4'), self.path('hd.mp4')})
+        copied = [job for job, state in updates if state == 'copied']
+        self.assertEqual(len(copied), 1)
+        self.assertIs(copied[0].copy_of, primary)
+        with open(self.path('max.mp4'), 'rb') as original, open(self.path('hd.mp4'), 'rb') as copy:
+            self.assertEqual(original.read(), copy.read())
+
+    def test_languages_are_downloaded_separately(self):
+        en, de = self.episodes('en')[0], self.episodes('de')[0]
+        jobs, updates = self.run_scheduler([(en, self.path('en.mp4')), (de, self.path('de.mp4'))])
+
+        self.assertEqual([j.state for j in jobs], ['done', 'done'])
+        self.assertEqual([j.copies for j in jobs], [[], []])
+        self.assertNotIn('copied', [state for _, state in updates])
+
+    def test_failed_copies_are_reported(self):
+        e = self.episodes()[0]
+        with open(self.path('blocker'), 'w'):
+            pass
+        jobs, _ = self.run_scheduler([(e, self.path('a.mp4')), (e, self.path('b.mp4')),
+                                      (e, self.path('blocker', 'c.mp4'))])
+
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].state, 'done')
+        self.assertEqual(list(jobs[0].copy_errors), [self.path('blocker', 'c.mp4')])
+        self.assertIsInstance(jobs[0].copy_errors[self.path('blocker', 'c.mp4')], OSError)
+        self.assertTrue(os.path.isfile(self.path('a.mp4')))
+        self.assertTrue(os.path.isfile(self.path('b.mp4')))
+
+
+class QueueWorkerTest(SchedulerTestCase):
+    def test_single_worker_drains_queue(self):
+        queue = spdl.WorkQueue(self.path('queue.sqlite'))
+        self.addCleanup(queue.close)
+        for priority, e in enumerate(self.episodes()):
+            queue.add(e, self.path(f'{e.id}.mp4'), priority)
+        # Once the queue is empty, the worker must not wait for the leases it holds itself
+        worker = spdl.QueueWorker(queue, lease=5., poll=60.)
+        self.addCleanup(worker.close)
+        scheduler = self.scheduler(max_episodes=1, on_update=worker.report)
+
+        scheduler.start(worker.claims(), lookahead=0)
+
+        self.assertTrue(scheduler.wait(20), "the worker did not finish the queue")
+        self.assertEqual(queue.counts(), {'queued': 0, 'leased': 0, 'done': 3, 'failed': 0})
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(['ffmpeg', 'queue.sqlite'] + [f'{e.id}.mp4' for e in self.episodes()]))
+
+
+    def test_worker_claims_only_started_episodes(self):
+        queue = spdl.WorkQueue(self.path('queue.sqlite'))
+        self.addCleanup(queue.close)
+        for priority, e in enumerate(self.episodes()):
+            queue.add(e, self.path(f'{e.id}.mp4'), priority)
+        worker = spdl.QueueWorker(queue, lease=5., poll=0.1)
+        self.addCleanup(worker.close)
+        leased = []
+
+        def report(job: spdl.DownloadJob):
+            worker.report(job)
+            if job.state == 'downloading':
+                started = sum(1 for j in scheduler.jobs if j.state in ('downloading', 'merging'))
+                leased.append((queue.counts()['leased'], started))
+
+        scheduler = self.scheduler(max_episodes=1, on_update=report)
+        scheduler.run(worker.claims(), lookahead=0)
+
+        self.assertEqual(len(leased), 3)
+        for claimed, started in leased:
+            self.assertLessEqual(claimed, started)
+
+
+
+class AsyncSouthParkTest(SchedulerTestCase):
+    def test_downloads_of_the_same_streams(self):
+        async def download(southpark: spdl.AsyncSouthPark, e: spdl.Episode, filename: str, quality: str):
+            async for progress in southpark.download(e, self.path(filename), quality):
+                pass
+            return progress
+
+        async def main():
+            async with spdl.AsyncSouthPark(ffmpeg_executable=self.ffmpeg, resume=False) as southpark:
+                e = (await southpark.get_season(1)).episodes[0]
+                results = await asyncio.gather(download(southpark, e, 'max.mp4', 'max'),
+                                               download(southpark, e, 'hd.mp4', '1920x1080'))
+                return results, southpark.scheduler.jobs
+
+        results, jobs = asyncio.run(main())
+
+        self.assertEqual([p.state for p in results], ['done', 'done'])
+        self.assertEqual(len(jobs), 1, "the streams were transferred twice")
+        with open(self.path('max.mp4'), 'rb') as original, open(self.path('hd.mp4'), 'rb') as copy:
+            self.assertEqual(original.read(), copy.read())
+
+if __name__ == '__main__':
+    unittest.main()